@@ -18,8 +18,9 @@ from offlineimap import mbnames, CustomConfig, OfflineImapError
 from offlineimap.repository import Repository
 from offlineimap.ui import getglobalui
 from offlineimap.threadutil import InstanceLimitedThread
+from offlineimap.movedetect import MoveDetector
 from subprocess import Popen, PIPE
-from threading import Event
+from threading import Event, Lock, RLock
 import os
 from sys import exc_info
 import traceback
@@ -71,6 +72,15 @@ class Account(CustomConfig.ConfigHelperMixin):
         # should we run in "dry-run" mode?
         self.dryrun = self.config.getboolean('general', 'dry-run')
         self.quicknum = 0
+        # MoveDetector of the running sync, if movedetection is on
+        self.movedetector = None
+        # keep folders and their message lists from one sync to the next
+        self.keepfolders = self.getconfboolean('keepfolders', False)
+        # remote folder name -> (remotefolder, localfolder, statusfolder)
+        self.keptfolders = {}
+        # remote folder name -> lock held while the folder is synced
+        self._folderlocks = {}
+        self._folderlockslock = Lock()
         if self.refreshperiod == 0.0:
             self.refreshperiod = None
 
@@ -92,6 +102,14 @@ class Account(CustomConfig.ConfigHelperMixin):
     def getsection(self):
         return 'Account ' + self.getname()
 
+    def getfolderlock(self, foldername):
+        """:returns: the lock held while a remote folder is synced
+
+        Besides the folder threads of a sync, folders are synced by the
+        threads watching for changes, e.g. with IDLE or inotify."""
+        with self._folderlockslock:
+            return self._folderlocks.setdefault(foldername, RLock())
+
     @classmethod
     def set_abort_event(cls, config, signum):
         """Set skip sleep/abort event for all accounts
@@ -225,35 +243,40 @@ class SyncableAccount(Account):
         self.localrepos  = Repository(self, 'local')
         self.statusrepos = Repository(self, 'status')
 
-        # Loop account sync if needed (bail out after 3 failures)
-        looping = 3
-        while looping:
-            self.ui.acct(self)
-            try:
-                self.lock()
-                self.sync()
-            except (KeyboardInterrupt, SystemExit):
-                raise
-            except OfflineImapError as e:
-                # Stop looping and bubble up Exception if needed.
-                if e.severity >= OfflineImapError.ERROR.REPO:
-                    if looping:
-                        looping -= 1
-                    if e.severity >= OfflineImapError.ERROR.CRITICAL:
-                        raise
-                self.ui.error(e, exc_info()[2])
-            except Exception as e:
-                self.ui.error(e, exc_info()[2], msg = "While attempting to sync"
-                    " account '%s'" % self)
-            else:
-                # after success sync, reset the looping counter to 3
-                if self.refreshperiod:
-                    looping = 3
-            finally:
-                self.ui.acctdone(self)
-                self.unlock()
-                if looping and self.sleeper() >= 2:
-                    looping = 0
+        try:
+            # Loop account sync if needed (bail out after 3 failures)
+            looping = 3
+            while looping:
+                self.ui.acct(self)
+                try:
+                    self.lock()
+                    self.sync()
+                except (KeyboardInterrupt, SystemExit):
+                    raise
+                except OfflineImapError as e:
+                    # Stop looping and bubble up Exception if needed.
+                    if e.severity >= OfflineImapError.ERROR.REPO:
+                        if looping:
+                            looping -= 1
+                        if e.severity >= OfflineImapError.ERROR.CRITICAL:
+                            raise
+                    self.ui.error(e, exc_info()[2])
+                except Exception as e:
+                    self.ui.error(e, exc_info()[2], msg = "While attempting "
+                        "to sync account '%s'" % self)
+                else:
+                    # after success sync, reset the looping counter to 3
+                    if self.refreshperiod:
+                        looping = 3
+                finally:
+                    self.ui.acctdone(self)
+                    self.unlock()
+                    if looping and self.sleeper() >= 2:
+                        looping = 0
+        finally:
+            for repos in (self.remoterepos, self.localrepos,
+                          self.statusrepos):
+                repos.close()
 
     def sync(self):
         """Synchronize the account once, then return
@@ -296,8 +319,20 @@ class SyncableAccount(Account):
             if not localrepos.getconfboolean('readonly', False):
                 self.ui.syncfolders(remoterepos, localrepos)
 
+            if self.getconfboolean('movedetection', False) and \
+                    not self.dryrun:
+                self.movedetector = MoveDetector()
+
+            remotefolders = remoterepos.getfolders()
+            if self.keepfolders:
+                remotefolders = self.getkeptfolders(remotefolders)
+
+            if quick:
+                remoterepos.prepare_quickchanged([folder for folder in
+                    remotefolders if folder.sync_this])
+
             # iterate through all folders on the remote repo and sync
-            for remotefolder in remoterepos.getfolders():
+            for remotefolder in remotefolders:
                 # check for CTRL-C or SIGTERM
                 if Account.abort_NOW_signal.is_set(): break
                 if not remotefolder.sync_this:
@@ -314,6 +349,7 @@ class SyncableAccount(Account):
             # wait for all threads to finish
             for thr in folderthreads:
                 thr.join()
+            self.finishmoves()
             # Write out mailbox names if required and not in dry-run mode
             if not self.dryrun:
                 mbnames.write()
@@ -322,9 +358,20 @@ class SyncableAccount(Account):
         except:
             #error while syncing. Drop all connections that we have, they
             #might be bogus by now (e.g. after suspend)
+            exc = exc_info()
+            if not isinstance(exc[1], (KeyboardInterrupt, SystemExit)):
+                # folder threads may still stash messages
+                for thr in folderthreads:
+                    thr.join()
+            try:
+                self.finishmoves()
+            except Exception as e:
+                self.ui.error(e, exc_info()[2], msg = "Deleting the messages "
+                              "stashed by move detection")
+            self.keptfolders = {}
             localrepos.dropconnections()
             remoterepos.dropconnections()
-            raise
+            raise exc[0], exc[1], exc[2]
         else:
             # sync went fine. Hold or drop depending on config
             localrepos.holdordropconnections()
@@ -333,6 +380,29 @@ class SyncableAccount(Account):
         hook = self.getconf('postsynchook', '')
         self.callhook(hook)
 
+    def finishmoves(self):
+        """Delete the messages stashed by the move detector for good
+
+        Stashed messages were deleted from the status already, so they
+        are deleted even if the sync failed. Otherwise the next sync
+        would copy them back."""
+        movedetector, self.movedetector = self.movedetector, None
+        if movedetector is not None:
+            movedetector.finish()
+
+    def getkeptfolders(self, remotefolders):
+        """Replace remote folders by the ones kept from the last sync
+
+        Kept folders that are no longer listed are forgotten.
+
+        :returns: the list of remote folders to sync"""
+        names = set(folder.getname() for folder in remotefolders)
+        for name in self.keptfolders.keys():
+            if not name in names:
+                del self.keptfolders[name]
+        return [self.keptfolders.get(folder.getname(), (folder,))[0]
+                for folder in remotefolders]
+
     def callhook(self, cmd):
         # check for CTRL-C or SIGTERM and run postsynchook
         if Account.abort_NOW_signal.is_set():
@@ -358,7 +428,12 @@ def syncfolder(account, remotefolder, quick):
     """This function is called as target for the
     InstanceLimitedThread invokation in SyncableAccount.
 
-    Filtered folders on the remote side will not invoke this function."""
+    Filtered folders on the remote side will not invoke this function.
+    Syncs of the same folder in other threads wait for each other."""
+    with account.getfolderlock(remotefolder.getname()):
+        _syncfolder(account, remotefolder, quick)
+
+def _syncfolder(account, remotefolder, quick):
     remoterepos = account.remoterepos
     localrepos = account.localrepos
     statusrepos = account.statusrepos
@@ -366,10 +441,16 @@ def syncfolder(account, remotefolder, quick):
     ui = getglobalui()
     ui.registerthread(account)
     try:
-        # Load local folder.
-        localfolder = localrepos.\
-                      getfolder(remotefolder.getvisiblename().\
-                                replace(remoterepos.getsep(), localrepos.getsep()))
+        # Folders kept from the last sync, if any. They are only kept
+        # again once this sync succeeded.
+        kept = account.keptfolders.pop(remotefolder.getname(), None)
+        if kept is not None:
+            localfolder, statusfolder = kept[1:]
+        else:
+            # Load local folder.
+            localfolder = localrepos.\
+                getfolder(remotefolder.getvisiblename().\
+                          replace(remoterepos.getsep(), localrepos.getsep()))
 
         #Filtered folders on the remote side will not invoke this
         #function, but we need to NOOP if the local folder is filtered
@@ -381,10 +462,14 @@ def syncfolder(account, remotefolder, quick):
         # Write the mailboxes
         mbnames.add(account.name, localfolder.getname())
 
-        # Load status folder.
-        statusfolder = statusrepos.getfolder(remotefolder.getvisiblename().\
-                                             replace(remoterepos.getsep(),
-                                                     statusrepos.getsep()))
+        if kept is not None:
+            for folder in (remotefolder, localfolder, statusfolder):
+                folder.prepare_resync()
+        else:
+            # Load status folder.
+            statusfolder = statusrepos.getfolder(remotefolder.getvisiblename().\
+                                                 replace(remoterepos.getsep(),
+                                                         statusrepos.getsep()))
         if localfolder.get_uidvalidity() == None:
             # This is a new folder, so delete the status cache to be
             # sure we don't have a conflict.
@@ -398,9 +483,14 @@ def syncfolder(account, remotefolder, quick):
             if not localfolder.quickchanged(statusfolder) \
                    and not remotefolder.quickchanged(statusfolder):
                 ui.skippingfolder(remotefolder)
+                if kept is not None:
+                    account.keptfolders[remotefolder.getname()] = kept
                 localrepos.restore_atime()
                 return
 
+        # the folders kept from the last sync are outdated from here on
+        remoterepos.savesyncstate(remotefolder)
+
         # Load local folder
         ui.syncingfolder(remoterepos, remotefolder, localrepos, localfolder)
         ui.loadmessagelist(localrepos, localfolder)
@@ -449,6 +539,11 @@ def syncfolder(account, remotefolder, quick):
                          % remoterepos.getname())
 
         statusfolder.save()
+        remotefolder.save_quickstatus()
+        remoterepos.savesyncstate(remotefolder, localfolder, statusfolder)
+        if account.keepfolders:
+            account.keptfolders[remotefolder.getname()] = \
+                (remotefolder, localfolder, statusfolder)
         localrepos.restore_atime()
     except (KeyboardInterrupt, SystemExit):
         raise
@@ -470,3 +565,51 @@ def syncfolder(account, remotefolder, quick):
         ui.error(e, msg = "ERROR in syncfolder for %s folder %s: %s" % \
                 (account, remotefolder.getvisiblename(),
                  traceback.format_exc()))
+
+def syncfolder_changes(account, responses, remotefolder, localfolder,
+                       statusfolder):
+    """Apply the changes a server pushed to a folder synced before
+
+    Rather than loading the status, local and remote folders again and
+    comparing all messages like syncfolder(), only the new and changed
+    messages of the FETCH responses are copied or have their flags
+    synced to the local folder. The folders are the ones kept by the
+    repository's savesyncstate() after the last full sync. Local
+    changes are left to the next full sync.
+
+    :returns: True on success, False if the folder needs a full sync"""
+    remoterepos = account.remoterepos
+    localrepos = account.localrepos
+    ui = getglobalui()
+    ui.registerthread(account)
+    if localrepos.getconfboolean('readonly', False) or \
+            account.getconfint('maxage', None) or \
+            account.getconfint('maxsize', None):
+        # messages might need to be filtered, leave that to syncfolder()
+        return False
+    with account.getfolderlock(remotefolder.getname()):
+        try:
+            uids = remotefolder.updatemessagelist(responses)
+            newuids = [uid for uid in uids
+                       if not statusfolder.uidexists(uid)]
+            newuidset = set(newuids)
+            changeduids = [uid for uid in uids if not uid in newuidset]
+            ui.syncingmessages(remoterepos, remotefolder, localrepos,
+                               localfolder)
+            remotefolder.syncmessagesto_copy(localfolder, statusfolder,
+                                             newuids)
+            remotefolder.syncmessagesto_flags(localfolder, statusfolder,
+                                              changeduids)
+            statusfolder.save()
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except OfflineImapError as e:
+            if e.severity > OfflineImapError.ERROR.FOLDER:
+                raise
+            # e.g. a local message was renamed meanwhile, start afresh
+            ui.error(e, exc_info()[2], msg = "Applying changes to folder "
+                     "'%s' [acc: '%s']" % (localfolder, account))
+            return False
+    localrepos.restore_atime()
+    return True
+
@@ -15,12 +15,14 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
-from offlineimap import threadutil
+from offlineimap import threadutil, imaputil
 from offlineimap.ui import getglobalui
 from offlineimap.error import OfflineImapError
+from offlineimap.syncplan import SyncPlan
 import offlineimap.accounts
 import os.path
 import re
+from io import BytesIO
 from sys import exc_info
 import traceback
 
@@ -63,8 +65,8 @@ class BaseFolder(object):
         return 0
 
     def getcopyinstancelimit(self):
-        """For threading folders, returns the instancelimitname for
-        InstanceLimitedThreads."""
+        """For threading folders, returns the name of the WorkerPool to
+        copy messages with."""
         raise NotImplementedException
 
     def storesmessages(self):
@@ -155,6 +157,41 @@ class BaseFolder(object):
             file.write("%d\n" % newval)
         os.rename(uidfilename + ".tmp", uidfilename)
         self._base_saved_uidvalidity = newval
+        # a HIGHESTMODSEQ is meaningless with another UIDVALIDITY
+        self._base_saved_highestmodseq = None
+
+    def get_savedhighestmodseq(self):
+        """Return the HIGHESTMODSEQ (RFC 7162) cached with the UIDVALIDITY
+
+        :returns: HIGHESTMODSEQ as (long) number or None, if None had
+            been saved yet."""
+        if hasattr(self, '_base_saved_highestmodseq'):
+            return self._base_saved_highestmodseq
+        self._base_saved_highestmodseq = None
+        uidfilename = self._getuidfilename()
+        if os.path.exists(uidfilename):
+            with open(uidfilename, "rt") as file:
+                file.readline() # UIDVALIDITY
+                modseq = file.readline().strip()
+            if modseq:
+                self._base_saved_highestmodseq = long(modseq)
+        return self._base_saved_highestmodseq
+
+    def save_highestmodseq(self, modseq):
+        """Save the HIGHESTMODSEQ value next to the cached UIDVALIDITY
+
+        Does nothing if no UIDVALIDITY has been saved yet. This function
+        is not threadsafe, so don't attempt to call it from concurrent
+        threads."""
+        uidvalidity = self.get_saveduidvalidity()
+        if uidvalidity is None:
+            return
+        uidfilename = self._getuidfilename()
+
+        with open(uidfilename + ".tmp", "wt") as file:
+            file.write("%d\n%d\n" % (uidvalidity, modseq))
+        os.rename(uidfilename + ".tmp", uidfilename)
+        self._base_saved_highestmodseq = modseq
 
     def get_uidvalidity(self):
         """Retrieve the current connections UIDVALIDITY value
@@ -169,6 +206,22 @@ class BaseFolder(object):
         memory unless this function is called again."""
         raise NotImplementedException
 
+    def prepare_resync(self):
+        """Prepare a folder kept from the last sync to be synced again
+
+        Called by accounts with keepfolders before a folder object is
+        reused for the next sync. Folders that can tell whether their
+        message list is still up to date keep it for cachemessagelist()
+        to update. The default drops it, so it is loaded from scratch."""
+        self.messagelist = None
+
+    def save_quickstatus(self):
+        """Remember the folder state of a completed sync for quickchanged()
+
+        Called after the folder has been synced successfully. The
+        default implementation does nothing."""
+        pass
+
     def getmessagelist(self):
         """Gets the current message list.
         You must call cachemessagelist() before calling this function!"""
@@ -191,6 +244,86 @@ class BaseFolder(object):
         """Returns the content of the specified message."""
         raise NotImplementedException
 
+    def getmessages(self, uidlist):
+        """Retrieves the content of several messages at once.
+
+        This is a generator yielding (uid, content) tuples. Backends
+        which can retrieve messages in bulk should override it, the
+        default implementation simply calls getmessage() for each uid.
+        Messages that could not be retrieved are not yielded, it is up
+        to the caller to notice that."""
+        for uid in uidlist:
+            yield uid, self.getmessage(uid)
+
+    def getmessage_stream(self, uid, file):
+        """Writes the content of the specified message to file
+
+        Backends which can pass on a message piecewise, without holding
+        all of it in memory, should override this. The default
+        implementation writes the result of getmessage()."""
+        file.write(self.getmessage(uid))
+
+    def streamsmessage(self, uid):
+        """Returns True if the message should be copied with
+        getmessage_stream() rather than getmessage()"""
+        return False
+
+    def getmessagesize(self, uid):
+        """Returns the size of the specified message in bytes, or None
+        if the size is not known without retrieving the message."""
+        return None
+
+    def getfetchbatchlimits(self):
+        """Returns a (maxcount, maxbytes) tuple limiting how many messages
+        should be retrieved with a single getmessages() call.
+
+        maxbytes may be None for no limit. The default of 1 message per
+        batch disables batching."""
+        return (1, None)
+
+    def getsavebatchlimits(self):
+        """Returns a (maxcount, maxbytes) tuple limiting how many messages
+        should be stored with a single savemessages() call.
+
+        maxbytes may be None for no limit. The default of 1 message per
+        batch disables batching."""
+        return (1, None)
+
+    def getcopybatches(self, uidlist, dstfolder):
+        """Splits uidlist into batches of messages to be copied together
+
+        Batches are bounded by the message count as well as by the
+        accumulated message size (if known). Batching is worthwhile if
+        either we can retrieve (see getfetchbatchlimits()) or dstfolder
+        can store (see getsavebatchlimits()) several messages at once.
+        A message larger than the size limit or one to be streamed ends
+        up in a batch of its own.
+
+        :returns: a list of lists of uids"""
+        fetchcount, fetchbytes = self.getfetchbatchlimits()
+        savecount, savebytes = dstfolder.getsavebatchlimits()
+        maxcount = max(fetchcount, savecount)
+        maxbytes = min([limit for limit in (fetchbytes, savebytes)
+                        if limit] or [None])
+        if maxcount <= 1:
+            return [[uid] for uid in uidlist]
+        batches = []
+        batch, batchbytes = [], 0
+        for uid in uidlist:
+            if self.streamsmessage(uid):
+                batches.append([uid])
+                continue
+            size = self.getmessagesize(uid) or 0
+            if batch and (len(batch) >= maxcount or (maxbytes and
+                                              batchbytes + size > maxbytes)):
+                batches.append(batch)
+                batch, batchbytes = [], 0
+            batch.append(uid)
+            batchbytes += size
+        if batch:
+            batches.append(batch)
+        return batches
+
     def savemessage(self, uid, content, flags, rtime):
         """Writes a new message, with the specified uid.
 
@@ -215,6 +348,28 @@ class BaseFolder(object):
         """
         raise NotImplementedException
 
+    def savemessage_stream(self, uid, writer, flags, rtime):
+        """Writes a new message, like savemessage()
+
+        Rather than being passed in, the content is written by calling
+        writer(file) with a file-like object. Backends which can store
+        it piecewise should override this, the default implementation
+        collects the content in memory and calls savemessage()."""
+        content = BytesIO()
+        writer(content)
+        return self.savemessage(uid, content.getvalue(), flags, rtime)
+
+    def savemessages(self, messages):
+        """Writes several new messages at once
+
+        :param messages: list of (uid, content, flags, rtime) tuples,
+            each with the meaning of the savemessage() arguments.
+        :returns: the list of new uids, as savemessage() would return
+            them, or None if the messages could not be saved together.
+            In that case, none of them has been saved. The default
+            implementation always returns None."""
+        return None
+
     def getmessagetime(self, uid):
         """Return the received time for the specified message."""
         raise NotImplementedException
@@ -269,6 +424,74 @@ class BaseFolder(object):
         for uid in uidlist:
             self.deletemessageflags(uid, flags)
 
+    def applyflagchanges(self, changes):
+        """Adds and removes flags of several messages at once
+
+        :param changes: dict of uid -> (addflags, delflags), each a set
+            of flags to add to, or remove from the message.
+
+        Messages with the same change are handed to addmessagesflags()
+        and deletemessagesflags() together.
+
+        Note that this function does not check against dryrun settings,
+        so you need to ensure that it is never called in a
+        dryrun mode."""
+        for operation, flags, uids in imaputil.flagchanges2groups(changes):
+            if operation == '+':
+                self.addmessagesflags(uids, flags)
+            else:
+                self.deletemessagesflags(uids, flags)
+
+    def getmessagekeys(self, uidlist):
+        """Message-ID and size of messages, to recognize moved messages
+
+        Backends that cannot provide these cheaply return an empty dict.
+
+        :returns: dict of uid -> (messageid, size). Messages without a
+            Message-ID header are left out."""
+        return {}
+
+    def stashmessages(self, uidlist):
+        """Remove messages from the folder, but keep them for a while
+
+        Stashed messages can be moved into another folder of the same
+        repository with savemessage_moved() or are removed for good by
+        dropstashedmessages(), see :class:`offlineimap.movedetect.
+        MoveDetector`. Backends that do not support this stash nothing.
+
+        Note that this function does not check against dryrun settings,
+        so you need to ensure that it is never called in a
+        dryrun mode.
+
+        :returns: dict of uid -> handle of the messages stashed"""
+        return {}
+
+    def savemessage_moved(self, uid, srcfolder, handle, flags, rtime):
+        """Move a message stashed by srcfolder into this folder
+
+        Otherwise this works like savemessage(), and the same return
+        values apply.
+
+        :returns: the new UID, or None if the message was not moved"""
+        return None
+
+    def linkmessage(self, uid, srcfolder, srcuid, flags, rtime):
+        """Store a message that srcfolder of this repository has already
+
+        This saves downloading the same message again, e.g. for each
+        label of a Gmail message. Otherwise this works like
+        savemessage(), and the same return values apply.
+
+        :returns: the new UID, or None if the message was not linked"""
+        return None
+
+    def dropstashedmessages(self, handles):
+        """Remove messages stashed by stashmessages() for good
+
+        Messages that were moved by savemessage_moved() meanwhile are
+        skipped."""
+        pass
+
     def change_message_uid(self, uid, new_uid):
         """Change the message from existing uid to new_uid
 
@@ -294,7 +517,8 @@ class BaseFolder(object):
         for uid in uidlist:
             self.deletemessage(uid)
 
-    def copymessageto(self, uid, dstfolder, statusfolder, register = 1):
+    def copymessageto(self, uid, dstfolder, statusfolder, register = 1,
+                      content = None, new_uid = None):
         """Copies a message from self to dst if needed, updating the status
 
         Note that this function does not check against dryrun settings,
@@ -305,6 +529,11 @@ class BaseFolder(object):
         :param dstfolder: A BaseFolder-derived instance
         :param statusfolder: A LocalStatusFolder instance
         :param register: whether we should register a new thread."
+        :param content: the message body if it has already been
+            retrieved (e.g. by copymessagesto()), None to fetch it here.
+        :param new_uid: the uid returned if the message has already been
+            saved in dstfolder (e.g. by copymessagesto()), None to save
+            it here.
         :returns: Nothing on success, or raises an Exception."""
         # Sometimes, it could be the case that if a sync takes awhile,
         # a message might be deleted from the maildir before it can be
@@ -315,24 +544,32 @@ class BaseFolder(object):
             self.ui.registerthread(self.repository.account)
 
         try:
-            message = None
+            message = content
             flags = self.getmessageflags(uid)
             rtime = self.getmessagetime(uid)
 
-            if uid > 0 and dstfolder.uidexists(uid):
+            if new_uid is None and uid > 0 and dstfolder.uidexists(uid):
                 # dst has message with that UID already, only update status
                 statusfolder.savemessage(uid, None, flags, rtime)
                 return
 
             # If any of the destinations actually stores the message body,
-            # load it up.
-            if dstfolder.storesmessages():
-                message = self.getmessage(uid)
+            # load it up, or pass it on piecewise if it is large.
+            if new_uid is not None:
+                pass # saved along with others by copymessagesto()
+            elif message is None and dstfolder.storesmessages() and \
+                    self.streamsmessage(uid):
+                new_uid = dstfolder.savemessage_stream(uid,
+                    lambda file: self.getmessage_stream(uid, file),
+                    flags, rtime)
+            else:
+                if message is None and dstfolder.storesmessages():
+                    message = self.getmessage(uid)
+                new_uid = dstfolder.savemessage(uid, message, flags, rtime)
             #Succeeded? -> IMAP actually assigned a UID. If newid
             #remained negative, no server was willing to assign us an
             #UID. If newid is 0, saving succeeded, but we could not
             #retrieve the new UID. Ignore message in this case.
-            new_uid = dstfolder.savemessage(uid, message, flags, rtime)
             if new_uid > 0:
                 if new_uid != uid:
                     # Got new UID, change the local uid to match the new one.
@@ -366,7 +603,83 @@ class BaseFolder(object):
                                exc_info()[2]))
             raise    #raise on unknown errors, so we can fix those
 
-    def syncmessagesto_copy(self, dstfolder, statusfolder):
+    def copymessagesto(self, uidlist, dstfolder, statusfolder, register = 1):
+        """Copies a batch of messages from self to dst, updating the status
+
+        The bodies of all messages that dstfolder does not have yet are
+        retrieved with a single getmessages() call and stored with a
+        single dstfolder.savemessages() call if possible, or else handed
+        to copymessageto() one by one. Messages which were not returned
+        in bulk are copied one by one afterwards, so errors are reported
+        per message just as with copymessageto().
+
+        Note that this function does not check against dryrun settings,
+        so you need to ensure that it is never called in a
+        dryrun mode.
+
+        :param uidlist: uids of the messages to be copied.
+        :param register: whether we should register a new thread."""
+        if register: # output that we start a new thread
+            self.ui.registerthread(self.repository.account)
+
+        copied = set()
+        if dstfolder.storesmessages():
+            fetchlist = [uid for uid in uidlist
+                         if not (uid > 0 and dstfolder.uidexists(uid))]
+            try:
+                messages = []
+                if fetchlist:
+                    fetched = set()
+                    fetchset = set(fetchlist)
+                    for uid, content in self.getmessages(fetchlist):
+                        if uid in fetched or uid not in fetchset:
+                            continue
+                        messages.append((uid, content,
+                                         self.getmessageflags(uid),
+                                         self.getmessagetime(uid)))
+                        fetched.add(uid)
+                new_uids = None
+                if len(messages) > 1:
+                    new_uids = dstfolder.savemessages(messages)
+                if new_uids is None:
+                    new_uids = [None] * len(messages)
+                for (uid, content, flags, rtime), new_uid in zip(messages,
+                                                                 new_uids):
+                    self.copymessageto(uid, dstfolder, statusfolder,
+                                       register = 0, content = content,
+                                       new_uid = new_uid)
+                    copied.add(uid)
+            except (KeyboardInterrupt): # bubble up CTRL-C
+                raise
+            except OfflineImapError as e:
+                if e.severity > OfflineImapError.ERROR.MESSAGE:
+                    raise # buble severe errors up
+                self.ui.error(e, exc_info()[2])
+        for uid in uidlist:
+            if not uid in copied:
+                self.copymessageto(uid, dstfolder, statusfolder, register = 0)
+
+    def getsyncplan(self, dstfolder, statusfolder, uidlist=None):
+        """Compare the message lists for a sync to dstfolder
+
+        :param uidlist: only consider these messages rather than all.
+            The plan then has no deletions.
+        :returns: a :class:`offlineimap.syncplan.SyncPlan`"""
+        if uidlist is None:
+            return SyncPlan(self.getmessagelist(),
+                            dstfolder.getmessageuidlist(),
+                            statusfolder.getmessagelist())
+        srcmessages = dict((uid, {'flags': self.getmessageflags(uid)})
+                           for uid in uidlist if self.uidexists(uid))
+        return SyncPlan(srcmessages,
+                        [uid for uid in srcmessages
+                         if dstfolder.uidexists(uid)],
+                        dict((uid, {'flags': statusfolder.getmessageflags(uid)})
+                             for uid in srcmessages
+                             if statusfolder.uidexists(uid)))
+
+    def syncmessagesto_copy(self, dstfolder, statusfolder, uidlist=None,
+                            plan=None):
         """Pass1: Copy locally existing messages not on the other side
 
         This will copy messages to dstfolder that exist locally but are
@@ -377,40 +690,66 @@ class BaseFolder(object):
            - If dstfolder doesn't have it yet, add them to dstfolder.
            - Update statusfolder
 
+        Messages are handed to copymessageto() one by one, or in batches
+        to copymessagesto() if getcopybatches() groups them. Folders that
+        suggest threads copy them on the workers of their WorkerPool.
+
         This function checks and protects us from action in ryrun mode.
-        """
-        threads = []
 
-        copylist = filter(lambda uid: not \
-                              statusfolder.uidexists(uid),
-                            self.getmessageuidlist())
+        :param uidlist: only consider these messages rather than all.
+        :param plan: the SyncPlan to execute, see getsyncplan().
+        """
+        if plan is None:
+            plan = self.getsyncplan(dstfolder, statusfolder, uidlist)
+        copylist = plan.copy
         num_to_copy = len(copylist)
         if num_to_copy and self.repository.account.dryrun:
             self.ui.info("[DRYRUN] Copy {} messages from {}[{}] to {}".format(
                     num_to_copy, self, self.repository, dstfolder.repository))
             return
-        for num, uid in enumerate(copylist):
-            # bail out on CTRL-C or SIGTERM
-            if offlineimap.accounts.Account.abort_NOW_signal.is_set():
-                break
-            self.ui.copyingmessage(uid, num+1, num_to_copy, self, dstfolder)
-            # exceptions are caught in copymessageto()
-            if self.suggeststhreads():
-                self.waitforthread()
-                thread = threadutil.InstanceLimitedThread(\
-                    self.getcopyinstancelimit(),
-                    target = self.copymessageto,
-                    name = "Copy message from %s:%s" % (self.repository, self),
-                    args = (uid, dstfolder, statusfolder))
-                thread.start()
-                threads.append(thread)
-            else:
-                self.copymessageto(uid, dstfolder, statusfolder,
+        movedetector = self.repository.account.movedetector
+        if num_to_copy and movedetector is not None:
+            # messages moved here from another folder
+            copylist = movedetector.movemessagesto(self, copylist, dstfolder,
+                                                   statusfolder)
+            num_to_copy = len(copylist)
+
+        def batches():
+            num = 0
+            for batch in self.getcopybatches(copylist, dstfolder):
+                # bail out on CTRL-C or SIGTERM
+                if offlineimap.accounts.Account.abort_NOW_signal.is_set():
+                    break
+                for uid in batch:
+                    num += 1
+                    self.ui.copyingmessage(uid, num, num_to_copy, self,
+                                           dstfolder)
+                yield batch
+
+        def copybatch(batch):
+            # errors on single messages are caught in copymessage(s)to()
+            if len(batch) == 1:
+                self.copymessageto(batch[0], dstfolder, statusfolder,
                                    register = 0)
-        for thread in threads:
-            thread.join()
+            else:
+                self.copymessagesto(batch, dstfolder, statusfolder,
+                                    register = 0)
 
-    def syncmessagesto_delete(self, dstfolder, statusfolder):
+        if not self.suggeststhreads():
+            for batch in batches():
+                copybatch(batch)
+            return
+        pool = threadutil.getWorkerPool(self.getcopyinstancelimit())
+        error = None
+        for batch, result, exc in pool.imap(copybatch, batches(),
+                                            self.repository.account):
+            # let the copies under way finish before raising
+            if exc is not None and error is None:
+                error = exc
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+    def syncmessagesto_delete(self, dstfolder, statusfolder, plan=None):
         """Pass 2: Remove locally deleted messages on dst
 
         Get all UIDS in statusfolder but not self. These are messages
@@ -418,20 +757,27 @@ class BaseFolder(object):
         statusfolder.
 
         This function checks and protects us from action in ryrun mode.
+
+        :param plan: the SyncPlan to execute, see getsyncplan().
         """
-        deletelist = filter(lambda uid: uid>=0 \
-                                and not self.uidexists(uid),
-                            statusfolder.getmessageuidlist())
+        if plan is None:
+            plan = self.getsyncplan(dstfolder, statusfolder)
+        deletelist = plan.delete
         if len(deletelist):
             self.ui.deletingmessages(deletelist, [dstfolder])
             if self.repository.account.dryrun:
                 return #don't delete messages in dry-run mode
             # delete in statusfolder first to play safe. In case of abort, we
             # won't lose message, we will just retransmit some unneccessary.
-            for folder in [statusfolder, dstfolder]:
-                folder.deletemessages(deletelist)
-
-    def syncmessagesto_flags(self, dstfolder, statusfolder):
+            statusfolder.deletemessages(deletelist)
+            movedetector = self.repository.account.movedetector
+            if movedetector is not None:
+                # keep messages that may have been moved to another folder
+                deletelist = movedetector.stashmessages(dstfolder, deletelist)
+            dstfolder.deletemessages(deletelist)
+
+    def syncmessagesto_flags(self, dstfolder, statusfolder, uidlist=None,
+                             plan=None):
         """Pass 3: Flag synchronization
 
         Compare flag mismatches in self with those in statusfolder. If
@@ -440,51 +786,25 @@ class BaseFolder(object):
         statusfolder.
 
         This function checks and protects us from action in ryrun mode.
-        """
-        # For each flag, we store a list of uids to which it should be
-        # added.  Then, we can call addmessagesflags() to apply them in
-        # bulk, rather than one call per message.
-        addflaglist = {}
-        delflaglist = {}
-        for uid in self.getmessageuidlist():
-            # Ignore messages with negative UIDs missed by pass 1 and
-            # don't do anything if the message has been deleted remotely
-            if uid < 0 or not dstfolder.uidexists(uid):
-                continue
-
-            selfflags = self.getmessageflags(uid)
-            statusflags = statusfolder.getmessageflags(uid)
-            #if we could not get message flags from LocalStatus, assume empty.
-            if statusflags is None:
-                statusflags = set()
-
-            addflags = selfflags - statusflags
-            delflags = statusflags - selfflags
-
-            for flag in addflags:
-                if not flag in addflaglist:
-                    addflaglist[flag] = []
-                addflaglist[flag].append(uid)
-
-            for flag in delflags:
-                if not flag in delflaglist:
-                    delflaglist[flag] = []
-                delflaglist[flag].append(uid)
 
-        for flag, uids in addflaglist.items():
-            self.ui.addingflags(uids, flag, dstfolder)
-            if self.repository.account.dryrun:
-                continue #don't actually add in a dryrun
-            dstfolder.addmessagesflags(uids, set(flag))
-            statusfolder.addmessagesflags(uids, set(flag))
+        :param uidlist: only consider these messages rather than all.
+        :param plan: the SyncPlan to execute, see getsyncplan().
+        """
+        # The flags to be added and removed per message are applied in
+        # bulk with applyflagchanges(), rather than one call per message.
+        if plan is None:
+            plan = self.getsyncplan(dstfolder, statusfolder, uidlist)
+        changes = plan.flagchanges
+        for operation, flags, uids in imaputil.flagchanges2groups(changes):
+            if operation == '+':
+                self.ui.addingflags(uids, sorted(flags), dstfolder)
+            else:
+                self.ui.deletingflags(uids, sorted(flags), dstfolder)
+        if self.repository.account.dryrun or not changes:
+            return #don't actually change flags in a dryrun
+        dstfolder.applyflagchanges(changes)
+        statusfolder.applyflagchanges(changes)
 
-        for flag,uids in delflaglist.items():
-            self.ui.deletingflags(uids, flag, dstfolder)
-            if self.repository.account.dryrun:
-                continue #don't actually remove in a dryrun
-            dstfolder.deletemessagesflags(uids, set(flag))
-            statusfolder.deletemessagesflags(uids, set(flag))
-                
     def syncmessagesto(self, dstfolder, statusfolder):
         """Syncs messages in this folder to the destination dstfolder.
 
@@ -511,19 +831,22 @@ class BaseFolder(object):
          deleted there), sync the flag change to both dstfolder and
          statusfolder.
 
+        The message lists are compared once up front, see getsyncplan().
+
         :param dstfolder: Folderinstance to sync the msgs to.
         :param statusfolder: LocalStatus instance to sync against.
         """
         passes = [('copying messages'       , self.syncmessagesto_copy),
                   ('deleting messages'      , self.syncmessagesto_delete),
                   ('syncing flags'          , self.syncmessagesto_flags)]
+        plan = self.getsyncplan(dstfolder, statusfolder)
 
         for (passdesc, action) in passes:
             # bail out on CTRL-C or SIGTERM
             if offlineimap.accounts.Account.abort_NOW_signal.is_set():
                 break
             try:
-                action(dstfolder, statusfolder)
+                action(dstfolder, statusfolder, plan = plan)
             except (KeyboardInterrupt):
                 raise
             except OfflineImapError as e:
@@ -534,6 +857,9 @@ class BaseFolder(object):
                 self.ui.error(e, exc_info()[2], "Syncing folder %s [acc: %s]" %\
                                   (self, self.accountname))
                 raise # raise unknown Exceptions so we can fix them
+            finally:
+                # the status only holds what was done, so keep it all
+                statusfolder.commit()
 
     def __eq__(self, other):
         """Comparisons work either on string comparing folder names or
@@ -40,6 +40,63 @@ class GmailFolder(IMAPFolder):
         self.trash_folder = repository.gettrashfolder(name)
         # Gmail will really delete messages upon EXPUNGE in these folders
         self.real_delete_folders =  [ self.trash_folder, repository.getspamfolder() ]
+        self.deduplicate = repository.getdeduplicate()
+
+    def _getfetchitems(self):
+        items = super(GmailFolder, self)._getfetchitems()
+        if self.deduplicate:
+            # Gmail's unique message id, the same in all labels
+            return items[:-1] + ' X-GM-MSGID)'
+        return items
+
+    def syncmessagesto_copy(self, dstfolder, statusfolder, uidlist=None,
+                            plan=None):
+        """Pass1: Copy messages, linking those stored for other labels
+
+        A message with several labels shows up in several folders. With
+        deduplicate set, the copy of a message that is stored in another
+        local folder already is linked there (see BaseFolder.linkmessage())
+        instead of being downloaded again. Messages already stored are
+        remembered per account, so that folders synced later can link to
+        them. That index is only kept in memory: it is built afresh by
+        each run from the folders synced so far, so whether a copy is
+        linked depends on the order in which the folders are synced."""
+        if not self.deduplicate or not dstfolder.storesmessages() or \
+                self.repository.account.dryrun:
+            return super(GmailFolder, self).syncmessagesto_copy(dstfolder,
+                                                statusfolder, uidlist, plan)
+        copylist = []
+        linked = set()
+        for uid in self.getmessageuidlist() if uidlist is None else uidlist:
+            msg = self.messagelist[uid]
+            if not 'gmmsgid' in msg:
+                continue
+            if dstfolder.uidexists(uid):
+                self.repository.addstoredmessage(msg['gmmsgid'], dstfolder,
+                                                 uid)
+            elif uid > 0 and not statusfolder.uidexists(uid):
+                copylist.append(uid)
+        for uid in copylist:
+            stored = self.repository.getstoredmessage(
+                self.messagelist[uid]['gmmsgid'])
+            if stored is None or stored[0] is dstfolder:
+                continue
+            flags = self.getmessageflags(uid)
+            rtime = self.getmessagetime(uid)
+            new_uid = dstfolder.linkmessage(uid, stored[0], stored[1], flags,
+                                            rtime)
+            if new_uid == uid:
+                # now only needs an update of the status
+                statusfolder.savemessage(uid, None, flags, rtime)
+                linked.add(uid)
+        if plan is not None and linked:
+            plan.copy = [uid for uid in plan.copy if not uid in linked]
+        super(GmailFolder, self).syncmessagesto_copy(dstfolder, statusfolder,
+                                                     uidlist, plan)
+        for uid in copylist:
+            if dstfolder.uidexists(uid):
+                self.repository.addstoredmessage(
+                    self.messagelist[uid]['gmmsgid'], dstfolder, uid)
 
     def savemessage(self, uid, content, flags, rtime):
         new_uid = super(GmailFolder, self).savemessage(uid, content, flags, rtime)
@@ -49,3 +106,15 @@ class GmailFolder(IMAPFolder):
             self.savemessageflags(new_uid, flags)
 
         return new_uid
+
+    def savemessages(self, messages):
+        new_uids = super(GmailFolder, self).savemessages(messages)
+
+        # Gmail does not store the Seen flag when copying a new message to the server
+        if new_uids is not None:
+            for (uid, content, flags, rtime), new_uid in zip(messages,
+                                                             new_uids):
+                if new_uid and 'S' in flags:
+                    self.savemessageflags(new_uid, flags)
+
+        return new_uids
@@ -22,6 +22,7 @@
 # WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 from .Base import BaseFolder
+from offlineimap.messagelist import MessageList
 from email.parser import Parser
 import dateutil.parser
 import email
@@ -154,6 +155,17 @@ class GridFSFolder(BaseFolder):
 
         return uid
 
+    def linkmessage(self, uid, srcfolder, srcuid, flags, rtime):
+        """Store a copy of a message of another GridFS folder
+
+        Each folder owns its files, so the content is copied within the
+        database rather than downloaded again."""
+        if not isinstance(srcfolder, GridFSFolder) or \
+                not srcfolder.uidexists(srcuid):
+            return None
+        return self.savemessage(uid, srcfolder.getmessage(srcuid), flags,
+                                rtime)
+
     def getmessageflags(self, uid):
         return self.messagelist[uid]['flags']
 
@@ -194,13 +206,13 @@ class GridFSFolder(BaseFolder):
 
         Maildir flags are: R (replied) S (seen) T (trashed) D (draft) F
         (flagged).
-        :returns: dict that can be used as self.messagelist"""
+        :returns: MessageList that can be used as self.messagelist"""
         maxage = self.config.getdefaultint("Account " + self.accountname,
                                            "maxage", None)
         maxsize = self.config.getdefaultint("Account " + self.accountname,
                                             "maxsize", None)
 
-        retval = {}
+        retval = MessageList('_id')
 
         moved_uid=-1
         files = self._files.find({'accountname':self.accountname, 'path':self.name, 'type':'M'})
@@ -18,12 +18,17 @@
 import email
 import random
 import binascii
+import os.path
 import re
 import time
+import Queue
+from threading import Event
 from sys import exc_info
 from .Base import BaseFolder
 from offlineimap import imaputil, imaplibutil, OfflineImapError
 from offlineimap.imaplib2 import MonthNames
+from offlineimap.messagelist import MessageList
+from offlineimap.movedetect import getmessageid
 
 
 class IMAPFolder(BaseFolder):
@@ -32,9 +37,21 @@ class IMAPFolder(BaseFolder):
         self.sep = imapserver.delim
         super(IMAPFolder, self).__init__(name, repository)
         self.expunge = repository.getexpunge()
+        self.fetchbatchsize = repository.getfetchbatchsize()
+        self.fetchbatchbytes = repository.getfetchbatchbytes()
+        self.appendbatchsize = repository.getappendbatchsize()
+        self.streamthreshold = repository.getstreamthreshold()
+        self.messagelistchunksize = repository.getmessagelistchunksize()
+        self.maxlinelength = repository.getmaxlinelength()
         self.root = None # imapserver.root
         self.imapserver = imapserver
         self.messagelist = None
+        # STATUS as fetched by IMAPRepository.prepare_quickchanged()
+        self.quickstatus = None
+        # The same items as seen when SELECTing in cachemessagelist()
+        self._selectstatus = None
+        # _selectstatus of the last sync, set by prepare_resync()
+        self._keptstatus = None
         self.randomgenerator = random.Random()
         #self.ui is set in BaseFolder
 
@@ -55,9 +72,6 @@ class IMAPFolder(BaseFolder):
     def suggeststhreads(self):
         return 1
 
-    def waitforthread(self):
-        self.imapserver.connectionwait()
-
     def getcopyinstancelimit(self):
         return 'MSGCOPY_' + self.repository.getname()
 
@@ -69,7 +83,7 @@ class IMAPFolder(BaseFolder):
         if hasattr(self, '_uidvalidity'):
             # use cached value if existing
             return self._uidvalidity
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(self.getfullname())
         try:
             # SELECT (if not already done) and get current UIDVALIDITY
             self.selectro(imapobj)
@@ -82,6 +96,8 @@ class IMAPFolder(BaseFolder):
             self.imapserver.releaseconnection(imapobj)
 
     def quickchanged(self, statusfolder):
+        if self.quickstatus is not None:
+            return self._quickstatuschanged(statusfolder)
         # An IMAP folder has definitely changed if the number of
         # messages or the UID of the last message have changed.  Otherwise
         # only flag changes could have occurred.
@@ -118,21 +134,117 @@ class IMAPFolder(BaseFolder):
             return True      
         return False
 
+    def _quickstatuschanged(self, statusfolder):
+        """Compare the prefetched STATUS with the one of the last sync
+
+        New or expunged messages change MESSAGES or UIDNEXT, flag changes
+        HIGHESTMODSEQ, which is only compared if known both times."""
+        if self.quickstatus.get('MESSAGES') != statusfolder.getmessagecount():
+            return True
+        saved = self._loadquickstatus()
+        if saved is None:
+            return True
+        for item in ('MESSAGES', 'UIDNEXT', 'UIDVALIDITY'):
+            if not item in saved or saved[item] != self.quickstatus.get(item):
+                return True
+        if 'HIGHESTMODSEQ' in saved and 'HIGHESTMODSEQ' in self.quickstatus:
+            return saved['HIGHESTMODSEQ'] != self.quickstatus['HIGHESTMODSEQ']
+        return False
+
+    def _getquickstatusfilename(self):
+        return os.path.join(self.repository.getstatusdir(),
+                            self.getfolderbasename())
+
+    def _loadquickstatus(self):
+        """:returns: The status saved by save_quickstatus() or None"""
+        filename = self._getquickstatusfilename()
+        if not os.path.exists(filename):
+            return None
+        with open(filename, 'rt') as file:
+            items = imaputil.options2hash(file.readline().split())
+        return dict((key, long(value)) for key, value in items.items())
+
+    def save_quickstatus(self):
+        """Save the folder state seen at the start of the sync
+
+        Anything that changed in the folder since then, including our
+        own changes, makes quickchanged() report it next time."""
+        if self._selectstatus is None:
+            return
+        filename = self._getquickstatusfilename()
+        with open(filename + '.tmp', 'wt') as file:
+            file.write(' '.join('%s %d' % item for item in
+                                sorted(self._selectstatus.items())) + '\n')
+        os.rename(filename + '.tmp', filename)
+
+    def prepare_resync(self):
+        """Keep the message list to be updated with CHANGEDSINCE
+
+        cachemessagelist() only fetches what changed since the SELECT of
+        the last sync if the server keeps mod-sequences for the folder,
+        and fetches the whole message list otherwise."""
+        if hasattr(self, '_uidvalidity'):
+            del self._uidvalidity
+        self._keptstatus = self._selectstatus
+
+    def _getselectstatus(self, imapobj, imapdata):
+        """STATUS items of the just selected folder from its SELECT reply"""
+        status = {'MESSAGES': 0}
+        if imapdata != [None]:
+            status['MESSAGES'] = max([long(msgnum) for msgnum in imapdata])
+        for item in ('UIDNEXT', 'UIDVALIDITY', 'HIGHESTMODSEQ'):
+            value = imapobj._get_untagged_response(item, True)
+            if value and value[-1] is not None:
+                status[item] = long(value[-1])
+        if not 'UIDNEXT' in status or not 'UIDVALIDITY' in status:
+            return None # not comparable with STATUS
+        return status
+
     def cachemessagelist(self):
         maxage = self.config.getdefaultint("Account %s" % self.accountname,
                                            "maxage", -1)
         maxsize = self.config.getdefaultint("Account %s" % self.accountname,
                                             "maxsize", -1)
-        self.messagelist = {}
+        keptlist, self.messagelist = self.messagelist, self._newmessagelist()
+        keptstatus, self._keptstatus = self._keptstatus, None
 
         imapobj = self.imapserver.acquireconnection()
         try:
             res_type, imapdata = imapobj.select(self.getfullname(), True, True)
+            self._selectstatus = self._getselectstatus(imapobj, imapdata)
+            # An incremental update needs an unrestricted message list
+            highestmodseq = None
+            if self.repository.getcondstore() and maxage == -1 and \
+                    maxsize == -1:
+                highestmodseq = self._gethighestmodseq(imapobj)
+            if highestmodseq is not None:
+                uidvalidity = imapobj._get_untagged_response('UIDVALIDITY',
+                                                             True)
+                if uidvalidity:
+                    uidvalidity = long(uidvalidity[-1])
+                else:
+                    highestmodseq = None
+            kept = None
+            if highestmodseq is not None and keptlist is not None and \
+                    keptstatus is not None and \
+                    keptstatus['UIDVALIDITY'] == uidvalidity and \
+                    'HIGHESTMODSEQ' in keptstatus:
+                kept = (keptlist, keptstatus['HIGHESTMODSEQ'])
             if imapdata == [None] or imapdata[0] == '0':
                 # Empty folder, no need to populate message list
+                if highestmodseq is not None:
+                    self._savemessagelistcache(uidvalidity, highestmodseq)
                 return
-            # By default examine all UIDs in this folder
-            msgsToFetch = '1:*'
+            exists = max([long(msgnum) for msgnum in imapdata])
+            if highestmodseq is not None:
+                if self._cachemessagelist_changedsince(imapobj, uidvalidity,
+                                                       highestmodseq, exists,
+                                                       kept):
+                    return
+                self.messagelist = self._newmessagelist()
+
+            # By default examine all messages in this folder
+            msgnums = None
 
             if (maxage != -1) | (maxsize != -1):
                 search_cond = "(";
@@ -164,31 +276,76 @@ class IMAPFolder(BaseFolder):
                             search_cond, res_type, res_data),
                         OfflineImapError.ERROR.FOLDER)
 
-                # Result UIDs are seperated by space, coalesce into ranges
-                msgsToFetch = imaputil.uid_sequence(res_data[0].split())
-                if not msgsToFetch:
+                # Result message numbers are seperated by space
+                msgnums = res_data[0].split()
+                if not msgnums:
                     return # No messages to sync
 
-            # Get the flags and UIDs for these. single-quotes prevent
-            # imaplib2 from quoting the sequence.
-            res_type, response = imapobj.fetch("'%s'" % msgsToFetch,
-                                               '(FLAGS UID)')
-            if res_type != 'OK':
-                raise OfflineImapError("FETCHING UIDs in folder [%s]%s failed. "
-                                       "Server responded '[%s] %s'" % (
-                            self.getrepository(), self,
-                            res_type, response),
-                        OfflineImapError.ERROR.FOLDER)
+            for msgsToFetch in self._getmessagelistchunks(exists, msgnums):
+                # Get the flags and UIDs for these. single-quotes prevent
+                # imaplib2 from quoting the sequence.
+                res_type, response = imapobj.fetch("'%s'" % msgsToFetch,
+                                                   self._getfetchitems())
+                if res_type != 'OK':
+                    raise OfflineImapError("FETCHING UIDs in folder [%s]%s "
+                                           "failed. Server responded '[%s] %s'"
+                                           % (self.getrepository(), self,
+                                              res_type, response),
+                                           OfflineImapError.ERROR.FOLDER)
+                self._parsemessagelist(response)
+                del response
         finally:
             self.imapserver.releaseconnection(imapobj)
 
+        if highestmodseq is not None:
+            self._savemessagelistcache(uidvalidity, highestmodseq)
+
+    def _getmessagelistchunks(self, exists, msgnums):
+        """Split the message list FETCH into windows of message numbers
+
+        Each window holds at most messagelistchunksize messages, so that
+        only that many responses are buffered at a time. Message numbers
+        are stable for the whole listing, as a server must not send
+        EXPUNGE responses during a FETCH (RFC 3501, 7.4.1) and we send no
+        other commands in between.
+
+        :param exists: number of messages in the folder
+        :param msgnums: message numbers to list, None for all
+        :returns: list of sequence sets"""
+        size = self.messagelistchunksize
+        if msgnums is None:
+            if size <= 0 or exists <= size:
+                return ['1:*']
+            chunks = ['%d:%d' % (start, start + size - 1)
+                      for start in xrange(1, exists + 1, size)]
+            # include messages that arrived since SELECT
+            chunks[-1] = chunks[-1].split(':')[0] + ':*'
+            return chunks
+        if size <= 0:
+            return [imaputil.uid_sequence(msgnums)]
+        return [imaputil.uid_sequence(msgnums[start:start + size])
+                for start in xrange(0, len(msgnums), size)]
+
+    def _getfetchitems(self):
+        """Message attributes to FETCH for the message list"""
+        # Message sizes are only needed to bound batched message retrieval
+        # and to decide which messages to stream.
+        if self.fetchbatchsize > 1 or self.streamthreshold > 0:
+            return '(FLAGS UID RFC822.SIZE)'
+        return '(FLAGS UID)'
+
+    def _parsemessagelist(self, response):
+        """Add the messages of a FETCH response to self.messagelist
+
+        :returns: the UIDs of the messages added or updated"""
+        uids = []
         for messagestr in response:
             # looks like: '1 (FLAGS (\\Seen Old) UID 4807)' or None if no msg
             # Discard initial message number.
             if messagestr == None:
                 continue
             messagestr = messagestr.split(' ', 1)[1]
-            options = imaputil.flags2hash(messagestr)
+            options = imaputil.fetch2hash(messagestr)
             if not 'UID' in options:
                 self.ui.warn('No UID in message with options %s' %\
                                           str(options),
@@ -196,8 +353,170 @@ class IMAPFolder(BaseFolder):
             else:
                 uid = long(options['UID'])
                 flags = imaputil.flagsimap2maildir(options['FLAGS'])
-                rtime = imaplibutil.Internaldate2epoch(messagestr)
-                self.messagelist[uid] = {'uid': uid, 'flags': flags, 'time': rtime}
+                rtime = None
+                if 'INTERNALDATE' in options:
+                    rtime = imaplibutil.Internaldate2epoch(
+                        'INTERNALDATE ' + options['INTERNALDATE'])
+                message = {'uid': uid, 'flags': flags, 'time': rtime}
+                if 'RFC822.SIZE' in options:
+                    message['size'] = long(options['RFC822.SIZE'])
+                if 'X-GM-MSGID' in options:
+                    # fetched by GmailFolder
+                    message['gmmsgid'] = long(options['X-GM-MSGID'])
+                self.messagelist[uid] = message
+                uids.append(uid)
+        return uids
+
+    def updatemessagelist(self, responses):
+        """Update the message list with FETCH responses the server pushed
+
+        The responses look like those of the message list FETCH, e.g.
+        '12 (FLAGS (\\Seen) UID 4807)', see _parsemessagelist().
+
+        :returns: the UIDs of the messages added or updated"""
+        return self._parsemessagelist(responses)
+
+    def _gethighestmodseq(self, imapobj):
+        """Return the HIGHESTMODSEQ of the just selected folder
+
+        :returns: HIGHESTMODSEQ as (long) number or None if the server
+            does not keep mod-sequences for this folder."""
+        if not 'CONDSTORE' in imapobj.enabled:
+            return None
+        modseq = imapobj._get_untagged_response('HIGHESTMODSEQ', True)
+        if not modseq or modseq[-1] is None:
+            return None # e.g. NOMODSEQ
+        return long(modseq[-1])
+
+    def _getmessagelistcachefilename(self):
+        return os.path.join(self.repository.getcachedir(),
+                            self.getfolderbasename())
+
+    def _loadmessagelistcache(self, uidvalidity):
+        """Load the message list saved by _savemessagelistcache()
+
+        The internal dates of the messages are not saved, their 'time'
+        is None just like for messages listed by FETCH, which does not
+        ask for INTERNALDATE either, see _getfetchitems(). The folders
+        messages are copied to fall back on their Date: header.
+
+        :returns: the message list or None if there is none or it was
+            saved for another UIDVALIDITY."""
+        filename = self._getmessagelistcachefilename()
+        if not os.path.exists(filename):
+            return None
+        messagelist = self._newmessagelist()
+        with open(filename, 'rt') as file:
+            if file.readline().strip() != str(uidvalidity):
+                return None
+            for line in file:
+                try:
+                    fields = line.strip().split(':')
+                    uid = long(fields[0])
+                    message = {'uid': uid, 'flags': set(fields[1]),
+                               'time': None}
+                    if len(fields) > 2 and fields[2]:
+                        message['size'] = long(fields[2])
+                    if len(fields) > 3:
+                        message['gmmsgid'] = long(fields[3])
+                    messagelist[uid] = message
+                except (ValueError, IndexError):
+                    self.ui.warn("Corrupt line '%s' in message list cache %s, "
+                                 "refetching message list" % (line, filename))
+                    return None
+        return messagelist
+
+    def _savemessagelistcache(self, uidvalidity, highestmodseq):
+        """Persist the message list along with its HIGHESTMODSEQ
+
+        The list is written before the HIGHESTMODSEQ, so that a crash in
+        between makes us fetch too many changes next time, not too few."""
+        if uidvalidity != self.get_saveduidvalidity():
+            return
+        filename = self._getmessagelistcachefilename()
+        with open(filename + '.tmp', 'wt') as file:
+            file.write('%d\n' % uidvalidity)
+            for uid, msg in self.messagelist.iteritems():
+                flags = ''.join(sorted(msg['flags']))
+                if 'gmmsgid' in msg:
+                    file.write('%d:%s:%s:%d\n' % (uid, flags,
+                                                  msg.get('size', ''),
+                                                  msg['gmmsgid']))
+                elif 'size' in msg:
+                    file.write('%d:%s:%d\n' % (uid, flags, msg['size']))
+                else:
+                    file.write('%d:%s\n' % (uid, flags))
+        os.rename(filename + '.tmp', filename)
+        self.save_highestmodseq(highestmodseq)
+
+    def _cachemessagelist_changedsince(self, imapobj, uidvalidity,
+                                       highestmodseq, exists, kept=None):
+        """Bring the message list of the last sync up to date (RFC 7162)
+
+        Only messages whose mod-sequence is higher than the saved
+        HIGHESTMODSEQ are fetched, i.e. new messages and flag changes.
+        Expunged messages are reported as VANISHED with QRESYNC;
+        without it, we detect them by comparing the message count and
+        weed them out with a UID SEARCH. The updated list is saved for
+        the next run.
+
+        :param kept: (message list, HIGHESTMODSEQ) kept in memory from
+            the last sync, used instead of the ones saved on disk
+        :returns: True if self.messagelist is up to date, False if the
+            full message list needs to be fetched."""
+        if kept is not None:
+            messagelist, savedmodseq = kept
+        else:
+            savedmodseq = self.get_savedhighestmodseq()
+            messagelist = None
+        if savedmodseq is None or savedmodseq > highestmodseq:
+            return False
+        if messagelist is None:
+            messagelist = self._loadmessagelistcache(uidvalidity)
+            if messagelist is None:
+                return False
+        self.messagelist = messagelist
+        changed = savedmodseq < highestmodseq
+
+        if changed:
+            qresync = 'QRESYNC' in imapobj.enabled
+            modifier = '(CHANGEDSINCE %d%s)' % (savedmodseq,
+                                                ' VANISHED' if qresync else '')
+            res_type, response = imapobj.uid('fetch', "'1:*'",
+                                             self._getfetchitems(), modifier)
+            if res_type != 'OK':
+                raise OfflineImapError("FETCHING changes in folder [%s]%s "
+                                       "failed. Server responded '[%s] %s'" % (
+                        self.getrepository(), self, res_type, response),
+                                       OfflineImapError.ERROR.FOLDER)
+            if qresync:
+                # looks like: '(EARLIER) 300:310,405,411'
+                for vanished in imapobj.response('VANISHED')[1]:
+                    if vanished is None:
+                        continue
+                    for uid in imaputil.uid_sequence_expand(
+                            vanished.split()[-1]):
+                        self.messagelist.pop(uid, None)
+            self._parsemessagelist(response)
+
+        if len(self.messagelist) != exists:
+            # Expunges we were not told about
+            res_type, response = imapobj.uid('search', 'ALL')
+            if res_type != 'OK' or response == [None]:
+                return False
+            uids = set([long(uid) for uid in response[0].split()])
+            for uid in self.messagelist.keys():
+                if not uid in uids:
+                    del self.messagelist[uid]
+            if len(self.messagelist) != exists:
+                return False
+            changed = True
+        if changed:
+            self._savemessagelistcache(uidvalidity, highestmodseq)
+        return True
+
+    def _newmessagelist(self):
+        return MessageList('time', 'size', 'gmmsgid')
 
     def getmessagelist(self):
         return self.messagelist
@@ -209,7 +528,8 @@ class IMAPFolder(BaseFolder):
                   (probably severity MESSAGE) if e.g. no message with
                   this UID could be found.
         """
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(self.getfullname(),
+                                                    readonly = True)
         try:
             fails_left = 2 # retry on dropped connection
             while fails_left:
@@ -221,7 +541,8 @@ class IMAPFolder(BaseFolder):
                 except imapobj.abort as e:
                     # Release dropped connection, and get a new one
                     self.imapserver.releaseconnection(imapobj, True)
-                    imapobj = self.imapserver.acquireconnection()
+                    imapobj = self.imapserver.acquireconnection(
+                        self.getfullname(), readonly = True)
                     self.ui.error(e, exc_info()[2])
                     fails_left -= 1
                     if not fails_left:
@@ -253,6 +574,245 @@ class IMAPFolder(BaseFolder):
             self.imapserver.releaseconnection(imapobj)
         return data
 
+    def getmessage_stream(self, uid, file):
+        """Retrieve message with UID from the IMAP server into file
+
+        Like getmessage(), but the message body is written to file as
+        it is received, with line endings converted on the way, rather
+        than being held in memory. As part of it may have been written
+        already, we do not retry on dropped connections."""
+        imapobj = self.imapserver.acquireconnection(self.getfullname(),
+                                                    readonly = True)
+        try:
+            imapobj.select(self.getfullname(), readonly = True)
+            converter = imaplibutil.CRLFConverter(file)
+            imapobj.literal_sink = converter
+            try:
+                res_type, data = imapobj.uid('fetch', str(uid),
+                                             '(BODY.PEEK[])')
+            finally:
+                imapobj.literal_sink = None
+            converter.flush()
+        except imapobj.abort as e:
+            self.imapserver.releaseconnection(imapobj, True)
+            raise OfflineImapError("Connection to IMAP server '%s' dropped "
+                "while streaming message UID '%s': %s" % (self.getrepository(),
+                uid, e), OfflineImapError.ERROR.MESSAGE)
+        except:
+            self.imapserver.releaseconnection(imapobj)
+            raise
+        self.imapserver.releaseconnection(imapobj)
+        if data == [None] or res_type != 'OK':
+            raise OfflineImapError("IMAP server '%s' failed to fetch message "
+                "UID '%s'. Server responded: %s %s" % (self.getrepository(),
+                uid, res_type, data), OfflineImapError.ERROR.MESSAGE)
+        self.ui.debug('imap', "Streamed message UID %d" % uid)
+
+    def streamsmessage(self, uid):
+        """Messages larger than streamthreshold are streamed"""
+        size = self.getmessagesize(uid)
+        return self.streamthreshold > 0 and size is not None and \
+            size > self.streamthreshold
+
+    def getmessages(self, uidlist):
+        """Retrieve several messages from the IMAP server with one UID FETCH
+
+        The UIDs are coalesced into a sequence set, so that a single
+        round trip returns all bodies of the batch. The FETCH responses
+        are handed over from the imaplib2 reader thread through a small
+        queue, so each message is yielded as soon as it has been read
+        and only a few of them are held in memory at a time. Unlike
+        getmessage() we do not retry on dropped connections; UIDs that
+        were not returned are simply not yielded and the caller falls
+        back to fetching them one by one.
+
+        :returns: generator of (uid, message body) tuples"""
+        imapobj = self.imapserver.acquireconnection(self.getfullname(),
+                                                    readonly = True)
+        # Bounded, so that the reader thread waits for us to catch up
+        responses = Queue.Queue(16)
+        abandoned = Event()
+
+        def put(item):
+            # Runs in the reader thread, which must not wait for a
+            # consumer that has gone away
+            while not abandoned.is_set():
+                try:
+                    responses.put(item, True, 1)
+                    return
+                except Queue.Full:
+                    pass
+
+        drop = True
+        try:
+            try:
+                imapobj.select(self.getfullname(), readonly = True)
+                imapobj.fetch_sink = lambda dat: put(('FETCH', dat))
+                imapobj.uid('fetch', "'%s'" % imaputil.uid_sequence(uidlist),
+                            '(UID BODY.PEEK[])',
+                            callback = lambda args: put(('DONE', args)))
+                message = None
+                while True:
+                    kind, dat = responses.get()
+                    # A message is complete once the next one starts
+                    if kind == 'DONE' or isinstance(dat, tuple):
+                        if message is not None:
+                            uid = self._getfetchuid(message[0])
+                            if uid is not None:
+                                yield uid, message[1].replace("\r\n", "\n")
+                        if kind == 'DONE':
+                            break
+                        message = list(dat)
+                    elif dat and message is not None:
+                        message[0] += dat
+                response, cb_arg, error = dat
+                if error is not None:
+                    raise error[0](error[1])
+            except imapobj.abort as e:
+                # Drop the connection, let the caller retry per message
+                self.ui.error(e, exc_info()[2])
+                return
+            drop = False
+        finally:
+            imapobj.fetch_sink = None
+            abandoned.set()
+            self.imapserver.releaseconnection(imapobj, drop)
+        if response[0] != 'OK':
+            raise OfflineImapError("IMAP server '%s' failed to fetch messages "
+                                   "%s. Server responded: %s %s" % (
+                    self.getrepository(), imaputil.uid_sequence(uidlist),
+                    response[0], response[1]), OfflineImapError.ERROR.MESSAGE)
+
+    def _getfetchuid(self, header):
+        """:returns: the UID in the FETCH response header, or None"""
+        match = re.search('UID (\d+)', header)
+        if match is None:
+            self.ui.warn("Can't parse FETCH response, can't find UID: %s"
+                         % header)
+            return None
+        return long(match.group(1))
+
+    def _gluefetchliterals(self, data):
+        """Pair up the FETCH data items of messages with their literal
+
+        data looks e.g. like [('1 (UID 17 BODY[] {2565}', 'msgbody...'),
+        ')', ('2 (BODY[] {42}', 'msgbody...'), ' UID 18)'], i.e. the UID
+        may come before or after the literal. Glue the trailing strings
+        to the header of the literal they belong to.
+
+        :returns: list of [header, literal] lists"""
+        messages = []
+        for item in data:
+            if isinstance(item, tuple):
+                messages.append([item[0], item[1]])
+            elif item and messages:
+                messages[-1][0] += item
+        return messages
+
+    def getmessagekeys(self, uidlist):
+        """Message-ID and size of messages, see folder/Base for details
+
+        Only the Message-ID header field and RFC822.SIZE are fetched. As
+        moves are detected on a best effort basis, failures are only
+        logged."""
+        keys = {}
+        if not len(uidlist):
+            return keys
+        imapobj = self.imapserver.acquireconnection(self.getfullname(),
+                                                    readonly = True)
+        data = []
+        try:
+            try:
+                imapobj.select(self.getfullname(), readonly = True)
+                for uidset in imaputil.uid_sequence_chunks(uidlist,
+                        self.maxlinelength - 100):
+                    res_type, res_data = imapobj.uid('fetch', "'%s'" % uidset,
+                        '(UID RFC822.SIZE BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])')
+                    if res_type != 'OK':
+                        self.ui.debug('imap', "getmessagekeys: FETCH of %s "
+                            "failed: %s %s" % (uidset, res_type, res_data))
+                        continue
+                    data.extend(res_data)
+            except imapobj.abort as e:
+                self.imapserver.releaseconnection(imapobj, True)
+                imapobj = None
+                self.ui.error(e, exc_info()[2])
+        finally:
+            if imapobj:
+                self.imapserver.releaseconnection(imapobj)
+        for header, headerfields in self._gluefetchliterals(data):
+            uid = re.search('UID (\d+)', header)
+            size = re.search('RFC822\.SIZE (\d+)', header)
+            messageid = getmessageid(headerfields)
+            if uid and size and messageid:
+                keys[long(uid.group(1))] = (messageid, long(size.group(1)))
+        return keys
+
+    def stashmessages(self, uidlist):
+        """Messages are kept on the server until dropstashedmessages()"""
+        return dict((uid, uid) for uid in uidlist if self.uidexists(uid))
+
+    def savemessage_moved(self, uid, srcfolder, handle, flags, rtime):
+        """Move a message stashed by another folder on the same server
+
+        The message is moved with UID MOVE (RFC 6851) if the server
+        supports it, or else copied with UID COPY. The copied original
+        is deleted by srcfolder.dropstashedmessages(). The new UID is
+        taken from the COPYUID response (RFC 4315). See folder/Base for
+        details.
+
+        The message list of srcfolder is left alone, as another thread
+        may be syncing srcfolder. A moved message stays in it until
+        dropstashedmessages() is called."""
+        if not isinstance(srcfolder, IMAPFolder) or \
+                srcfolder.imapserver is not self.imapserver or \
+                not srcfolder.uidexists(handle):
+            return None
+        self.ui.savemessage('imap', uid, flags, self)
+        oldflags = srcfolder.getmessageflags(handle)
+        imapobj = self.imapserver.acquireconnection(srcfolder.getfullname())
+        try:
+            try:
+                imapobj.select(srcfolder.getfullname())
+            except imapobj.readonly:
+                return None
+            command = 'MOVE' if 'MOVE' in imapobj.capabilities else 'COPY'
+            res_type, data = imapobj.uid(command, str(handle),
+                                         self.getfullname())
+            if res_type != 'OK':
+                raise OfflineImapError("UID %s of message %s from folder '%s' "
+                    "to '%s' failed. Server responded: %s %s" % (command,
+                    handle, srcfolder, self, res_type, data),
+                    OfflineImapError.ERROR.MESSAGE)
+            # e.g. [COPYUID 38505 304 3956], 3956 being the new UID
+            resp = imapobj._get_untagged_response('COPYUID')
+        finally:
+            self.imapserver.releaseconnection(imapobj)
+        new_uid = 0
+        if resp and resp[-1]:
+            new_uid = long(resp[-1].split(' ')[2])
+        if new_uid:
+            self.messagelist[new_uid] = {'uid': new_uid, 'flags': oldflags,
+                                         'time': rtime}
+            if flags != oldflags:
+                self.savemessageflags(new_uid, flags)
+        return new_uid
+
+    def dropstashedmessages(self, handles):
+        """Delete the stashed messages, see MoveDetector.finish()
+
+        A message moved with UID MOVE is gone from the folder already.
+        Flagging its UID for deletion is no error, see RFC 3501 6.4.8,
+        and a single STORE for all handles is cheaper than tracking
+        which messages were moved."""
+        self.deletemessages(handles)
+
+    def getmessagesize(self, uid):
+        return self.messagelist[uid].get('size')
+
+    def getfetchbatchlimits(self):
+        return (self.fetchbatchsize, self.fetchbatchbytes)
+
     def getmessagetime(self, uid):
         return self.messagelist[uid]['time']
 
@@ -508,7 +1068,7 @@ class IMAPFolder(BaseFolder):
             return uid
 
         retry_left = 2 # succeeded in APPENDING?
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(self.getfullname())
         try:
             while retry_left:
                 # UIDPLUS extension provides us with an APPENDUID response.
@@ -552,7 +1112,7 @@ class IMAPFolder(BaseFolder):
                     # connection has been reset, release connection and retry.
                     retry_left -= 1
                     self.imapserver.releaseconnection(imapobj, True)
-                    imapobj = self.imapserver.acquireconnection()
+                    imapobj = self.imapserver.acquireconnection(self.getfullname())
                     if not retry_left:
                         raise OfflineImapError("Saving msg in folder '%s', "
                               "repository '%s' failed (abort). Server reponded: %s\n"
@@ -616,13 +1176,82 @@ class IMAPFolder(BaseFolder):
         self.ui.debug('imap', 'savemessage: returning new UID %d' % uid)
         return uid
 
+    def getsavebatchlimits(self):
+        return (self.appendbatchsize, self.fetchbatchbytes)
+
+    def savemessages(self, messages):
+        """Save several messages on the server with a single APPEND
+
+        This needs MULTIAPPEND (RFC 3502) to send them in one go, and
+        UIDPLUS to learn their UIDs from the APPENDUID response. If
+        either is missing, or the server refuses the APPEND, nothing has
+        been saved and the caller falls back to savemessage().
+
+        See folder/Base for details. Note that savemessages() does not
+        check against dryrun settings, so you need to ensure that
+        savemessages is never called in a dryrun mode.
+
+        :returns: the list of new UIDs, 0 for messages whose UID could
+                  not be found, or None if no message was saved."""
+        imapobj = self.imapserver.acquireconnection(self.getfullname())
+        try:
+            if not 'MULTIAPPEND' in imapobj.capabilities or \
+                    not 'UIDPLUS' in imapobj.capabilities:
+                return None
+            try:
+                # Select folder for append and make the box READ-WRITE
+                imapobj.select(self.getfullname())
+            except imapobj.readonly:
+                return None # savemessage() reports it for each message
+            appends = []
+            for uid, content, flags, rtime in messages:
+                self.ui.savemessage('imap', uid, flags, self)
+                appends.append((imaputil.flagsmaildir2imap(flags),
+                                self.getmessageinternaldate(content, rtime),
+                                content))
+            try:
+                typ, dat = imapobj.multiappend(self.getfullname(), appends)
+            except imapobj.abort as e:
+                # connection has been reset, drop it and let savemessage()
+                # retry.
+                self.imapserver.releaseconnection(imapobj, True)
+                imapobj = None
+                self.ui.error(e, exc_info()[2])
+                return None
+            except imapobj.error as e:
+                self.ui.debug('imap', "savemessages: MULTIAPPEND of %d "
+                    "messages failed: %s" % (len(messages), e))
+                return None
+            if typ != 'OK':
+                self.ui.debug('imap', "savemessages: MULTIAPPEND of %d "
+                    "messages failed: %s %s" % (len(messages), typ, dat))
+                return None
+            # OK [APPENDUID 38505 3955:3964] with 38505 being the folder
+            # UIDVALIDITY and the new UIDs in the order of the messages.
+            resp = imapobj._get_untagged_response('APPENDUID')
+        finally:
+            self.imapserver.releaseconnection(imapobj)
+
+        uids = []
+        if resp and resp != [None]:
+            uids = imaputil.uid_sequence_expand(resp[-1].split(' ')[1])
+        if len(uids) != len(messages):
+            self.ui.warn("savemessages: Got no usable APPENDUID response "
+                         "saving %d messages: %s" % (len(messages), resp))
+            return [0] * len(messages)
+        for (uid, content, flags, rtime), new_uid in zip(messages, uids):
+            self.messagelist[new_uid] = {'uid': new_uid, 'flags': flags}
+        self.ui.debug('imap', 'savemessages: returning new UIDs %s' %
+                      imaputil.uid_sequence(uids))
+        return uids
+
     def savemessageflags(self, uid, flags):
         """Change a message's flags to `flags`.
 
         Note that this function does not check against dryrun settings,
         so you need to ensure that it is never called in a
         dryrun mode."""
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(self.getfullname())
         try:
             try:
                 imapobj.select(self.getfullname())
@@ -638,7 +1267,7 @@ class IMAPFolder(BaseFolder):
         if not result:
             self.messagelist[uid]['flags'] = flags
         else:
-            flags = imaputil.flags2hash(imaputil.imapsplit(result)[1])['FLAGS']
+            flags = imaputil.fetch2hash(result.split(' ', 1)[1])['FLAGS']
             self.messagelist[uid]['flags'] = imaputil.flagsimap2maildir(flags)
 
     def addmessageflags(self, uid, flags):
@@ -660,52 +1289,96 @@ class IMAPFolder(BaseFolder):
         self.processmessagesflags('-', uidlist, flags)
 
     def processmessagesflags(self, operation, uidlist, flags):
-        if len(uidlist) > 101:
-            # Hack for those IMAP ervers with a limited line length
-            self.processmessagesflags(operation, uidlist[:100], flags)
-            self.processmessagesflags(operation, uidlist[100:], flags)
+        if operation == '+':
+            change = (flags, set())
+        else:
+            change = (set(), flags)
+        self.applyflagchanges(dict((uid, change) for uid in uidlist))
+
+    def _getflagstoreplan(self, changes):
+        """Plan the STORE commands to apply flag changes with
+
+        Messages are grouped either by the complete set of flags added or
+        removed, or by single flag, whichever needs fewer commands once
+        the UID sets are split to fit into maxlinelength.
+        :returns: List of (operation, flags, imapflags, uidset) tuples"""
+        plan = None
+        for perflag in (False, True):
+            commands = []
+            for operation, flags, uids in \
+                    imaputil.flagchanges2groups(changes, perflag):
+                imapflags = imaputil.flagsmaildir2imap(flags)
+                # leave room for 'TAG UID STORE <set> +FLAGS <flags>\r\n'
+                maxlen = self.maxlinelength - len(imapflags) - 40
+                for uidset in imaputil.uid_sequence_chunks(uids, maxlen):
+                    commands.append((operation, flags, imapflags, uidset))
+            if plan is None or len(commands) < len(plan):
+                plan = commands
+        return plan
+
+    def applyflagchanges(self, changes):
+        """Apply flag changes with as few STORE commands as possible
+
+        The STORE commands are pipelined on a single connection."""
+        plan = self._getflagstoreplan(changes)
+        if not plan:
             return
-
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(self.getfullname())
+        drop = False
         try:
             try:
                 imapobj.select(self.getfullname())
             except imapobj.readonly:
-                self.ui.flagstoreadonly(self, uidlist, flags)
+                for operation, flags, imapflags, uidset in plan:
+                    self.ui.flagstoreadonly(self,
+                        imaputil.uid_sequence_expand(uidset), flags)
                 return
-            r = imapobj.uid('store',
-                            imaputil.uid_sequence(uidlist),
-                            operation + 'FLAGS',
-                            imaputil.flagsmaildir2imap(flags))
-            assert r[0] == 'OK', 'Error with store: ' + '. '.join(r[1])
-            r = r[1]
+            results = imapobj.pipeline(
+                [('uid', ('store', uidset, operation + 'FLAGS', imapflags))
+                 for operation, flags, imapflags, uidset in plan])
+            # aborted commands leave the connection unusable
+            drop = None in [typ for typ, dat in results]
         finally:
-            self.imapserver.releaseconnection(imapobj)
+            self.imapserver.releaseconnection(imapobj, drop)
         # Some IMAP servers do not always return a result.  Therefore,
         # only update the ones that it talks about, and manually fix
         # the others.
-        needupdate = list(uidlist)
-        for result in r:
-            if result == None:
-                # Compensate for servers that don't return anything from
-                # STORE.
+        reported = {}
+        for typ, dat in results:
+            if typ != 'OK':
                 continue
-            attributehash = imaputil.flags2hash(imaputil.imapsplit(result)[1])
-            if not ('UID' in attributehash and 'FLAGS' in attributehash):
-                # Compensate for servers that don't return a UID attribute.
+            for result in dat:
+                if result == None:
+                    # Compensate for servers that don't return anything
+                    # from STORE.
+                    continue
+                attributehash = imaputil.fetch2hash(result.split(' ', 1)[1])
+                if not ('UID' in attributehash and 'FLAGS' in attributehash):
+                    # Compensate for servers that don't return a UID
+                    # attribute.
+                    continue
+                reported[long(attributehash['UID'])] = \
+                    imaputil.flagsimap2maildir(attributehash['FLAGS'])
+        failed = []
+        for (operation, flags, imapflags, uidset), (typ, dat) in \
+                zip(plan, results):
+            if typ != 'OK':
+                failed.append("%s (%s)" % (uidset, '. '.join(map(str, dat))))
                 continue
-            flagstr = attributehash['FLAGS']
-            uid = long(attributehash['UID'])
-            self.messagelist[uid]['flags'] = imaputil.flagsimap2maildir(flagstr)
-            try:
-                needupdate.remove(uid)
-            except ValueError:          # Let it slide if it's not in the list
-                pass
-        for uid in needupdate:
-            if operation == '+':
-                self.messagelist[uid]['flags'] |= flags
-            elif operation == '-':
-                self.messagelist[uid]['flags'] -= flags
+            for uid in imaputil.uid_sequence_expand(uidset):
+                if uid in reported or not uid in self.messagelist:
+                    continue
+                if operation == '+':
+                    self.messagelist[uid]['flags'] |= flags
+                else:
+                    self.messagelist[uid]['flags'] -= flags
+        for uid, flags in reported.items():
+            if uid in self.messagelist:
+                self.messagelist[uid]['flags'] = flags
+        if failed:
+            raise OfflineImapError("Storing flags in folder '%s' failed for "
+                "UIDs %s" % (self.getvisiblename(), ', '.join(failed)),
+                OfflineImapError.ERROR.FOLDER)
 
     def change_message_uid(self, uid, new_uid):
         """Change the message from existing uid to new_uid
@@ -728,7 +1401,7 @@ class IMAPFolder(BaseFolder):
             return
 
         self.addmessagesflags_noconvert(uidlist, set('T'))
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(self.getfullname())
         try:
             try:
                 imapobj.select(self.getfullname())
@@ -16,10 +16,15 @@
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
 from .Base import BaseFolder
+from offlineimap.messagelist import MessageList
 import os
 import threading
 
 magicline = "OFFLINEIMAP LocalStatus CACHE DATA - DO NOT MODIFY - FORMAT 1"
+journalsuffix = ".journal"
+# The journal is compacted into the status file once it grows larger
+# than the status file and this many bytes
+journalminsize = 65536
 
 
 class LocalStatusFolder(BaseFolder):
@@ -27,11 +32,21 @@ class LocalStatusFolder(BaseFolder):
         self.sep = '.' #needs to be set before super.__init__()
         super(LocalStatusFolder, self).__init__(name, repository)
         self.filename = os.path.join(self.getroot(), self.getfolderbasename())
-        self.messagelist = {}
+        self.messagelist = MessageList('time')
+        # set by prepare_resync() to skip reading the status file again
+        self._keepmessagelist = False
         self.savelock = threading.Lock()
         self.doautosave = self.config.getdefaultboolean("general", "fsync",
                                                         False)
         """Should we perform fsyncs as often as possible?"""
+        self.journal = repository.account.getconfboolean('status_journal',
+                                                         True)
+        """Should changes be appended to a journal rather than rewriting
+        the status file each time?"""
+        self.journalname = self.filename + journalsuffix
+        self._journalfile = None
+        self._journalsize = 0
+        self._statussize = 0
 
     def storesmessages(self):
         return 0
@@ -52,15 +67,27 @@ class LocalStatusFolder(BaseFolder):
         return self.filename
 
     def deletemessagelist(self):
+        self._keepmessagelist = False
+        with self.savelock:
+            self._closejournal()
+            if os.path.exists(self.journalname):
+                os.unlink(self.journalname)
         if not self.isnewfolder():
             os.unlink(self.filename)
 
+    def prepare_resync(self):
+        """Keep the message list, the status file is only written by us"""
+        self._keepmessagelist = True
+
     def cachemessagelist(self):
         if self.isnewfolder():
-            self.messagelist = {}
+            self.messagelist = MessageList('time')
+            return
+        if self._keepmessagelist:
+            self._keepmessagelist = False
             return
         file = open(self.filename, "rt")
-        self.messagelist = {}
+        self.messagelist = MessageList('time')
         line = file.readline().strip()
         if not line:
             # The status file is empty - should not have happened,
@@ -83,30 +110,115 @@ class LocalStatusFolder(BaseFolder):
                 raise ValueError(errstr)
             self.messagelist[uid] = {'uid': uid, 'flags': flags}
         file.close()
+        self._statussize = os.path.getsize(self.filename)
+        self._replayjournal()
+
+    def _replayjournal(self):
+        """Apply the changes in the journal to the message list
+
+        A last line without newline was cut short by a crash while it
+        was written. The change it records has not been reported as
+        done, so it is cut off."""
+        self._journalsize = 0
+        if not os.path.exists(self.journalname):
+            return
+        with open(self.journalname, "rt") as file:
+            for line in file:
+                if not line.endswith("\n"):
+                    break
+                self._journalsize += len(line)
+                try:
+                    if line.startswith('-'):
+                        self.messagelist.pop(long(line[1:]), None)
+                        continue
+                    uid, flags = line[1:].strip().split(':')
+                    uid = long(uid)
+                    if not line.startswith('+'):
+                        raise ValueError
+                except ValueError:
+                    errstr = "Corrupt line '%s' in journal '%s'" % \
+                        (line.strip(), self.journalname)
+                    self.ui.warn(errstr)
+                    raise ValueError(errstr)
+                self.messagelist[uid] = {'uid': uid, 'flags': set(flags)}
+        if os.path.getsize(self.journalname) > self._journalsize:
+            with open(self.journalname, "r+b") as file:
+                file.truncate(self._journalsize)
+
+    def _closejournal(self):
+        if self._journalfile is not None:
+            self._journalfile.close()
+            self._journalfile = None
+
+    def _fsyncdir(self):
+        fd = os.open(os.path.dirname(self.filename), os.O_RDONLY)
+        os.fsync(fd)
+        os.close(fd)
+
+    def _writejournal(self, lines):
+        """Record changes in the journal, or save the status file
+
+        Appending the changed messages rather than rewriting the status
+        file keeps the writes of a sync proportional to the changes.
+        Like save(), a change is written out before it is reported as
+        done. The journal is compacted by save()."""
+        if not self.journal or self.isnewfolder() or \
+                self._journalsize > max(self._statussize, journalminsize):
+            self.save()
+            return
+        with self.savelock:
+            if self._journalfile is None:
+                created = not os.path.exists(self.journalname)
+                self._journalfile = open(self.journalname, "at")
+                if created and self.doautosave:
+                    self._fsyncdir()
+            data = ''.join(lines)
+            self._journalfile.write(data)
+            self._journalfile.flush()
+            if self.doautosave:
+                os.fsync(self._journalfile.fileno())
+            self._journalsize += len(data)
+
+    def _journalset(self, uid):
+        flags = ''.join(sorted(self.messagelist[uid]['flags']))
+        self._writejournal(["+%d:%s\n" % (uid, flags)])
 
     def save(self):
+        """Write the whole status file, compacting the journal into it
+
+        The journal is removed only after the new status file is in
+        place. Replaying it on a status file that already contains its
+        changes does no harm."""
         self.savelock.acquire()
         try:
             file = open(self.filename + ".tmp", "wt")
             file.write(magicline + "\n")
-            for msg in self.messagelist.values():
-                flags = msg['flags']
+            for uid, flags in sorted(self.messagelist.getflagdict().items()):
                 flags = ''.join(sorted(flags))
-                file.write("%s:%s\n" % (msg['uid'], flags))
+                file.write("%s:%s\n" % (uid, flags))
             file.flush()
             if self.doautosave:
                 os.fsync(file.fileno())
+            self._statussize = file.tell()
             file.close()
             os.rename(self.filename + ".tmp", self.filename)
 
             if self.doautosave:
-                fd = os.open(os.path.dirname(self.filename), os.O_RDONLY)
-                os.fsync(fd)
-                os.close(fd)
+                self._fsyncdir()
 
+            self._closejournal()
+            if self._journalsize or os.path.exists(self.journalname):
+                os.unlink(self.journalname)
+                self._journalsize = 0
         finally:
             self.savelock.release()
 
+    def commit(self):
+        """Write out changes held back, called after each sync pass
+
+        Nothing to do here, changes are written as they are made."""
+        pass
+
     def getmessagelist(self):
         return self.messagelist
 
@@ -125,7 +237,7 @@ class LocalStatusFolder(BaseFolder):
             return uid
 
         self.messagelist[uid] = {'uid': uid, 'flags': flags, 'time': rtime}
-        self.save()
+        self._journalset(uid)
         return uid
 
     def getmessageflags(self, uid):
@@ -136,7 +248,7 @@ class LocalStatusFolder(BaseFolder):
 
     def savemessageflags(self, uid, flags):
         self.messagelist[uid]['flags'] = flags
-        self.save()
+        self._journalset(uid)
 
     def deletemessage(self, uid):
         self.deletemessages([uid])
@@ -149,4 +261,4 @@ class LocalStatusFolder(BaseFolder):
 
         for uid in uidlist:
             del(self.messagelist[uid])
-        self.save()
+        self._writejournal(["-%d\n" % uid for uid in uidlist])
@@ -16,14 +16,97 @@
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 import os.path
 import re
+import time
 from threading import Lock
-from .LocalStatus import LocalStatusFolder
+from .LocalStatus import LocalStatusFolder, journalsuffix
+from offlineimap.messagelist import MessageList
 try:
     import sqlite3 as sqlite
 except:
     pass #fail only if needed later on, not on import
 
 
+class SQLiteWriter(object):
+    """Writes to an SQLite connection, committed in batches
+
+    Writes are committed together once status_commitbatch statements
+    are pending or the oldest is status_commitinterval seconds old,
+    and whenever commit() is called, e.g. at the end of each sync pass.
+    lock protects the connection against concurrent writes."""
+
+    def __init__(self, account, ui):
+        self.ui = ui
+        self.connection = None
+        self.lock = Lock()
+        self.commitbatch = account.getconfint('status_commitbatch', 500)
+        self.commitinterval = account.getconffloat('status_commitinterval',
+                                                   5.0)
+        self._pending = 0
+        self._pendingsince = None
+        self.commits = 0
+        self.committime = 0.0
+
+    def retrylocked(self, func, *args):
+        """Call func(*args), retrying with a growing delay while the
+        database is locked by another process"""
+        delay = 0.01
+        while True:
+            try:
+                return func(*args)
+            except sqlite.OperationalError as e:
+                if e.args[0] != 'database is locked':
+                    raise
+            self.ui.debug('', "Locked sqlite database, retrying in %.2fs." %
+                          delay)
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
+
+    def write(self, sql, vars=None, executemany=False):
+        """Execute an INSERT, UPDATE or DELETE, committed later
+
+        :param vars: the variable values to `sql`, or a list of them
+            with executemany
+        :returns: the Cursor() or raises an Exception"""
+        if executemany:
+            execute = self.connection.executemany
+        else:
+            execute = self.connection.execute
+        args = (sql,) if vars is None else (sql, vars)
+        with self.lock:
+            cursor = self.retrylocked(execute, *args)
+            self._pending += 1
+            if self._pendingsince is None:
+                self._pendingsince = time.time()
+            if self._pending >= self.commitbatch or \
+                    time.time() - self._pendingsince >= self.commitinterval:
+                self._commit()
+        return cursor
+
+    def _commit(self):
+        """Commit the pending writes, with lock held"""
+        if not self._pending:
+            return
+        start = time.time()
+        self.retrylocked(self.connection.commit)
+        self.commits += 1
+        self.committime += time.time() - start
+        self._pending = 0
+        self._pendingsince = None
+
+    def commit(self):
+        """Commit the pending writes to the database"""
+        with self.lock:
+            self._commit()
+
+    def debugstats(self, filename):
+        """Log how many commits there were and how long they took"""
+        if self.commits:
+            self.ui.debug('', "Status database %s: %d commits, %.1fms "
+                          "on average" % (filename, self.commits,
+                                           1000 * self.committime /
+                                           self.commits))
+
+
 class LocalStatusSQLiteFolder(LocalStatusFolder):
     """LocalStatus backend implemented with an SQLite database
 
@@ -42,13 +125,19 @@ class LocalStatusSQLiteFolder(LocalStatusFolder):
     #current version of our db format
     cur_version = 1
 
+    # The connection is the one of the writer
+    connection = property(lambda self: self._writer.connection,
+                          lambda self, connection: setattr(self._writer,
+                              'connection', connection))
+
     def __init__(self, name, repository):
         super(LocalStatusSQLiteFolder, self).__init__(name, repository)       
-        # dblock protects against concurrent writes in same connection
-        self._dblock = Lock()
+        # commits the writes in batches and protects against concurrent
+        # writes in same connection
+        self._writer = SQLiteWriter(repository.account, self.ui)
         #Try to establish connection, no need for threadsafety in __init__
         try:
-            self.connection = sqlite.connect(self.filename, check_same_thread = False)
+            self.connection = self._connect()
         except NameError:
             # sqlite import had failed
             raise UserWarning('SQLite backend chosen, but no sqlite python '
@@ -69,50 +158,50 @@ class LocalStatusSQLiteFolder(LocalStatusFolder):
             if version < LocalStatusSQLiteFolder.cur_version:
                 self.upgrade_db(version)
 
+    def _connect(self):
+        """Open the database in WAL mode
+
+        With a write-ahead log, a commit appends to the log rather than
+        rewriting pages and readers do not block the writer. Commits
+        are only synced to disk at checkpoints unless fsync is set. A
+        crash may then lose the last commits, i.e. the status forgets
+        some changes and the next sync does them again, but the status
+        never claims changes that were not done."""
+        connection = sqlite.connect(self.filename, check_same_thread = False)
+        try:
+            connection.execute('PRAGMA journal_mode=WAL')
+            if self.doautosave:
+                connection.execute('PRAGMA synchronous=FULL')
+            else:
+                connection.execute('PRAGMA synchronous=NORMAL')
+        except sqlite.DatabaseError:
+            pass # corrupt, the caller recreates it
+        return connection
+
     def sql_write(self, sql, vars=None, executemany=False):
         """Execute some SQL, retrying if the db was locked.
 
+        The write is committed along with others by commit(), see
+        SQLiteWriter.
+
         :param sql: the SQL string passed to execute()
         :param vars: the variable values to `sql`. E.g. (1,2) or {uid:1,
             flags:'T'}. See sqlite docs for possibilities.
         :param executemany: bool indicating whether we want to
             perform conn.executemany() or conn.execute().
         :returns: the Cursor() or raises an Exception"""
-        success = False
-        while not success:
-            self._dblock.acquire()
-            try:
-                if vars is None:
-                    if executemany:
-                        cursor = self.connection.executemany(sql)
-                    else:
-                        cursor = self.connection.execute(sql)
-                else:
-                    if executemany:
-                        cursor = self.connection.executemany(sql, vars)
-                    else:
-                        cursor = self.connection.execute(sql, vars)
-                success = True
-                self.connection.commit()
-            except sqlite.OperationalError as e:
-                if e.args[0] == 'cannot commit - no transaction is active':
-                    pass
-                elif e.args[0] == 'database is locked':
-                    self.ui.debug('', "Locked sqlite database, retrying.")
-                    success = False
-                else:
-                    raise
-            finally:
-                self._dblock.release()
-        return cursor
+        return self._writer.write(sql, vars, executemany)
+
+    def commit(self):
+        """Commit the pending writes to the database"""
+        self._writer.commit()
 
     def upgrade_db(self, from_ver):
         """Upgrade the sqlite format from version 'from_ver' to current"""
 
-        if hasattr(self, 'connection'):
+        if self.connection is not None:
             self.connection.close() #close old connections first
-        self.connection = sqlite.connect(self.filename,
-                                         check_same_thread = False)
+        self.connection = self._connect()
 
         if from_ver == 0:
             # from_ver==0: no db existent: plain text migration?
@@ -127,19 +216,20 @@ class LocalStatusSQLiteFolder(LocalStatusFolder):
                 self.ui._msg('Migrating LocalStatus cache from plain text '
                              'to sqlite database for %s:%s' %\
                                  (self.repository, self))
-                file = open(plaintextfilename, "rt")
-                line = file.readline().strip()
-                data = []
-                for line in file.xreadlines():
-                    uid, flags = line.strip().split(':')
-                    uid = long(uid)
-                    flags = ''.join(sorted(flags))
-                    data.append((uid,flags))
+                # replays the journal, too
+                plainfolder = LocalStatusFolder(self.name, self.repository)
+                plainfolder.filename = plaintextfilename
+                plainfolder.journalname = plaintextfilename + journalsuffix
+                plainfolder.cachemessagelist()
+                data = [(uid, ''.join(sorted(flags))) for uid, flags in
+                        plainfolder.getmessagelist().getflagdict().items()]
                 self.connection.executemany('INSERT INTO status (id,flags) VALUES (?,?)',
                                        data)
                 self.connection.commit()
-                file.close()
                 os.rename(plaintextfilename, plaintextfilename + ".old")
+                if os.path.exists(plainfolder.journalname):
+                    os.rename(plainfolder.journalname,
+                              plainfolder.journalname + ".old")
         # Future version upgrades come here...
         # if from_ver <= 1: ... #upgrade from 1 to 2
         # if from_ver <= 2: ... #upgrade from 2 to 3
@@ -148,9 +238,9 @@ class LocalStatusSQLiteFolder(LocalStatusFolder):
         """Create a new db file"""
         self.ui._msg('Creating new Local Status db for %s:%s' \
                          % (self.repository, self))
-        if hasattr(self, 'connection'):
+        if self.connection is not None:
             self.connection.close() #close old connections first
-        self.connection = sqlite.connect(self.filename, check_same_thread = False)
+        self.connection = self._connect()
         self.connection.executescript("""
         CREATE TABLE metadata (key VARCHAR(50) PRIMARY KEY, value VARCHAR(128));
         INSERT INTO metadata VALUES('db_version', '1');
@@ -166,18 +256,23 @@ class LocalStatusSQLiteFolder(LocalStatusFolder):
 
     def deletemessagelist(self):
         """delete all messages in the db"""
+        self._keepmessagelist = False
         self.sql_write('DELETE FROM status')
 
     def cachemessagelist(self):
-        self.messagelist = {}
+        if self._keepmessagelist:
+            self._keepmessagelist = False
+            return
+        self.messagelist = MessageList('time')
         cursor = self.connection.execute('SELECT id,flags from status')
         for row in cursor:
                 flags = set(row[1])
                 self.messagelist[row[0]] = {'uid': row[0], 'flags': flags}
 
     def save(self):
-        #Noop in this backend
-        pass
+        """Commit the pending writes, the database is written as we go"""
+        self.commit()
+        self._writer.debugstats(self.filename)
 
     # Following some pure SQLite functions, where we chose to use
     # BaseFolder() methods instead. Doing those on the in-memory list is
@@ -240,6 +335,16 @@ class LocalStatusSQLiteFolder(LocalStatusFolder):
         flags = ''.join(sorted(flags))
         self.sql_write('UPDATE status SET flags=? WHERE id=?',(flags,uid))
 
+    def applyflagchanges(self, changes):
+        """Update the flags of several messages with one executemany()"""
+        data = []
+        for uid, (addflags, delflags) in changes.items():
+            flags = (self.getmessageflags(uid) | addflags) - delflags
+            self.messagelist[uid]['flags'] = flags
+            data.append((''.join(sorted(flags)), uid))
+        if data:
+            self.sql_write('UPDATE status SET flags=? WHERE id=?', data, True)
+
     def deletemessage(self, uid):
         if not uid in self.messagelist:
             return
@@ -0,0 +1,300 @@
+# Local status cache virtual folder: one SQLite database per account
+# Copyright (C) 2013 John Goerzen & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import os
+from collections import OrderedDict
+from threading import Lock
+from .LocalStatus import LocalStatusFolder, journalsuffix
+from .LocalStatusSQLite import SQLiteWriter
+from offlineimap.ui import getglobalui
+try:
+    import sqlite3 as sqlite
+except:
+    pass #fail only if needed later on, not on import
+
+
+class StatusDatabase(SQLiteWriter):
+    """The status database of all folders of an account
+
+    All folders share the connection, and their writes are committed
+    together like those of a LocalStatusSQLiteFolder."""
+
+    def __init__(self, filename, account):
+        super(StatusDatabase, self).__init__(account, getglobalui())
+        self.filename = filename
+        try:
+            self.connection = sqlite.connect(filename,
+                                             check_same_thread = False)
+        except NameError:
+            # sqlite import had failed
+            raise UserWarning('SQLite backend chosen, but no sqlite python '
+                              'bindings available. Please install.')
+        self.connection.text_factory = str
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        if account.getconfig().getdefaultboolean("general", "fsync", False):
+            self.connection.execute('PRAGMA synchronous=FULL')
+        else:
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript("""
+        CREATE TABLE IF NOT EXISTS metadata (key VARCHAR(50) PRIMARY KEY,
+                                             value VARCHAR(128));
+        INSERT OR IGNORE INTO metadata VALUES('db_version', '1');
+        CREATE TABLE IF NOT EXISTS folders (name VARCHAR(256) PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS status (folder VARCHAR(256), id INTEGER,
+            flags VARCHAR(50), PRIMARY KEY (folder, id));
+        """)
+        self.connection.commit()
+
+    def query(self, sql, vars=()):
+        """:returns: all rows of a SELECT as list"""
+        with self.lock:
+            return self.retrylocked(
+                lambda: self.connection.execute(sql, vars).fetchall())
+
+    def getflagdict(self, folder):
+        """:returns: dict mapping the UIDs of a folder to their flags
+
+        Messages with the same flags share the frozenset."""
+        flagsets = {}
+        flagdict = {}
+        with self.lock:
+            cursor = self.connection.execute(
+                'SELECT id, flags FROM status WHERE folder=?', (folder,))
+            for uid, flags in cursor:
+                flagset = flagsets.get(flags)
+                if flagset is None:
+                    flagset = flagsets[flags] = frozenset(flags)
+                flagdict[uid] = flagset
+        return flagdict
+
+
+class StatusMessageList(object):
+    """The message list of a LocalStatusSQLiteAccountFolder
+
+    Looks messages up in the database rather than holding them in
+    memory. It is only meant for the few uses of getmessagelist() that
+    remain, the folder's methods query the database directly."""
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def __contains__(self, uid):
+        return self.folder.uidexists(uid)
+
+    def __len__(self):
+        return self.folder.getmessagecount()
+
+    def __nonzero__(self):
+        return len(self) > 0
+
+    def keys(self):
+        return self.folder.getmessageuidlist()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    iterkeys = __iter__
+
+    def __getitem__(self, uid):
+        return {'uid': uid, 'flags': self.folder.getmessageflags(uid)}
+
+    def get(self, uid, default=None):
+        if uid in self:
+            return self[uid]
+        return default
+
+    def getflagdict(self):
+        return self.folder.db.getflagdict(self.folder.key)
+
+    def items(self):
+        return [(uid, {'uid': uid, 'flags': set(flags)})
+                for uid, flags in self.getflagdict().items()]
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def values(self):
+        return [msg for uid, msg in self.items()]
+
+    def itervalues(self):
+        return iter(self.values())
+
+
+class LocalStatusSQLiteAccountFolder(LocalStatusFolder):
+    """LocalStatus backend keeping all folders in one SQLite database
+
+    The status of the messages stays in the database, which answers
+    uidexists(), getmessageflags() and the like. Only the flags of
+    recently used messages are cached, and the flags of all messages
+    are only loaded to compare message lists for a sync, see
+    StatusMessageList.getflagdict()."""
+
+    # UIDs whose flags are cached
+    cachesize = 1000
+
+    def __init__(self, name, repository):
+        super(LocalStatusSQLiteAccountFolder, self).__init__(name, repository)
+        self.db = repository.getstatusdb()
+        self.key = self.getfolderbasename()
+        self.messagelist = StatusMessageList(self)
+        # uid -> frozenset of flags, or None for missing messages
+        self._cache = OrderedDict()
+        self._cachelock = Lock()
+        if not self.db.query('SELECT name FROM folders WHERE name=?',
+                             (self.key,)):
+            self._migrate()
+            self.db.write('INSERT OR IGNORE INTO folders (name) VALUES (?)',
+                          (self.key,))
+
+    def _migrate(self):
+        """Import the status of the 'plain' or 'sqlite' backend"""
+        meta = self.repository.account.getaccountmeta()
+        plainname = os.path.join(meta, 'LocalStatus', self.key)
+        sqlitename = os.path.join(meta, 'LocalStatus-sqlite', self.key)
+        if os.path.exists(sqlitename):
+            connection = sqlite.connect(sqlitename)
+            try:
+                rows = connection.execute('SELECT id, flags FROM status'
+                                          ).fetchall()
+            finally:
+                connection.close()
+            oldname = sqlitename
+        elif os.path.exists(plainname):
+            # replays the journal, too
+            plainfolder = LocalStatusFolder(self.name, self.repository)
+            plainfolder.filename = plainname
+            plainfolder.journalname = plainname + journalsuffix
+            plainfolder.cachemessagelist()
+            rows = [(uid, ''.join(sorted(flags))) for uid, flags in
+                    plainfolder.getmessagelist().getflagdict().items()]
+            oldname = plainname
+        else:
+            return
+        self.ui.info('Migrating LocalStatus cache of %s:%s to the account '
+                     'database' % (self.repository, self))
+        self.db.write('INSERT OR REPLACE INTO status (folder, id, flags) '
+                      'VALUES (?, ?, ?)',
+                      [(self.key, uid, flags) for uid, flags in rows], True)
+        self.db.commit()
+        os.rename(oldname, oldname + ".old")
+        if os.path.exists(oldname + journalsuffix):
+            os.rename(oldname + journalsuffix,
+                      oldname + journalsuffix + '.old')
+
+    def _cacheflags(self, uid, flags):
+        with self._cachelock:
+            self._cache.pop(uid, None)
+            self._cache[uid] = flags
+            if len(self._cache) > self.cachesize:
+                self._cache.popitem(last=False)
+
+    def _getflags(self, uid):
+        """:returns: the flags of a message as frozenset or None"""
+        with self._cachelock:
+            if uid in self._cache:
+                return self._cache[uid]
+        rows = self.db.query('SELECT flags FROM status WHERE folder=? AND '
+                             'id=?', (self.key, uid))
+        flags = frozenset(rows[0][0]) if rows else None
+        self._cacheflags(uid, flags)
+        return flags
+
+    def isnewfolder(self):
+        return not self.getmessagecount()
+
+    def deletemessagelist(self):
+        """delete all messages of the folder"""
+        self.db.write('DELETE FROM status WHERE folder=?', (self.key,))
+        with self._cachelock:
+            self._cache.clear()
+
+    def cachemessagelist(self):
+        """Nothing to load, the messages stay in the database"""
+        pass
+
+    def prepare_resync(self):
+        pass
+
+    def save(self):
+        """Commit the pending writes, the database is written as we go"""
+        self.db.commit()
+        self.db.debugstats(self.db.filename)
+
+    def commit(self):
+        self.db.commit()
+
+    def uidexists(self, uid):
+        return self._getflags(uid) is not None
+
+    def getmessageuidlist(self):
+        return [row[0] for row in self.db.query(
+                'SELECT id FROM status WHERE folder=? ORDER BY id',
+                (self.key,))]
+
+    def getmessagecount(self):
+        return self.db.query('SELECT count(id) FROM status WHERE folder=?',
+                             (self.key,))[0][0]
+
+    def getmessageflags(self, uid):
+        flags = self._getflags(uid)
+        if flags is None:
+            raise KeyError(uid)
+        return set(flags)
+
+    def getmessagetime(self, uid):
+        return None
+
+    def savemessage(self, uid, content, flags, rtime):
+        """Writes a new message, with the specified uid.
+
+        See folder/Base for detail. Note that savemessage() does not
+        check against dryrun settings, so you need to ensure that
+        savemessage is never called in a dryrun mode."""
+        if uid < 0:
+            # We cannot assign a uid.
+            return uid
+        self.db.write('INSERT OR REPLACE INTO status (folder, id, flags) '
+                      'VALUES (?, ?, ?)',
+                      (self.key, uid, ''.join(sorted(flags))))
+        self._cacheflags(uid, frozenset(flags))
+        return uid
+
+    def savemessageflags(self, uid, flags):
+        self.db.write('UPDATE status SET flags=? WHERE folder=? AND id=?',
+                      (''.join(sorted(flags)), self.key, uid))
+        self._cacheflags(uid, frozenset(flags))
+
+    def applyflagchanges(self, changes):
+        """Update the flags of several messages with one executemany()"""
+        data = []
+        for uid, (addflags, delflags) in changes.items():
+            flags = (self.getmessageflags(uid) | addflags) - delflags
+            data.append((''.join(sorted(flags)), self.key, uid))
+            self._cacheflags(uid, frozenset(flags))
+        if data:
+            self.db.write('UPDATE status SET flags=? WHERE folder=? AND id=?',
+                          data, True)
+
+    def deletemessage(self, uid):
+        self.deletemessages([uid])
+
+    def deletemessages(self, uidlist):
+        if not uidlist:
+            return
+        self.db.write('DELETE FROM status WHERE folder=? AND id=?',
+                      [(self.key, uid) for uid in uidlist], True)
+        for uid in uidlist:
+            self._cacheflags(uid, None)
@@ -33,11 +33,17 @@ except NameError:
     from sets import Set as set
 
 from offlineimap import OfflineImapError
+from offlineimap.movedetect import getmessageid, readheaders, \
+    getcrlffilesize
+from offlineimap.messagelist import MessageList
+from offlineimap.syncplan import getflagdict
 
 # Find the UID in a message filename
 re_uidmatch = re.compile(',U=(\d+)')
 # Find a numeric timestamp in a string (filename prefix)
 re_timestampmatch = re.compile('(\d+)');
+# First line of the scan index, see MaildirFolder._scanfolder()
+indexmagic = "OFFLINEIMAP Maildir index - FORMAT 1"
 
 timeseq = 0
 lasttime = 0
@@ -65,6 +71,8 @@ class MaildirFolder(BaseFolder):
         self.dofsync = self.config.getdefaultboolean("general", "fsync", True)
         self.root = root
         self.messagelist = None
+        # stamps of new/ and cur/ when the message list was scanned
+        self._scanstamp = None
         # check if we should use a different infosep to support Win file systems
         self.wincompatible = self.config.getdefaultboolean(
             "Account "+self.accountname, "maildir-windows-compatible", False)
@@ -90,26 +98,18 @@ class MaildirFolder(BaseFolder):
         token."""
         return 42
 
-    #Checks to see if the given message is within the maximum age according
-    #to the maildir name which should begin with a timestamp
-    def _iswithinmaxage(self, messagename, maxage):
-        #In order to have the same behaviour as SINCE in an IMAP search
-        #we must convert this to the oldest time and then strip off hrs/mins
-        #from that day
+    def _getoldesttime(self, maxage):
+        """Oldest message timestamp within the maximum age
+
+        In order to have the same behaviour as SINCE in an IMAP search
+        we must convert this to the oldest time and then strip off
+        hrs/mins from that day."""
         oldest_time_utc = time.time() - (60*60*24*maxage)
         oldest_time_struct = time.gmtime(oldest_time_utc)
         oldest_time_today_seconds = ((oldest_time_struct[3] * 3600) \
             + (oldest_time_struct[4] * 60) \
             + oldest_time_struct[5])
-        oldest_time_utc -= oldest_time_today_seconds
-
-        timestampmatch = re_timestampmatch.search(messagename)
-        timestampstr = timestampmatch.group()
-        timestamplong = long(timestampstr)
-        if(timestamplong < oldest_time_utc):
-            return False
-        else:
-            return True
+        return oldest_time_utc - oldest_time_today_seconds
 
     def _parse_filename(self, filename):
         """Returns a messages file name components
@@ -145,67 +145,214 @@ class MaildirFolder(BaseFolder):
             flags = set((c for c in flagmatch.group(1) if not c.islower()))
         return prefix, uid, fmd5, flags
 
+    def _getindexfilename(self):
+        return os.path.join(self.repository.getcachedir(),
+                            self.getfolderbasename())
+
+    def _getindexheader(self):
+        # the parsed names depend on the folder MD5 and the infosep
+        return '%s %s %s' % (indexmagic, self._foldermd5, self.infosep)
+
+    def _loadindex(self):
+        """Load the scan index saved by _saveindex()
+
+        :returns: the index as (stamps, entries), see _scanfolder(), or
+            None if there is none or it cannot be used"""
+        filename = self._getindexfilename()
+        if not os.path.exists(filename):
+            return None
+        stamps, entries = {}, {'new': {}, 'cur': {}}
+        with open(filename, 'rt') as file:
+            if file.readline().rstrip('\n') != self._getindexheader():
+                return None
+            try:
+                for dirannex in ('new', 'cur'):
+                    fields = file.readline().split()
+                    if fields[0] != dirannex:
+                        raise ValueError
+                    if len(fields) > 1:
+                        stamps[dirannex] = (long(fields[1]), long(fields[2]),
+                                            float(fields[3]))
+                for line in file:
+                    filepath, uid, flags, timestamp, size = \
+                        line.rstrip('\n').split('\t')
+                    dirannex, name = filepath.split('/', 1)
+                    entries[dirannex][name] = (long(uid) if uid else None,
+                        flags, long(timestamp) if timestamp else None,
+                        long(size) if size else None)
+            except (ValueError, IndexError, KeyError):
+                self.ui.warn("Corrupt Maildir index %s, scanning the "
+                             "folder" % filename)
+                return None
+        return stamps, entries
+
+    def _saveindex(self, stamps, entries):
+        """Persist the scan index, see _scanfolder()
+
+        The names of a directory are only listed in the index if none
+        contains a tab or newline. Otherwise its stamp is left out, so
+        that the directory is listed each time."""
+        filename = self._getindexfilename()
+        with open(filename + '.tmp', 'wt') as file:
+            file.write(self._getindexheader() + '\n')
+            storable = {}
+            for dirannex in ('new', 'cur'):
+                storable[dirannex] = not [name for name in entries[dirannex]
+                                          if '\t' in name or '\n' in name]
+                stamp = stamps.get(dirannex)
+                if stamp is None or not storable[dirannex]:
+                    file.write('%s\n' % dirannex)
+                else:
+                    file.write('%s %d %d %r\n' % ((dirannex,) + stamp))
+            for dirannex in ('new', 'cur'):
+                if not storable[dirannex]:
+                    continue
+                for name, (uid, flags, timestamp, size) in \
+                        entries[dirannex].iteritems():
+                    file.write('%s/%s\t%s\t%s\t%s\t%s\n' % (dirannex, name,
+                        '' if uid is None else uid, flags,
+                        '' if timestamp is None else timestamp,
+                        '' if size is None else size))
+        os.rename(filename + '.tmp', filename)
+
+    def _getdirstamp(self, dirname):
+        """Device, inode and modification time of a directory
+
+        :returns: the stamp or None if the directory changed too recently
+            to tell a later change apart"""
+        stat = os.stat(dirname)
+        # a directory changed again within the granularity of its mtime
+        # would keep the same mtime
+        if stat.st_mtime >= time.time() - 1:
+            return None
+        return (stat.st_dev, stat.st_ino, stat.st_mtime)
+
+    def _indexentry(self, filename):
+        """:returns: the entry of a message file in the scan index"""
+        (prefix, uid, fmd5, flags) = self._parse_filename(filename)
+        timestampmatch = re_timestampmatch.search(filename)
+        timestamp = long(timestampmatch.group()) if timestampmatch else None
+        return (uid, ''.join(sorted(flags)), timestamp, None)
+
     def _scanfolder(self):
         """Cache the message list from a Maildir.
 
         Maildir flags are: R (replied) S (seen) T (trashed) D (draft) F
         (flagged).
-        :returns: dict that can be used as self.messagelist"""
+
+        The names of the message files in new/ and cur/, parsed, are
+        kept in a scan index, along with a stamp of each directory
+        (device, inode and mtime). A directory whose stamp is unchanged
+        is not listed again, and only the names that were not known yet
+        are parsed. The index is only kept on disk and loaded for each
+        scan, so that it does not take memory next to the message list.
+        :returns: MessageList that can be used as self.messagelist"""
         maxage = self.config.getdefaultint("Account " + self.accountname,
                                            "maxage", None)
         maxsize = self.config.getdefaultint("Account " + self.accountname,
                                             "maxsize", None)
-        retval = {}
-        files = []
-        nouidcounter = -1          # Messages without UIDs get negative UIDs.
+        stamps, entries = self._loadindex() or ({}, {'new': {}, 'cur': {}})
+        changed = False
         for dirannex in ['new', 'cur']:
             fulldirname = os.path.join(self.getfullname(), dirannex)
-            files.extend((dirannex, filename) for
-                         filename in os.listdir(fulldirname))
-
-        for dirannex, filename in files:
-            # We store just dirannex and filename, ie 'cur/123...'
-            filepath = os.path.join(dirannex, filename)
-            # check maxage/maxsize if this message should be considered
-            if maxage and not self._iswithinmaxage(filename, maxage):
-                continue
-            if maxsize and (os.path.getsize(os.path.join(
-                        self.getfullname(), filepath)) > maxsize):
+            stamp = self._getdirstamp(fulldirname)
+            if stamp is not None and stamp == stamps.get(dirannex):
                 continue
-
-            (prefix, uid, fmd5, flags) = self._parse_filename(filename)
-            if uid is None: # assign negative uid to upload it.
-                uid = nouidcounter
-                nouidcounter -= 1
-            else:                       # It comes from our folder.
-                uidmatch = re_uidmatch.search(filename)
-                uid = None
-                if not uidmatch:
+            known = entries[dirannex]
+            scanned = {}
+            for filename in os.listdir(fulldirname):
+                entry = known.get(filename)
+                if entry is None:
+                    entry = self._indexentry(filename)
+                scanned[filename] = entry
+            entries[dirannex] = scanned
+            stamps[dirannex] = stamp
+            changed = True
+
+        retval = MessageList('filename')
+        nouidcounter = -1          # Messages without UIDs get negative UIDs.
+        if maxage:
+            oldest = self._getoldesttime(maxage)
+        for dirannex in ['new', 'cur']:
+            direntries = entries[dirannex]
+            for filename, entry in direntries.iteritems():
+                (uid, flags, timestamp, size) = entry
+                # check maxage/maxsize if this message should be considered
+                if maxage and timestamp is not None and timestamp < oldest:
+                    continue
+                if maxsize:
+                    if size is None:
+                        # message files are renamed, but never changed
+                        size = os.path.getsize(os.path.join(
+                                self.getfullname(), dirannex, filename))
+                        direntries[filename] = (uid, flags, timestamp, size)
+                        changed = True
+                    if size > maxsize:
+                        continue
+                if uid is None: # assign negative uid to upload it.
                     uid = nouidcounter
                     nouidcounter -= 1
-                else:
-                    uid = long(uidmatch.group(1))
-            # 'filename' is 'dirannex/filename', e.g. cur/123,U=1,FMD5=1:2,S
-            retval[uid] = {'flags': flags, 'filename': filepath}
+                # 'filename' is 'dirannex/filename', e.g. cur/123,U=1,FMD5=1:2,S
+                retval[uid] = {'flags': set(flags),
+                               'filename': os.path.join(dirannex, filename)}
+        if changed:
+            self._saveindex(stamps, entries)
         return retval
 
     def quickchanged(self, statusfolder):
-        """Returns True if the Maildir has changed"""
+        """Returns True if the Maildir has changed
+
+        With an up to date scan index, the Maildir is not listed, so
+        this only compares the flags of both message lists. With the
+        inotify setting, a folder that has not changed since it was
+        found unchanged last time is not even compared."""
+        watcher = self.repository.watcher
+        if watcher is not None:
+            if watcher.isclean(self.getname()):
+                return False
+            # usually watched since getfolders(), unless that failed
+            watcher.watch(self)
+            watcher.markclean(self.getname())
         self.cachemessagelist()
-        # Folder has different uids than statusfolder => TRUE
-        if sorted(self.getmessageuidlist()) != \
-                sorted(statusfolder.getmessageuidlist()):
-            return True
-        # Also check for flag changes, it's quick on a Maildir 
-        for (uid, message) in self.getmessagelist().iteritems():
-            if message['flags'] != statusfolder.getmessageflags(uid):
-                return True
-        return False  #Nope, nothing changed
+        changed = getflagdict(self.getmessagelist()) != \
+            getflagdict(statusfolder.getmessagelist())
+        if changed and watcher is not None:
+            # until a sync found it unchanged
+            watcher.markdirty(self.getname())
+        return changed
+
+    def _getscanstamp(self):
+        """Stamps of new/ and cur/, taken before a scan
+
+        :returns: the stamps or None if they are too recent to tell a
+            later change of the directories apart"""
+        try:
+            stamp = tuple(self._getdirstamp(os.path.join(self.getfullname(),
+                                                         dirannex))
+                          for dirannex in ('new', 'cur'))
+        except OSError:
+            return None
+        if None in stamp:
+            return None
+        return stamp
 
     def cachemessagelist(self):
         if self.messagelist is None:
+            self._scanstamp = self._getscanstamp()
             self.messagelist = self._scanfolder()
 
+    def prepare_resync(self):
+        """Keep the message list unless new/ or cur/ changed since the scan
+
+        Our own changes during the last sync count as changes, too. With
+        maxage, messages leave the message list as time passes, so the
+        folder is always scanned again."""
+        if self._scanstamp is None or \
+                self._getscanstamp() != self._scanstamp or \
+                self.config.getdefaultint("Account " + self.accountname,
+                                          "maxage", None):
+            self.messagelist = None
+
     def getmessagelist(self):
         return self.messagelist
 
@@ -220,6 +367,11 @@ class MaildirFolder(BaseFolder):
         #      read it as text?
         return retval.replace("\r\n", "\n")
 
+    def getmessagesize(self, uid):
+        """Size of the message file, used to bound batched uploads"""
+        filename = self.messagelist[uid]['filename']
+        return os.path.getsize(os.path.join(self.getfullname(), filename))
+
     def getmessagetime(self, uid):
         filename = self.messagelist[uid]['filename']
         filepath = os.path.join(self.getfullname(), filename)
@@ -242,6 +394,15 @@ class MaildirFolder(BaseFolder):
         See folder/Base for detail. Note that savemessage() does not
         check against dryrun settings, so you need to ensure that
         savemessage is never called in a dryrun mode."""
+        return self.savemessage_stream(uid, lambda file: file.write(content),
+                                       flags, rtime)
+
+    def savemessage_stream(self, uid, writer, flags, rtime):
+        """Writes a new message, with the specified uid.
+
+        The content is written by writer(file) straight into the file
+        in tmp/, see folder/Base for detail. If writer fails, the
+        partial file is removed again."""
         # This function only ever saves to tmp/,
         # but it calls savemessageflags() to actually save to cur/ or new/.
         self.ui.savemessage('maildir', uid, flags, self)
@@ -272,11 +433,16 @@ class MaildirFolder(BaseFolder):
                 raise
 
         file = os.fdopen(fd, 'wt')
-        file.write(content)
-        # Make sure the data hits the disk
-        file.flush()
-        if self.dofsync:
-            os.fsync(fd)
+        try:
+            writer(file)
+            # Make sure the data hits the disk
+            file.flush()
+            if self.dofsync:
+                os.fsync(fd)
+        except:
+            file.close()
+            os.unlink(os.path.join(tmpdir, messagename))
+            raise
         file.close()
 
         if rtime != None:
@@ -329,6 +495,104 @@ class MaildirFolder(BaseFolder):
             self.messagelist[uid]['flags'] = flags
             self.messagelist[uid]['filename'] = newfilename
 
+    def getmessagekeys(self, uidlist):
+        """Message-ID and size of messages, see folder/Base for details
+
+        The size is that of the message with CRLF line endings, as the
+        IMAP server would report it. Messages without Message-ID are
+        only read up to the end of their headers."""
+        keys = {}
+        for uid in uidlist:
+            if not uid in self.messagelist:
+                continue
+            filepath = os.path.join(self.getfullname(),
+                                    self.messagelist[uid]['filename'])
+            try:
+                with open(filepath, 'rb') as file:
+                    messageid = getmessageid(readheaders(file))
+                    if messageid is None:
+                        continue
+                    file.seek(0)
+                    size = getcrlffilesize(file, os.fstat(file.fileno()
+                                                          ).st_size)
+            except (IOError, OSError):
+                continue
+            keys[uid] = (messageid, size)
+        return keys
+
+    def stashmessages(self, uidlist):
+        """Move messages to tmp/ until they are moved or dropped
+
+        Like any file left in tmp/, stashed messages are invisible to
+        mail readers."""
+        handles = {}
+        for uid in uidlist:
+            if not uid in self.messagelist:
+                continue
+            filename = self.messagelist[uid]['filename']
+            stashpath = os.path.join(self.getfullname(), 'tmp',
+                                     os.path.basename(filename))
+            try:
+                os.rename(os.path.join(self.getfullname(), filename),
+                          stashpath)
+            except OSError:
+                continue # leave it to deletemessages()
+            del self.messagelist[uid]
+            handles[uid] = stashpath
+        return handles
+
+    def savemessage_moved(self, uid, srcfolder, handle, flags, rtime):
+        """Move a message stashed by another Maildir into this one
+
+        See folder/Base for details."""
+        if not isinstance(srcfolder, MaildirFolder) or uid < 0 or \
+                uid in self.messagelist:
+            return None
+        self.ui.savemessage('maildir', uid, flags, self)
+        messagename = os.path.join('tmp', self.new_message_filename(uid, flags))
+        try:
+            os.rename(handle, os.path.join(self.getfullname(), messagename))
+        except OSError as e:
+            raise OfflineImapError("Can't move stashed message '%s' to '%s': "
+                                   "%s" % (handle, messagename, e),
+                                   OfflineImapError.ERROR.MESSAGE)
+        if rtime != None:
+            os.utime(os.path.join(self.getfullname(), messagename),
+                     (rtime, rtime))
+        self.messagelist[uid] = {'flags': flags, 'filename': messagename}
+        # savemessageflags moves msg to 'cur' or 'new' as appropriate
+        self.savemessageflags(uid, flags)
+        return uid
+
+    def linkmessage(self, uid, srcfolder, srcuid, flags, rtime):
+        """Hard link a message of another Maildir into this one
+
+        As message files are never changed, only renamed, both folders
+        can share the file. See folder/Base for details."""
+        if not isinstance(srcfolder, MaildirFolder) or uid < 0 or \
+                uid in self.messagelist or not srcfolder.uidexists(srcuid):
+            return None
+        srcpath = os.path.join(srcfolder.getfullname(),
+                               srcfolder.messagelist[srcuid]['filename'])
+        messagename = os.path.join('tmp', self.new_message_filename(uid, flags))
+        try:
+            os.link(srcpath, os.path.join(self.getfullname(), messagename))
+        except (OSError, AttributeError):
+            # renamed meanwhile, or no hard links on this platform
+            return None
+        self.ui.savemessage('maildir', uid, flags, self)
+        self.messagelist[uid] = {'flags': flags, 'filename': messagename}
+        # savemessageflags moves msg to 'cur' or 'new' as appropriate
+        self.savemessageflags(uid, flags)
+        return uid
+
+    def dropstashedmessages(self, handles):
+        for stashpath in handles:
+            try:
+                os.unlink(stashpath)
+            except OSError:
+                pass # moved to another folder
+
     def change_message_uid(self, uid, new_uid):
         """Change the message from existing uid to new_uid
 
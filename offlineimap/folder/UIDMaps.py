@@ -16,8 +16,122 @@
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 from threading import Lock
 from .IMAP import IMAPFolder
+from offlineimap.syncplan import getflagdict
+from offlineimap.uidmap import UIDMap
+from offlineimap import OfflineImapError
 import os.path
 
+
+class MappedMessage(object):
+    """A message of the local folder, with its remote UID as 'uid'"""
+    __slots__ = ('message', 'uid')
+
+    def __init__(self, message, uid):
+        self.message = message
+        self.uid = uid
+
+    def __getitem__(self, field):
+        if field == 'uid':
+            return self.uid
+        return self.message[field]
+
+    def __setitem__(self, field, value):
+        if field != 'uid':
+            self.message[field] = value
+
+    def get(self, field, default=None):
+        if field == 'uid':
+            return self.uid
+        return self.message.get(field, default)
+
+    def __contains__(self, field):
+        return field == 'uid' or field in self.message
+
+    def items(self):
+        return [(field, self[field]) for field, value in self.message.items()]
+
+    def copy(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return repr(self.copy())
+
+
+class MappedMessageList(object):
+    """The message list of a MappedIMAPFolder, keyed by remote UIDs
+
+    A view of the local folder's message list that maps UIDs as the
+    messages are looked up, rather than copying the list. Only the
+    flags of all messages, as needed to compare message lists, are
+    mapped at once, and kept until the UID mapping or the local
+    message list change."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._flagdict = None
+        self._flagdictversion = None
+        self._flagdictlist = None
+
+    def _localmessages(self):
+        return self.folder._mb.getmessagelist()
+
+    def __getitem__(self, uid):
+        return MappedMessage(self._localmessages()[self.folder.r2l[uid]], uid)
+
+    def get(self, uid, default=None):
+        if uid in self:
+            return self[uid]
+        return default
+
+    def __contains__(self, uid):
+        return self.folder.uidexists(uid)
+
+    def __len__(self):
+        return self.folder.getmessagecount()
+
+    def __nonzero__(self):
+        return len(self) > 0
+
+    def keys(self):
+        return self.folder.getmessageuidlist()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    iterkeys = __iter__
+
+    def items(self):
+        localmessages = self._localmessages()
+        return [(ruid, MappedMessage(localmessages[luid], ruid))
+                for luid, ruid in self.folder.l2r.items()
+                if luid in localmessages]
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def values(self):
+        return [message for uid, message in self.items()]
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def getflagdict(self):
+        """:returns: dict mapping the remote UIDs to the flags"""
+        localmessages = self._localmessages()
+        # holds on to the local list, so that its id is not reused
+        version = (self.folder.uidmap.version,
+                   getattr(localmessages, 'version', None))
+        if version[1] is None or version != self._flagdictversion or \
+                localmessages is not self._flagdictlist:
+            localflags = getflagdict(localmessages)
+            self._flagdict = dict((ruid, localflags[luid]) for luid, ruid
+                                  in self.folder.l2r.items()
+                                  if luid in localflags)
+            self._flagdictversion = version
+            self._flagdictlist = localmessages
+        return self._flagdict
+
+
 class MappedIMAPFolder(IMAPFolder):
     """IMAP class to map between Folder() instances where both side assign a uid
 
@@ -25,61 +139,23 @@ class MappedIMAPFolder(IMAPFolder):
     be an IMAPFolder.
 
     Instance variables (self.):
-      r2l: dict mapping message uids: self.r2l[remoteuid]=localuid
-      l2r: dict mapping message uids: self.r2l[localuid]=remoteuid
-      #TODO: what is the difference, how are they used?
-      diskr2l: dict mapping message uids: self.r2l[remoteuid]=localuid
-      diskl2r: dict mapping message uids: self.r2l[localuid]=remoteuid"""
+      uidmap: UIDMap of the local and remote uids, kept on disk
+      r2l: dict-like view mapping message uids: self.r2l[remoteuid]=localuid
+      l2r: dict-like view mapping message uids: self.l2r[localuid]=remoteuid"""
 
     def __init__(self, *args, **kwargs):
         IMAPFolder.__init__(self, *args, **kwargs)
         self.maplock = Lock()
-        (self.diskr2l, self.diskl2r) = self._loadmaps()
+        self.uidmap = UIDMap(self._getmapfilename())
+        self.r2l = self.uidmap.r2l
+        self.l2r = self.uidmap.l2r
+        self.messagelist = MappedMessageList(self)
         self._mb = IMAPFolder(*args, **kwargs)
         """Representing the local IMAP Folder using local UIDs"""
 
     def _getmapfilename(self):
         return os.path.join(self.repository.getmapdir(),
                             self.getfolderbasename())
-        
-    def _loadmaps(self):
-        self.maplock.acquire()
-        try:
-            mapfilename = self._getmapfilename()
-            if not os.path.exists(mapfilename):
-                return ({}, {})
-            file = open(mapfilename, 'rt')
-            r2l = {}
-            l2r = {}
-            while 1:
-                line = file.readline()
-                if not len(line):
-                    break
-                try:
-                    line = line.strip()
-                except ValueError:
-                    raise Exception("Corrupt line '%s' in UID mapping file '%s'" \
-                                        %(line, mapfilename))
-                (str1, str2) = line.split(':')
-                loc = long(str1)
-                rem = long(str2)
-                r2l[rem] = loc
-                l2r[loc] = rem
-            return (r2l, l2r)
-        finally:
-            self.maplock.release()
-
-    def _savemaps(self, dolock = 1):
-        mapfilename = self._getmapfilename()
-        if dolock: self.maplock.acquire()
-        try:
-            file = open(mapfilename + ".tmp", 'wt')
-            for (key, value) in self.diskl2r.iteritems():
-                file.write("%d:%d\n" % (key, value))
-            file.close()
-            os.rename(mapfilename + '.tmp', mapfilename)
-        finally:
-            if dolock: self.maplock.release()
 
     def _uidlist(self, mapping, items):
         try:
@@ -90,6 +166,10 @@ class MappedIMAPFolder(IMAPFolder):
                 "iling list.".format(e.args[0], self),
                                    OfflineImapError.ERROR.MESSAGE)
 
+    def prepare_resync(self):
+        IMAPFolder.prepare_resync(self)
+        self._mb.prepare_resync()
+
     def cachemessagelist(self):
         self._mb.cachemessagelist()
         reallist = self._mb.getmessagelist()
@@ -97,27 +177,23 @@ class MappedIMAPFolder(IMAPFolder):
         self.maplock.acquire()
         try:
             # OK.  Now we've got a nice list.  First, delete things from the
-            # summary that have been deleted from the folder.
+            # summary that have been deleted from the folder, and
+            # the negative UIDs of the last sync.
 
-            for luid in self.diskl2r.keys():
-                if not luid in reallist:
-                    ruid = self.diskl2r[luid]
-                    del self.diskr2l[ruid]
-                    del self.diskl2r[luid]
+            unmapped = set(reallist.keys())
+            for luid, ruid in self.l2r.items():
+                if not luid in unmapped or ruid < 0:
+                    self.uidmap.removelocal(luid)
+                else:
+                    unmapped.discard(luid)
 
             # Now, assign negative UIDs to local items.
-            self._savemaps(dolock = 0)
             nextneg = -1
 
-            self.r2l = self.diskr2l.copy()
-            self.l2r = self.diskl2r.copy()
-
-            for luid in reallist.keys():
-                if not luid in self.l2r:
-                    ruid = nextneg
-                    nextneg -= 1
-                    self.l2r[luid] = ruid
-                    self.r2l[ruid] = luid
+            for luid in sorted(unmapped):
+                ruid = nextneg
+                nextneg -= 1
+                self.uidmap.add(luid, ruid)
         finally:
             self.maplock.release()
 
@@ -142,34 +218,43 @@ class MappedIMAPFolder(IMAPFolder):
         return len(self.r2l)
 
     def getmessagelist(self):
-        """Gets the current message list. This function's implementation
-        is quite expensive for the mapped UID case.  You must call
-        cachemessagelist() before calling this function!"""
-
-        retval = {}
-        localhash = self._mb.getmessagelist()
-        self.maplock.acquire()
-        try:
-            for key, value in localhash.items():
-                try:
-                    key = self.l2r[key]
-                except KeyError:
-                    # Sometimes, the IMAP backend may put in a new message,
-                    # then this function acquires the lock before the system
-                    # has the chance to note it in the mapping.  In that case,
-                    # just ignore it.
-                    continue
-                value = value.copy()
-                value['uid'] = self.l2r[value['uid']]
-                retval[key] = value
-            return retval
-        finally:
-            self.maplock.release()
+        """Gets the current message list, a view of the local message
+        list with remote UIDs. You must call cachemessagelist() before
+        calling this function!"""
+        return self.messagelist
 
     def getmessage(self, uid):
         """Returns the content of the specified message."""
         return self._mb.getmessage(self.r2l[uid])
 
+    def getmessages(self, uidlist):
+        """Retrieves several messages at once, see BaseFolder.getmessages()"""
+        for luid, content in self._mb.getmessages(self._uidlist(self.r2l,
+                                                                uidlist)):
+            yield self.l2r[luid], content
+
+    def getmessage_stream(self, uid, file):
+        return self._mb.getmessage_stream(self.r2l[uid], file)
+
+    def getmessagesize(self, uid):
+        return self._mb.getmessagesize(self.r2l[uid])
+
+    def getcopybatches(self, uidlist, dstfolder):
+        return [self._uidlist(self.l2r, batch) for batch in
+                self._mb.getcopybatches(self._uidlist(self.r2l, uidlist),
+                                        dstfolder)]
+
+    def getsavebatchlimits(self):
+        return (1, None)
+
+    def savemessages(self, messages):
+        # New messages need to be mapped one by one in savemessage()
+        return None
+
+    def getmessagekeys(self, uidlist):
+        # Moves are not detected for mapped folders
+        return {}
+
     def savemessage(self, uid, content, flags, rtime):
         """Writes a new message, with the specified uid.
 
@@ -206,11 +291,7 @@ class MappedIMAPFolder(IMAPFolder):
                              "%s" % newluid)
         self.maplock.acquire()
         try:
-            self.diskl2r[newluid] = uid
-            self.diskr2l[uid] = newluid
-            self.l2r[newluid] = uid
-            self.r2l[uid] = newluid
-            self._savemaps(dolock = 0)
+            self.uidmap.add(newluid, uid)
         finally:
             self.maplock.release()
         return uid
@@ -248,33 +329,15 @@ class MappedIMAPFolder(IMAPFolder):
         if ruid == new_ruid: return  # sanity check shortcut
         self.maplock.acquire()
         try:
-            luid = self.r2l[ruid]
-            self.l2r[luid] = new_ruid
-            del self.r2l[ruid]
-            self.r2l[new_ruid] = luid
-            #TODO: diskl2r|r2l are a pain to sync and should be done away with
-            #diskl2r only contains positive UIDs, so wrap in ifs
-            if luid>0: self.diskl2r[luid] = new_ruid
-            if ruid>0: del self.diskr2l[ruid]
-            if new_ruid > 0: self.diskr2l[new_ruid] = luid
-            self._savemaps(dolock = 0)
+            self.uidmap.add(self.r2l[ruid], new_ruid)
         finally:
             self.maplock.release()
 
     def _mapped_delete(self, uidlist):
         self.maplock.acquire()
         try:
-            needssave = 0
             for ruid in uidlist:
-                luid = self.r2l[ruid]
-                del self.r2l[ruid]
-                del self.l2r[luid]
-                if ruid > 0:
-                    del self.diskr2l[ruid]
-                    del self.diskl2r[luid]
-                    needssave = 1
-            if needssave:
-                self._savemaps(dolock = 0)
+                self.uidmap.removeremote(ruid)
         finally:
             self.maplock.release()
 
@@ -285,6 +348,10 @@ class MappedIMAPFolder(IMAPFolder):
         self._mb.deletemessagesflags(self._uidlist(self.r2l, uidlist),
                                      flags)
 
+    def applyflagchanges(self, changes):
+        self._mb.applyflagchanges(dict((self.r2l[uid], change)
+                                       for uid, change in changes.items()))
+
     def deletemessage(self, uid):
         self._mb.deletemessage(self.r2l[uid])
         self._mapped_delete([uid])
@@ -28,9 +28,19 @@ from hashlib import sha1
 from offlineimap.ui import getglobalui
 from offlineimap import OfflineImapError
 from offlineimap.imaplib2 import IMAP4, IMAP4_SSL, zlib, IMAP4_PORT, InternalDate, Mon2num
+from offlineimap.imaplib2 import CRLF, Time2Internaldate
 
 
 class UsefulIMAPMixIn(object):
+    # Extensions switched on with ENABLE (RFC 5161), set by IMAPServer
+    enabled = ()
+    # File-like object literals are written to instead of being kept
+    # in memory, see _put_response()
+    literal_sink = None
+    # Callable FETCH responses are passed to instead of being kept as
+    # untagged responses, see _append_untagged()
+    fetch_sink = None
+
     def getselectedfolder(self):
         if self.state == 'SELECTED':
             return self.mailbox
@@ -63,9 +73,198 @@ class UsefulIMAPMixIn(object):
             raise OfflineImapError(errstr, severity)
         return result
 
+    def pipeline(self, commands):
+        """Send several commands at once and wait for all of them
+
+        Rather than waiting for each reply in turn, all commands are
+        sent right away. This only helps with commands that imaplib2
+        runs asynchronously, such as STATUS, FETCH, STORE or UID.
+
+        :param commands: list of (method name, args) tuples, e.g.
+            [('status', ('INBOX', '(MESSAGES)'))]
+        :returns: list of the (typ, data) results in the order of
+            commands. typ is None and data the error message for
+            commands that were aborted."""
+        if not commands:
+            return []
+        results = [None] * len(commands)
+        lock = threading.Lock()
+        done = threading.Event()
+        pending = [len(commands)]
+
+        def callback(args):
+            response, index, error = args
+            with lock:
+                if error is not None:
+                    response = (None, error[1])
+                results[index] = response
+                pending[0] -= 1
+                if not pending[0]:
+                    done.set()
+
+        for index, (name, args) in enumerate(commands):
+            getattr(self, name)(callback=callback, cb_arg=index, *args)
+        done.wait()
+        return results
+
+    def multiappend(self, mailbox, messages, **kw):
+        """(typ, [data]) = multiappend(mailbox, messages)
+        Append several messages with a single APPEND command (RFC 3502).
+
+        messages is a list of (flags, date_time, message) tuples, with
+        the same meaning as the arguments of append(). Each message is
+        sent as a literal once the server asks for it, followed by the
+        flags, date and size of the next one."""
+        specs = []
+        for flags, date_time, message in messages:
+            message = self.mapCRLF_cre.sub(CRLF, message)
+            spec = []
+            if flags:
+                if (flags[0], flags[-1]) != ('(', ')'):
+                    flags = '(%s)' % flags
+                spec.append(flags)
+            if date_time:
+                spec.append(Time2Internaldate(date_time))
+            spec.append('{%d}' % len(message))
+            specs.append((' '.join(spec), message))
+        literals = iter([message + ' ' + nextspec for (spec, message),
+                         (nextspec, nextmessage) in zip(specs, specs[1:])] +
+                        [specs[-1][1]])
+        self.literal = lambda data, rqb: next(literals, None)
+        try:
+            # bytearray keeps imaplib2 from quoting the first spec
+            return self._simple_command('APPEND', mailbox,
+                                        bytearray(specs[0][0]), **kw)
+        finally:
+            self._release_state_change()
+
+    def start_compressing(self):
+        """Enable deflate compression on the socket (RFC 4978)
+
+        Wraps the (de)compressor so that the bytes passing through are
+        counted in self.compressionstats."""
+        super(UsefulIMAPMixIn, self).start_compressing()
+        self.compressionstats = CompressionStats()
+        self.compressor = CountingCompressor(self.compressor,
+                                             self.compressionstats)
+        self.decompressor = CountingDecompressor(self.decompressor,
+                                                 self.compressionstats)
+
+    def _put_response(self, resp):
+        """Divert literal data to literal_sink, if one is set
+
+        imaplib2 collects literals in memory, which for large messages
+        means holding several copies of them. Instead, their data is
+        written to literal_sink as it comes in, and the response only
+        carries an empty string in place of the literal."""
+        if self._expecting_data > 0 and self.literal_sink is not None:
+            dlen = min(self._expecting_data, len(resp))
+            self._expecting_data -= dlen
+            self.literal_sink.write(resp[:dlen])
+            if not self._accumulated_data:
+                self._accumulated_data.append('')
+            if len(resp) <= dlen:
+                return
+            resp = resp[dlen:]
+        super(UsefulIMAPMixIn, self)._put_response(resp)
+
+    def _append_untagged(self, typ, dat):
+        """Pass FETCH responses to fetch_sink, if one is set
+
+        This lets callers consume the messages of a large FETCH while
+        they are still coming in, rather than once the command is
+        complete. fetch_sink is called in the reader thread."""
+        if typ == 'FETCH' and self.fetch_sink is not None:
+            self.fetch_sink(dat)
+            return
+        super(UsefulIMAPMixIn, self)._append_untagged(typ, dat)
+
     def _mesg(self, s, tn=None, secs=None):
         new_mesg(self, s, tn, secs)
 
+
+class CRLFConverter(object):
+    """File-like object converting CRLF line endings to LF
+
+    Data is written through to file as it comes in. A CR at the end of
+    a write is held back until we know whether a LF follows."""
+    def __init__(self, file):
+        self.file = file
+        self.pending_cr = False
+
+    def write(self, data):
+        if not data:
+            return
+        if self.pending_cr:
+            data = '\r' + data
+        self.pending_cr = data.endswith('\r')
+        if self.pending_cr:
+            data = data[:-1]
+        self.file.write(data.replace('\r\n', '\n'))
+
+    def flush(self):
+        """Write out a held back CR, which was not followed by a LF"""
+        if self.pending_cr:
+            self.file.write('\r')
+            self.pending_cr = False
+
+
+class CompressionStats(object):
+    """Byte counters of a COMPRESS=DEFLATE connection
+
+    wire_in/wire_out count the compressed bytes received/sent,
+    data_in/data_out the bytes before compression."""
+    def __init__(self):
+        self.wire_in = self.data_in = 0
+        self.wire_out = self.data_out = 0
+
+    def ratio_in(self):
+        return float(self.data_in) / self.wire_in if self.wire_in else 1.0
+
+    def ratio_out(self):
+        return float(self.data_out) / self.wire_out if self.wire_out else 1.0
+
+    def __str__(self):
+        return "received %d bytes as %d (%.1fx), sent %d bytes as %d (%.1fx)" \
+            % (self.data_in, self.wire_in, self.ratio_in(),
+               self.data_out, self.wire_out, self.ratio_out())
+
+
+class CountingDecompressor(object):
+    """zlib decompressor object counting the bytes passing through"""
+    def __init__(self, decompressor, stats):
+        self.decompressor = decompressor
+        self.stats = stats
+
+    @property
+    def unconsumed_tail(self):
+        return self.decompressor.unconsumed_tail
+
+    def decompress(self, data, size):
+        result = self.decompressor.decompress(data, size)
+        # input left in unconsumed_tail is fed (and counted) again later
+        self.stats.wire_in += len(data) - len(self.decompressor.unconsumed_tail)
+        self.stats.data_in += len(result)
+        return result
+
+
+class CountingCompressor(object):
+    """zlib compressor object counting the bytes passing through"""
+    def __init__(self, compressor, stats):
+        self.compressor = compressor
+        self.stats = stats
+
+    def compress(self, data):
+        self.stats.data_out += len(data)
+        result = self.compressor.compress(data)
+        self.stats.wire_out += len(result)
+        return result
+
+    def flush(self, mode=zlib.Z_FINISH):
+        result = self.compressor.flush(mode)
+        self.stats.wire_out += len(result)
+        return result
+
 class IMAP4_Tunnel(UsefulIMAPMixIn, IMAP4):
     """IMAP4 client class over a tunnel
 
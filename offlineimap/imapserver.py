@@ -73,10 +73,19 @@ class IMAPServer:
         self.availableconnections = []
         self.assignedconnections = []
         self.lastowner = {}
+        # acquireconnection() requests for a mailbox that could/could not
+        # be served by a connection having it selected already
+        self.selecthits = 0
+        self.selectmisses = 0
         self.semaphore = BoundedSemaphore(self.maxconnections)
         self.connectionlock = Lock()
         self.reference = repos.getreference()
         self.idlefolders = repos.getidlefolders()
+        self.pushconnections = repos.getpushconnections()
+        self.pushpollinterval = repos.getpushpollinterval()
+        # idle folder name -> (remote, local, status folder) of its last
+        # sync, see IMAPRepository.savesyncstate()
+        self.syncstates = {}
         self.gss_step = self.GSS_STATE_STEP
         self.gss_vc = None
         self.gssapi = False
@@ -112,12 +121,19 @@ class IMAPServer:
         self.assignedconnections.remove(connection)
         # Don't reuse broken connections
         if connection.Terminate or drop_conn:
-            connection.logout()
+            self.logout(connection)
         else:
             self.availableconnections.append(connection)
         self.connectionlock.release()
         self.semaphore.release()
 
+    def logout(self, imapobj):
+        """Log out of a connection, reporting what compression saved"""
+        if hasattr(imapobj, 'compressionstats'):
+            self.ui.debug('imap', 'COMPRESS=DEFLATE on connection to %s: %s' %
+                          (self.repos, imapobj.compressionstats))
+        imapobj.logout()
+
     def md5handler(self, response):
         challenge = response.strip()
         self.ui.debug('imap', 'md5handler: got challenge %s' % challenge)
@@ -158,17 +174,37 @@ class IMAPServer:
             response = ''
         return base64.b64decode(response)
 
-    def acquireconnection(self):
+    def acquireconnection(self, mailbox = None, readonly = False):
         """Fetches a connection from the pool, making sure to create a new one
         if needed, to obey the maximum connection limits, etc.
         Opens a connection to the server and returns an appropriate
-        object."""
+        object.
+
+        :param mailbox: If given, prefer a connection which has this
+            mailbox selected already, in the mode requested by readonly,
+            so that the caller does not need to SELECT it again."""
 
         self.semaphore.acquire()
         self.connectionlock.acquire()
         curThread = currentThread()
         imapobj = None
 
+        if mailbox is not None:
+            for i in range(len(self.availableconnections) - 1, -1, -1):
+                tryobj = self.availableconnections[i]
+                if tryobj.getselectedfolder() == mailbox and \
+                        tryobj.is_readonly == readonly:
+                    imapobj = tryobj
+                    del(self.availableconnections[i])
+                    break
+            if imapobj:
+                self.selecthits += 1
+                self.assignedconnections.append(imapobj)
+                self.lastowner[imapobj] = curThread.ident
+                self.connectionlock.release()
+                return imapobj
+            self.selectmisses += 1
+
         if len(self.availableconnections): # One is available.
             # Try to find one that previously belonged to this thread
             # as an optimization.  Start from the back since that's where
@@ -276,6 +312,14 @@ class IMAPServer:
             if dat != [None]:
                 imapobj.capabilities = tuple(dat[-1].upper().split())
 
+            if self.repos.getcompress() and \
+                    'COMPRESS=DEFLATE' in imapobj.capabilities:
+                self.ui.debug('imap', 'Enabling COMPRESS=DEFLATE')
+                imapobj.enable_compression()
+
+            if self.repos.getcondstore():
+                self.enablecondstore(imapobj)
+
             if self.delim == None:
                 listres = imapobj.list(self.reference, '""')[1]
                 if listres == [None] or listres == None:
@@ -351,6 +395,69 @@ class IMAPServer:
                 # re-raise all other errors
                 raise
 
+    def enablecondstore(self, imapobj):
+        """Switch on QRESYNC or, failing that, CONDSTORE (RFC 7162)
+
+        ENABLE (RFC 5161) is only valid before a mailbox is selected,
+        so this is called for fresh connections. The extensions the
+        server actually enabled are recorded in imapobj.enabled."""
+        for extension in ('QRESYNC', 'CONDSTORE'):
+            if not extension in imapobj.capabilities or \
+                    not 'ENABLE' in imapobj.capabilities:
+                continue
+            try:
+                typ, dat = imapobj.xatom('ENABLE', extension,
+                                         untagged_response = 'ENABLED')
+            except imapobj.error as e:
+                self.ui.debug('imap', 'ENABLE %s failed: %s' % (extension, e))
+                continue
+            if typ == 'OK' and dat != [None]:
+                enabled = ' '.join(dat).upper().split()
+                if 'QRESYNC' in enabled:
+                    enabled.append('CONDSTORE') # QRESYNC implies CONDSTORE
+                imapobj.enabled = tuple(enabled)
+                self.ui.debug('imap', 'Enabled %s' % ' '.join(enabled))
+                return
+
+    def getstatus(self, mailboxes, items):
+        """Query the STATUS of several mailboxes on one connection
+
+        Rather than waiting for each reply in turn, all STATUS commands
+        are sent at once (see UsefulIMAPMixIn.pipeline()). Mailboxes
+        whose status could not be obtained are missing from the result.
+
+        :param mailboxes: List of full mailbox names
+        :param items: Status data items, e.g. ('MESSAGES', 'UIDNEXT').
+            HIGHESTMODSEQ is only asked for if the server supports it.
+        :returns: dict of mailbox name -> dict of item -> value"""
+        statuses = {}
+        if not mailboxes:
+            return statuses
+        imapobj = self.acquireconnection()
+        if not 'CONDSTORE' in imapobj.capabilities:
+            items = [item for item in items if item != 'HIGHESTMODSEQ']
+        items = '(%s)' % ' '.join(items)
+        try:
+            results = imapobj.pipeline([('status', (mailbox, items))
+                                        for mailbox in mailboxes])
+        except imapobj.abort:
+            self.releaseconnection(imapobj, True)
+            raise OfflineImapError("STATUS on server '%s' failed: %s" % (
+                    self.repos, exc_info()[1]), OfflineImapError.ERROR.REPO)
+        self.releaseconnection(imapobj)
+        for mailbox, (typ, dat) in zip(mailboxes, results):
+            if typ != 'OK':
+                self.ui.debug('imap', 'STATUS of %s failed: %s %s' % (
+                        mailbox, typ, dat))
+                continue
+            # Untagged responses are not tied to their command, so each
+            # reply may carry several mailboxes or none.
+            for statusdata in dat:
+                status = imaputil.statussplit(statusdata)
+                if status is not None:
+                    statuses[status[0]] = status[1]
+        return statuses
+
     def connectionwait(self):
         """Waits until there is a connection available.  Note that between
         the time that a connection becomes available and the time it is
@@ -371,8 +478,12 @@ class IMAPServer:
             # requires the connectionlock, leading to a potential
             # deadlock! Audit & check!
             threadutil.semaphorereset(self.semaphore, self.maxconnections)
+            if self.selecthits or self.selectmisses:
+                self.ui.debug('imap', 'Connections to %s had the mailbox '
+                    'selected already for %d of %d requests' % (self.repos,
+                    self.selecthits, self.selecthits + self.selectmisses))
             for imapobj in self.assignedconnections + self.availableconnections:
-                imapobj.logout()
+                self.logout(imapobj)
             self.assignedconnections = []
             self.availableconnections = []
             self.lastowner = {}
@@ -381,6 +492,21 @@ class IMAPServer:
             self.gss_vc = None
             self.gssapi = False
 
+    def syncpushedfolder(self, foldername, responses=None):
+        """Sync an idle folder the server told us has changed
+
+        :param responses: FETCH responses of new and changed messages as
+            returned by IdleThread.getchanges() to apply, or None for a
+            full sync of the folder."""
+        account = self.repos.account
+        state = self.syncstates.get(foldername)
+        if responses is None or state is None or \
+                not offlineimap.accounts.syncfolder_changes(account,
+                                                            responses, *state):
+            remotefolder = account.remoterepos.getfolder(foldername)
+            offlineimap.accounts.syncfolder(account, remotefolder, quick=False)
+        self.ui.unregisterthread(currentThread()) #syncfolder registered the thread
+
     def keepalive(self, timeout, event):
         """Sends a NOOP to each connection recorded.   It will wait a maximum
         of timeout seconds between doing this, and will continue to do so
@@ -395,9 +521,20 @@ class IMAPServer:
             self.connectionlock.release()
 
             threads = []
+            pushfolders = 0
+            if self.pushconnections and self.idlefolders:
+                # one PushThread watches all folders
+                pusher = PushThread(self, self.idlefolders,
+                                    self.pushconnections)
+                pusher.start()
+                threads.append(pusher)
+                pushfolders = len(self.idlefolders)
             for i in range(numconnections):
                 self.ui.debug('imap', 'keepalive: processing connection %d of %d' % (i, numconnections))
-                if len(self.idlefolders) > i:
+                if pushfolders:
+                    # NOOP thread
+                    idler = IdleThread(self)
+                elif len(self.idlefolders) > i:
                     # IDLE thread
                     idler = IdleThread(self, self.idlefolders[i])
                 else:
@@ -502,16 +639,48 @@ class IdleThread(object):
                 self.parent.releaseconnection(imapobj)
                 self.stop_sig.wait() # wait until we are supposed to quit
 
-    def dosync(self):
-        remoterepos = self.parent.repos
-        account = remoterepos.account
-        localrepos = account.localrepos
-        remoterepos = account.remoterepos
-        statusrepos = account.statusrepos
-        remotefolder = remoterepos.getfolder(self.folder)
-        offlineimap.accounts.syncfolder(account, remotefolder, quick=False)
-        ui = getglobalui()
-        ui.unregisterthread(currentThread()) #syncfolder registered the thread
+    def getchanges(self, imapobj):
+        """Fetch the messages the server told us about while IDLEing
+
+        New messages are fetched with UID FETCH <last UID + 1>:*, the
+        flags of messages the server sent FETCH responses for by their
+        sequence number. As sequence numbers are only valid as long as
+        no message was expunged, EXPUNGE (or VANISHED) responses need a
+        full sync, as does a folder we did not sync before.
+
+        :returns: list of FETCH responses of new and changed messages,
+            or None if the folder needs a full sync"""
+        expunged = imapobj._get_untagged_response('EXPUNGE') or \
+            imapobj._get_untagged_response('VANISHED')
+        fetched = imapobj._get_untagged_response('FETCH') or []
+        state = self.parent.syncstates.get(self.folder)
+        if state is None or expunged:
+            return None
+        remotefolder = state[0]
+        uidvalidity = imapobj._get_untagged_response('UIDVALIDITY', True)
+        if not uidvalidity or uidvalidity[-1] is None or \
+                long(uidvalidity[-1]) != remotefolder.get_saveduidvalidity():
+            return None
+        items = remotefolder._getfetchitems()
+        lastuid = max(remotefolder.getmessageuidlist() or [0])
+        commands = [('uid', ('fetch', '%d:*' % (lastuid + 1), items))]
+        seqnums = [long(response.split(' ', 1)[0]) for response in fetched
+                   if isinstance(response, basestring)]
+        if seqnums:
+            commands.append(('fetch', (imaputil.uid_sequence(seqnums), items)))
+        responses = []
+        for typ, dat in imapobj.pipeline(commands):
+            if typ != 'OK':
+                return None
+            responses.extend(dat)
+        return responses
+
+    def dosync(self, responses=None):
+        """Sync the folder, only applying responses if we can
+
+        :param responses: FETCH responses of new and changed messages as
+            returned by getchanges(), or None for a full sync"""
+        self.parent.syncpushedfolder(self.folder, responses)
 
     def idle(self):
         """Invoke IDLE mode until timeout or self.stop() is invoked"""
@@ -552,13 +721,17 @@ class IdleThread(object):
                     "Sleep until next refresh cycle." % imapobj.identifier)
                 imapobj.noop()
             self.stop_sig.wait() # self.stop() or IDLE callback are invoked
+            responses = None
             try:
                 # End IDLE mode with noop, imapobj can point to a dropped conn.
                 imapobj.noop()
+                if self.needsync:
+                    responses = self.getchanges(imapobj)
             except imapobj.abort:
                 self.ui.warn('Attempting NOOP on dropped connection %s' % \
                                  imapobj.identifier)
                 self.parent.releaseconnection(imapobj, True)
+                responses = None
             else:
                 self.parent.releaseconnection(imapobj)
 
@@ -566,4 +739,172 @@ class IdleThread(object):
                 # here not via self.stop, but because IDLE responded. Do
                 # another round and invoke actual syncing.
                 self.stop_sig.clear()
-                self.dosync()
+                self.dosync(responses)
+
+
+class PushThread(object):
+    # the events we want to hear about, see RFC 5465
+    NOTIFY_EVENTS = '(MessageNew MessageExpunge FlagChange)'
+    STATUS_ITEMS = ('MESSAGES', 'UIDNEXT', 'UIDVALIDITY', 'HIGHESTMODSEQ')
+
+    def __init__(self, parent, folders, connections):
+        """Watch folders for changes with at most connections connections
+
+        If the server supports NOTIFY (RFC 5465), a single connection
+        watches all folders. Otherwise the first folders get an
+        IdleThread each, and the folders left once connections - 1
+        are used are polled with STATUS every pushpollinterval seconds
+        instead. Changed folders are synced."""
+        self.parent = parent
+        self.folders = folders
+        self.connections = connections
+        self.stop_sig = Event()
+        self.ui = getglobalui()
+        self.idlers = []
+        # folder name -> STATUS items as last seen
+        self.statuses = {}
+        self.thread = Thread(target=self.push)
+        self.thread.setDaemon(1)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_sig.set()
+        for idler in self.idlers:
+            idler.stop()
+
+    def join(self):
+        self.thread.join()
+        for idler in self.idlers:
+            idler.stop() # in case it was started after stop()
+            idler.join()
+
+    def changedfolders(self, statuses):
+        """Remember the STATUS of folders and return those that changed
+
+        Folders we did not know the STATUS of before are not considered
+        changed, as they were synced just before we started watching.
+        Notifications may carry only some of the status items.
+
+        :param statuses: dict of folder name -> status items"""
+        changed = []
+        for folder, status in statuses.items():
+            if not folder in self.folders:
+                continue
+            known = self.statuses.setdefault(folder, {})
+            if known and [item for item, value in status.items()
+                          if known.get(item, value) != value]:
+                changed.append(folder)
+            known.update(status)
+        return changed
+
+    def push(self):
+        imapobj = self.parent.acquireconnection()
+        notify = 'NOTIFY' in imapobj.capabilities
+        self.parent.releaseconnection(imapobj)
+        if notify:
+            try:
+                self.notify()
+                return
+            except Exception as e:
+                self.ui.error(e, exc_info()[2], msg = "Watching folders "
+                    "with NOTIFY failed, using IDLE and STATUS instead")
+            if self.stop_sig.isSet():
+                return
+        if len(self.folders) <= self.connections:
+            idlefolders, pollfolders = self.folders, []
+        else:
+            idlefolders = self.folders[:self.connections - 1]
+            pollfolders = self.folders[self.connections - 1:]
+        for folder in idlefolders:
+            idler = IdleThread(self.parent, folder)
+            idler.start()
+            self.idlers.append(idler)
+        if pollfolders:
+            self.poll(pollfolders)
+
+    def poll(self, folders):
+        """Poll the STATUS of folders until self.stop() is invoked"""
+        while not self.stop_sig.isSet():
+            try:
+                statuses = self.parent.getstatus(folders, self.STATUS_ITEMS)
+            except OfflineImapError as e:
+                self.ui.error(e, exc_info()[2])
+            else:
+                for folder in self.changedfolders(statuses):
+                    self.parent.syncpushedfolder(folder)
+            self.stop_sig.wait(self.parent.pushpollinterval)
+
+    def notify(self):
+        """Have the server NOTIFY us of changes until self.stop()
+
+        The first folder is selected, so that we can IDLE to wait for
+        notifications. Its changes are reported like with IDLE, those
+        of the other folders as STATUS responses. NOTIFY SET STATUS also
+        reports the STATUS of all other folders whenever we start
+        watching again after syncing, so changes in between are not
+        missed. Errors other than a lost connection are raised for
+        push() to fall back to IDLE and STATUS."""
+        def callback(args):
+            """IDLE callback function invoked by imaplib2, see IdleThread"""
+            result, cb_arg, exc_data = args
+            if exc_data is None and not self.stop_sig.isSet():
+                self.needsync = True
+            self.stop_sig.set() # continue to sync
+
+        selected, others = self.folders[0], self.folders[1:]
+        while not self.stop_sig.isSet():
+            self.needsync = False
+            changed = []
+            imapobj = self.parent.acquireconnection()
+            drop = False
+            try:
+                imapobj.select(selected, readonly = True)
+                filters = ['(selected %s)' % self.NOTIFY_EVENTS]
+                if others:
+                    filters.append('(mailboxes (%s) %s)' % (' '.join(
+                                [imapobj._quote(folder) for folder in others]),
+                                self.NOTIFY_EVENTS))
+                typ, dat = imapobj.xatom('NOTIFY', 'SET', 'STATUS', *filters)
+                if typ != 'OK':
+                    raise OfflineImapError("NOTIFY on server '%s' failed: %s" %
+                        (self.parent.repos, dat), OfflineImapError.ERROR.REPO)
+                # changes while we were not watching
+                changed = self.changedfolders(self._popstatuses(imapobj))
+                if not changed:
+                    imapobj.idle(callback=callback)
+                    self.stop_sig.wait()
+                # End IDLE mode with NOTIFY NONE, which also keeps further
+                # notifications from whoever uses the connection next
+                imapobj.xatom('NOTIFY', 'NONE')
+                if self.needsync:
+                    for response in ('EXISTS', 'EXPUNGE', 'VANISHED', 'FETCH'):
+                        if imapobj._get_untagged_response(response):
+                            changed.append(selected)
+                            break
+                    changed.extend(self.changedfolders(
+                            self._popstatuses(imapobj)))
+            except imapobj.abort as e:
+                self.ui.error(e, exc_info()[2])
+                drop = True
+            except:
+                # NOTIFY may still be set, don't pass on the connection
+                drop = True
+                raise
+            finally:
+                self.parent.releaseconnection(imapobj, drop)
+            if self.needsync:
+                # not via self.stop(), but because the server notified us
+                self.stop_sig.clear()
+            for folder in changed:
+                self.parent.syncpushedfolder(folder)
+
+    def _popstatuses(self, imapobj):
+        """Return the untagged STATUS responses as dict of name -> items"""
+        statuses = {}
+        for statusdata in imapobj._get_untagged_response('STATUS') or []:
+            status = imaputil.statussplit(statusdata)
+            if status is not None:
+                statuses[status[0]] = status[1]
+        return statuses
@@ -28,6 +28,15 @@ quotere = re.compile(
         \s*(?P<rest>.*)$           # Whitespace & remainder of string""",
     re.VERBOSE)
 
+# one "NAME value" data item of a FETCH response, see fetch2hash()
+fetchitemre = re.compile(
+    r"""\s*(?P<name>[^\s()\[\]{}"]+(?:\[[^\]]*\](?:<\d+>)?)?) # e.g. BODY[]<0>
+        \s+(?P<value>\((?:[^()"]|"(?:\\.|[^"\\])*")*\)        # list, not nested
+                    |"(?:\\.|[^"\\])*"                        # quoted string
+                    |\{\d+\}                                  # literal
+                    |[^\s()]+)                                # atom or number""",
+    re.VERBOSE)
+
 def debug(*args):
     msg = []
     for arg in args:
@@ -77,6 +86,41 @@ def flags2hash(flags):
     {'FLAGS': '(\\Seen Old)', 'UID': '4807'}"""
     return options2hash(flagsplit(flags))
 
+def fetch2hash(fetchdata):
+    """Converts the data items of a FETCH response to a hash.
+
+    This gives the same result as flags2hash(), but uses a precompiled
+    expression and no debug output, as it is run for every message of
+    a folder. E.g. '(FLAGS (\\Seen Old) UID 4807)' leads to
+    {'FLAGS': '(\\Seen Old)', 'UID': '4807'}. If fetchdata is a
+    (header, literal) tuple, as imaplib2 returns responses containing
+    a literal, that item's value is the literal. Responses with nested
+    lists (e.g. BODYSTRUCTURE) are handed to imapsplit()."""
+    literal = None
+    if not isinstance(fetchdata, basestring):
+        fetchdata, literal = fetchdata
+    if fetchdata[0] != '(':
+        raise ValueError("Passed string '%s' is not a FETCH response" %
+                         fetchdata)
+    end = len(fetchdata.rstrip())
+    if fetchdata[end - 1] == ')':
+        end -= 1 # a header ending in a literal lacks the closing paren
+    retval = {}
+    pos = 1
+    match = fetchitemre.match
+    while pos < end:
+        mo = match(fetchdata, pos, end)
+        if mo is None:
+            retval = options2hash(imapsplit(fetchdata[1:end]))
+            break
+        retval[mo.group('name')] = mo.group('value')
+        pos = mo.end()
+    if literal is not None:
+        for name, value in retval.items():
+            if value[0] == '{':
+                retval[name] = literal
+    return retval
+
 def imapsplit(imapstring):
     """Takes a string from an IMAP conversation and returns a list containing
     its components.  One example string is:
@@ -172,13 +216,13 @@ flagmap = [('\\Seen', 'S'),
            ('\\Deleted', 'T'),
            ('\\Draft', 'D')]
 
+flagmapimap2maildir = dict(flagmap)
+
 def flagsimap2maildir(flagstring):
     """Convert string '(\\Draft \\Deleted)' into a flags set(DR)"""
-    retval = set()
-    imapflaglist = flagstring[1:-1].split()
-    for imapflag, maildirflag in flagmap:
-        if imapflag in imapflaglist:
-            retval.add(maildirflag)
+    get = flagmapimap2maildir.get
+    retval = set([get(imapflag) for imapflag in flagstring[1:-1].split()])
+    retval.discard(None)
     return retval
 
 def flagsmaildir2imap(maildirflaglist):
@@ -218,3 +262,80 @@ def uid_sequence(uidlist):
 
     retval.append(getrange(start, end)) # Add final range/item
     return ",".join(retval)
+
+def uid_sequence_expand(seqset):
+    """Expand a sequence set into a list of UIDs
+
+    This is the reverse of uid_sequence(): "1:3,10,13:12" will return
+    [1, 2, 3, 10, 12, 13]. Ranges may be given in either order, the
+    items are returned in the order of the sequence set.
+    :returns: The UIDs as list of longs"""
+    retval = []
+    for item in seqset.split(','):
+        if ':' in item:
+            start, end = sorted(map(long, item.split(':', 1)))
+            retval.extend(xrange(start, end + 1))
+        elif item:
+            retval.append(long(item))
+    return retval
+
+def uid_sequence_chunks(uidlist, maxlen):
+    """Collapse UID lists into sequence sets of limited length
+
+    Like uid_sequence(), but the collapsed set is split between ranges
+    so that no sequence set is longer than maxlen characters, e.g. for
+    servers with a limited command line length.
+    :returns: List of sequence set strings"""
+    chunks, chunk, chunklen = [], [], 0
+    if not len(uidlist): return chunks
+    for item in uid_sequence(uidlist).split(','):
+        if chunk and chunklen + len(item) + 1 > maxlen:
+            chunks.append(",".join(chunk))
+            chunk, chunklen = [], 0
+        if chunk:
+            chunklen += 1
+        chunklen += len(item)
+        chunk.append(item)
+    chunks.append(",".join(chunk))
+    return chunks
+
+def flagchanges2groups(changes, perflag=False):
+    """Group the flag changes of messages for applying them in bulk
+
+    :param changes: dict of uid -> (addflags, delflags), each a set of
+        maildir flags to add to, or remove from the message.
+    :param perflag: group the messages by single flag rather than by the
+        complete set of flags added or removed.
+    :returns: List of (operation, flags, uidlist) tuples, operation being
+        '+' or '-'. Additions come before removals."""
+    groups = {}
+    for uid, (addflags, delflags) in changes.items():
+        for operation, flags in (('+', addflags), ('-', delflags)):
+            if not flags:
+                continue
+            if perflag:
+                keys = [(operation, flag) for flag in flags]
+            else:
+                keys = [(operation, ''.join(sorted(flags)))]
+            for key in keys:
+                groups.setdefault(key, []).append(uid)
+    return [(operation, set(flags), sorted(uids))
+            for (operation, flags), uids in sorted(groups.items())]
+
+def statussplit(statusdata):
+    """Parse the data of an untagged STATUS response
+
+    E.g. '"INBOX" (MESSAGES 231 UIDNEXT 44292)' returns
+    ('INBOX', {'MESSAGES': 231, 'UIDNEXT': 44292}).
+    :returns: Tuple of the dequoted mailbox name and a dict of the status
+              items, or None if the response could not be parsed"""
+    if not isinstance(statusdata, basestring):
+        # mailbox names sent as literal
+        return None
+    parts = imapsplit(statusdata)
+    if len(parts) != 2:
+        return None
+    items = {}
+    for key, value in options2hash(flagsplit(parts[1])).items():
+        items[key.upper()] = long(value)
+    return dequote(parts[0]), items
@@ -319,14 +319,13 @@ class OfflineImap:
             config.getdefaultint('general', 'maxsyncaccounts', 1))
 
         for reposname in config.getsectionlist('Repository'):
-            for instancename in ["FOLDER_" + reposname,
-                                 "MSGCOPY_" + reposname]:
-                if options.singlethreading:
-                    threadutil.initInstanceLimit(instancename, 1)
-                else:
-                    threadutil.initInstanceLimit(instancename,
-                        config.getdefaultint('Repository ' + reposname,
-                                                  'maxconnections', 2))
+            if options.singlethreading:
+                limit = 1
+            else:
+                limit = config.getdefaultint('Repository ' + reposname,
+                                             'maxconnections', 2)
+            threadutil.initInstanceLimit("FOLDER_" + reposname, limit)
+            threadutil.initWorkerPool("MSGCOPY_" + reposname, limit)
         self.config = config
         return (options, args)
 
@@ -398,6 +397,7 @@ class OfflineImap:
                                            'config': self.config})
                 t.start()
                 threadutil.exitnotifymonitorloop(threadutil.threadexited)
+            threadutil.shutdownWorkerPools()
             self.ui.terminate()
         except (SystemExit):
             raise
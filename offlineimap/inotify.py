@@ -0,0 +1,128 @@
+# Copyright (C) 2013 John Goerzen & contributors
+# Minimal access to the Linux inotify API through ctypes
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+import errno
+import os
+import select
+import struct
+try:
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                       ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+except (ImportError, OSError, AttributeError):
+    libc = None # not Linux, fail only if needed later on
+
+# events, see inotify(7)
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+# flags of inotify_init1()
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# struct inotify_event without the name that follows it
+EVENT = struct.Struct('iIII')
+
+
+def available():
+    """:returns: True if inotify can be used on this platform"""
+    return libc is not None
+
+
+def _raiseerrno(filename=None):
+    err = ctypes.get_errno()
+    if filename is None:
+        raise OSError(err, os.strerror(err))
+    raise OSError(err, os.strerror(err), filename)
+
+
+class Inotify(object):
+    """An inotify instance with the watches added to it
+
+    Events are only read on request, by read() or wait(), so there is
+    no thread involved. The kernel queues them meanwhile and reports
+    IN_Q_OVERFLOW once its queue is full."""
+
+    def __init__(self):
+        if libc is None:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            _raiseerrno()
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        """Watch path for the events in mask
+
+        :returns: the watch descriptor reported with its events"""
+        wd = libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            _raiseerrno(path)
+        return wd
+
+    def rm_watch(self, wd):
+        if libc.inotify_rm_watch(self.fd, wd) < 0:
+            _raiseerrno()
+
+    def read(self):
+        """Read the events queued so far, without blocking
+
+        :returns: list of (watch descriptor, mask, cookie, name)"""
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return events
+                raise
+            offset = 0
+            while offset + EVENT.size <= len(data):
+                wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+                offset += EVENT.size
+                name = data[offset:offset + length].rstrip('\0')
+                offset += length
+                events.append((wd, mask, cookie, name))
+
+    def wait(self, timeout=None):
+        """Wait up to timeout seconds for events to be queued
+
+        :returns: True if there are events to read"""
+        try:
+            readable = select.select([self.fd], [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return False
+            raise
+        return bool(readable)
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
@@ -0,0 +1,431 @@
+# Copyright (C) 2013 John Goerzen & contributors
+# Compact message lists for the folder backends
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+from array import array
+from bisect import bisect_left
+from itertools import imap, izip
+from threading import RLock
+
+# Maildir flags are stored as bits. Messages with other flags have all
+# of their flags kept aside.
+FLAGBITS = dict((flag, 1 << bit) for bit, flag in enumerate('DFPRST'))
+EXTRAFLAGS = 0x40
+DELETED = 0x80
+MASKFLAGS = [frozenset(flag for flag, bit in FLAGBITS.items() if mask & bit)
+             for mask in range(EXTRAFLAGS)] + [None] * (256 - EXTRAFLAGS)
+
+# array('l') only holds 32 bit numbers on some platforms, too few for
+# UIDs and X-GM-MSGIDs
+if array('l').itemsize >= 8:
+    def intarray(values=()):
+        return array('l', values)
+else:
+    intarray = list
+
+
+class FloatColumn(object):
+    """Numbers with a fraction, i.e. times. None is stored as NaN."""
+    def __init__(self, values=()):
+        self.values = array('d', values)
+
+    def get(self, row):
+        value = self.values[row]
+        if value != value:
+            return None
+        return value
+
+    def encode(self, value):
+        if value is None:
+            return float('nan')
+        return value
+
+    def set(self, row, value):
+        self.values[row] = self.encode(value)
+
+    def append(self, value):
+        self.values.append(self.encode(value))
+
+    def select(self, rows):
+        values = self.values
+        return self.__class__(values[row] for row in rows)
+
+
+class IntColumn(FloatColumn):
+    """Non-negative integers, e.g. sizes. None is stored as -1."""
+    def __init__(self, values=()):
+        self.values = intarray(values)
+
+    def get(self, row):
+        value = self.values[row]
+        if value < 0:
+            return None
+        return value
+
+    def encode(self, value):
+        if value is None:
+            return -1
+        return value
+
+
+class StringColumn(object):
+    """Byte strings, i.e. file names, stored back to back in one buffer
+
+    A changed string is appended to the buffer, which is compacted once
+    more than half of it is taken by strings no longer in use."""
+    def __init__(self, values=()):
+        self.buffer = bytearray()
+        self.offsets = intarray()
+        self.lengths = array('I')
+        self.unused = 0
+        for value in values:
+            self.append(value)
+
+    def get(self, row):
+        offset = self.offsets[row]
+        if offset < 0:
+            return None
+        return str(self.buffer[offset:offset + self.lengths[row]])
+
+    def _store(self, value):
+        if value is None:
+            return -1, 0
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        offset = len(self.buffer)
+        self.buffer.extend(value)
+        return offset, len(value)
+
+    def set(self, row, value):
+        if self.offsets[row] >= 0:
+            self.unused += self.lengths[row]
+        self.offsets[row], self.lengths[row] = self._store(value)
+        if self.unused > 65536 and self.unused * 2 > len(self.buffer):
+            compacted = self.select(xrange(len(self.offsets)))
+            self.__dict__.update(compacted.__dict__)
+
+    def append(self, value):
+        offset, length = self._store(value)
+        self.offsets.append(offset)
+        self.lengths.append(length)
+
+    def select(self, rows):
+        return StringColumn(self.get(row) for row in rows)
+
+
+class ObjectColumn(object):
+    """Any other values, e.g. database ids"""
+    def __init__(self, values=()):
+        self.values = list(values)
+
+    def get(self, row):
+        return self.values[row]
+
+    def set(self, row, value):
+        self.values[row] = value
+
+    def append(self, value):
+        self.values.append(value)
+
+    def select(self, rows):
+        values = self.values
+        return ObjectColumn(values[row] for row in rows)
+
+
+COLUMNS = {'time': FloatColumn,
+           'size': IntColumn,
+           'gmmsgid': IntColumn,
+           'filename': StringColumn,
+           '_id': ObjectColumn}
+
+
+class Message(object):
+    """A message of a MessageList, used like the dicts folders used to keep
+
+    Its fields are looked up in the MessageList on every access. Fields
+    that are not set read as None and are not 'in' the message."""
+    __slots__ = ('messagelist', 'uid')
+
+    def __init__(self, messagelist, uid):
+        self.messagelist = messagelist
+        self.uid = uid
+
+    def __getitem__(self, field):
+        return self.messagelist.getfield(self.uid, field)
+
+    def __setitem__(self, field, value):
+        self.messagelist.setfield(self.uid, field, value)
+
+    def get(self, field, default=None):
+        value = self[field]
+        if value is None:
+            return default
+        return value
+
+    def __contains__(self, field):
+        return self[field] is not None
+
+    def items(self):
+        return [(field, value) for field, value in
+                self.messagelist.getfields(self.uid).items()
+                if value is not None]
+
+    def copy(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        return self.copy() == dict(other.items())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self.copy())
+
+
+class MessageList(object):
+    """A message list kept in parallel arrays rather than in dicts
+
+    Maps UIDs to messages just like the dict of dicts the folders used
+    to keep, e.g. messagelist[uid]['flags'], but takes a few dozen bytes
+    per message rather than several hundred. UIDs are kept in a sorted
+    array, the Maildir flags as a bitmask and the other fields in arrays
+    (times, sizes), a string buffer (file names) or a list (others).
+
+    Messages are usually added in UID order and simply appended. Others
+    are appended, too, and the arrays are sorted when a message is
+    looked up next. A folder can thus be loaded in any order without
+    sorting after each message. Deleted messages are marked as such and
+    removed once they make up half of the arrays.
+
+    It is safe to use a MessageList from several threads."""
+
+    def __init__(self, *fields):
+        """:param fields: the fields besides 'uid' and 'flags', out of
+            'time', 'size', 'gmmsgid', 'filename' and '_id'"""
+        self.fields = ('uid', 'flags') + fields
+        self.lock = RLock()
+        self.uids = intarray()
+        self.flags = array('B')
+        # UID -> all flags of messages with flags not in FLAGBITS
+        self.extraflags = {}
+        self.columns = dict((field, COLUMNS[field]()) for field in fields)
+        self.deleted = 0
+        self.unsorted = False
+        # changed with every change to the messages, so that others can
+        # tell whether what they derived from them is still up to date
+        self.version = 0
+
+    def _select(self, rows):
+        """Keep only the given rows, in the given order"""
+        uids, flags = self.uids, self.flags
+        self.uids = intarray(uids[row] for row in rows)
+        self.flags = array('B', (flags[row] for row in rows))
+        for field, column in self.columns.items():
+            self.columns[field] = column.select(rows)
+        self.deleted = 0
+
+    def _sort(self):
+        """Sort the arrays by UID, dropping deleted and replaced rows"""
+        uids = self.uids
+        order = sorted(xrange(len(uids)), key=uids.__getitem__)
+        rows = []
+        for i, row in enumerate(order):
+            # of several rows for a UID, the last one added counts
+            if i + 1 < len(order) and uids[order[i + 1]] == uids[row]:
+                continue
+            if not self.flags[row] & DELETED:
+                rows.append(row)
+        self._select(rows)
+        self.unsorted = False
+
+    def _findrow(self, uid):
+        """:returns: the row of a UID, even if deleted, or None"""
+        if self.unsorted:
+            self._sort()
+        uids = self.uids
+        row = bisect_left(uids, uid)
+        if row < len(uids) and uids[row] == uid:
+            return row
+        return None
+
+    def _find(self, uid):
+        """:returns: the row of a message or raises KeyError"""
+        row = self._findrow(uid)
+        if row is None or self.flags[row] & DELETED:
+            raise KeyError(uid)
+        return row
+
+    def _encodeflags(self, uid, flags):
+        mask = 0
+        for flag in flags:
+            bit = FLAGBITS.get(flag)
+            if bit is None:
+                self.extraflags[uid] = frozenset(flags)
+                return EXTRAFLAGS
+            mask |= bit
+        self.extraflags.pop(uid, None)
+        return mask
+
+    def _decodeflags(self, uid, mask):
+        if mask & EXTRAFLAGS:
+            return self.extraflags[uid]
+        return MASKFLAGS[mask]
+
+    def __setitem__(self, uid, message):
+        """Add or replace a message, given as a dict of its fields"""
+        fields = dict(message.items())
+        with self.lock:
+            self.version += 1
+            uids = self.uids
+            row = None
+            if uids and not self.unsorted and uid <= uids[-1]:
+                row = self._findrow(uid)
+            mask = self._encodeflags(uid, fields.get('flags', ()))
+            if row is None:
+                if uids and uid <= uids[-1]:
+                    self.unsorted = True
+                uids.append(uid)
+                self.flags.append(mask)
+                for field, column in self.columns.items():
+                    column.append(fields.get(field))
+            else:
+                if self.flags[row] & DELETED:
+                    self.deleted -= 1
+                self.flags[row] = mask
+                for field, column in self.columns.items():
+                    column.set(row, fields.get(field))
+
+    def __delitem__(self, uid):
+        with self.lock:
+            row = self._find(uid)
+            self.version += 1
+            self.flags[row] = DELETED
+            self.extraflags.pop(uid, None)
+            self.deleted += 1
+            if self.deleted > 64 and self.deleted * 2 > len(self.uids):
+                self._select([row for row, mask in enumerate(self.flags)
+                              if not mask & DELETED])
+
+    def __getitem__(self, uid):
+        with self.lock:
+            self._find(uid)
+        return Message(self, uid)
+
+    def __contains__(self, uid):
+        with self.lock:
+            row = self._findrow(uid)
+            return row is not None and not self.flags[row] & DELETED
+
+    def __len__(self):
+        with self.lock:
+            if self.unsorted:
+                self._sort()
+            return len(self.uids) - self.deleted
+
+    def __nonzero__(self):
+        return len(self) > 0
+
+    def getfield(self, uid, field):
+        """:returns: a field of a message, None if it is not set"""
+        with self.lock:
+            row = self._find(uid)
+            if field == 'uid':
+                return uid
+            if field == 'flags':
+                return set(self._decodeflags(uid, self.flags[row]))
+            column = self.columns.get(field)
+            if column is None:
+                return None
+            return column.get(row)
+
+    def getfields(self, uid):
+        """:returns: the fields of a message as dict"""
+        with self.lock:
+            row = self._find(uid)
+            fields = dict((field, column.get(row)) for field, column in
+                          self.columns.items())
+            fields['uid'] = uid
+            fields['flags'] = set(self._decodeflags(uid, self.flags[row]))
+            return fields
+
+    def setfield(self, uid, field, value):
+        with self.lock:
+            row = self._find(uid)
+            self.version += 1
+            if field == 'flags':
+                self.flags[row] = self._encodeflags(uid, value)
+            elif field in self.columns:
+                self.columns[field].set(row, value)
+            elif field != 'uid':
+                raise KeyError("Message lists of this folder have no "
+                               "field '%s'" % field)
+
+    def getflagdict(self):
+        """:returns: dict mapping all UIDs to their flags as frozensets
+
+        Messages with the same flags share the frozenset."""
+        with self.lock:
+            if self.unsorted:
+                self._sort()
+            if self.deleted:
+                self._select([row for row, mask in enumerate(self.flags)
+                              if not mask & DELETED])
+            flagdict = dict(izip(self.uids,
+                                 imap(MASKFLAGS.__getitem__, self.flags)))
+            flagdict.update(self.extraflags)
+        return flagdict
+
+    def keys(self):
+        with self.lock:
+            if self.unsorted:
+                self._sort()
+            if not self.deleted:
+                return list(self.uids)
+            return [uid for uid, mask in izip(self.uids, self.flags)
+                    if not mask & DELETED]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    iterkeys = __iter__
+
+    def values(self):
+        return [Message(self, uid) for uid in self.keys()]
+
+    def itervalues(self):
+        return (Message(self, uid) for uid in self.keys())
+
+    def items(self):
+        return [(uid, Message(self, uid)) for uid in self.keys()]
+
+    def iteritems(self):
+        return ((uid, Message(self, uid)) for uid in self.keys())
+
+    def get(self, uid, default=None):
+        if uid in self:
+            return Message(self, uid)
+        return default
+
+    def pop(self, uid, *default):
+        with self.lock:
+            if not uid in self:
+                if default:
+                    return default[0]
+                raise KeyError(uid)
+            message = self.getfields(uid)
+            del self[uid]
+        return message
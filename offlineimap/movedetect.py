@@ -0,0 +1,180 @@
+# Copyright (C) 2013 John Goerzen & contributors
+# Detection of messages moved between the folders of an account
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+import re
+from sys import exc_info
+from threading import Lock
+from offlineimap import OfflineImapError
+from offlineimap.ui import getglobalui
+
+messageidre = re.compile(r'^message-id:\s*(\S+)', re.IGNORECASE | re.MULTILINE)
+# bytes of a message file read at once by getcrlffilesize()
+CHUNKSIZE = 65536
+
+def getmessageid(headers):
+    """Return the Message-ID of the given message headers, or None"""
+    mo = messageidre.search(headers)
+    if mo is None:
+        return None
+    return mo.group(1)
+
+def readheaders(file):
+    """Read the headers of a message file, up to the empty line"""
+    headers = []
+    while True:
+        line = file.readline()
+        if line in ('', '\n', '\r\n'):
+            return ''.join(headers)
+        headers.append(line)
+
+def getcrlffilesize(file, size):
+    """Size of a message file with CRLF line endings
+
+    This is the size IMAP reports as RFC822.SIZE, i.e. each bare newline
+    counts as two bytes. The file is read in chunks from its current
+    position on, so that bare newlines can be counted without holding
+    the message in memory.
+
+    :param size: the size of the whole file"""
+    lastchar = ''
+    while True:
+        chunk = file.read(CHUNKSIZE)
+        if not chunk:
+            return size
+        size += chunk.count('\n') - chunk.count('\r\n')
+        if lastchar == '\r' and chunk[0] == '\n':
+            size -= 1
+        lastchar = chunk[-1]
+
+
+class MoveDetector(object):
+    """Turns deletions and new messages in different folders into moves
+
+    A message moved from one folder to another shows up as a deletion
+    in the first folder and as a new message in the second. Rather than
+    deleting the message on the other side, the folder that would
+    delete it stashes it, keyed by its Message-ID and size. When the
+    message turns up as a new message in another folder of the same
+    account, the stashed copy is moved there instead of transferring
+    the message body again. Stashed messages that were not claimed are
+    deleted by finish().
+
+    Moves are only detected if the folder the message was moved from
+    is synced before the folder it was moved to. Otherwise, the message
+    is transferred as usual."""
+
+    def __init__(self):
+        self.ui = getglobalui()
+        self.lock = Lock()
+        # (messageid, size) -> list of stashed (folder, handle) tuples
+        self.stash = {}
+        # all stashed (folder, handle) tuples, to be dropped by finish()
+        self.stashed = []
+
+    def stashmessages(self, folder, uidlist):
+        """Stash messages that are about to be deleted from folder
+
+        :returns: the UIDs that were not stashed and still need to be
+            deleted the usual way"""
+        keys = folder.getmessagekeys(uidlist)
+        if not keys:
+            return uidlist
+        handles = folder.stashmessages(keys.keys())
+        with self.lock:
+            for uid, handle in handles.items():
+                self.stash.setdefault(keys[uid], []).append((folder, handle))
+                self.stashed.append((folder, handle))
+        return [uid for uid in uidlist if not uid in handles]
+
+    def _takestashed(self, key, dstfolder):
+        """Take a stashed message that dstfolder can move into itself"""
+        with self.lock:
+            entries = self.stash.get(key, [])
+            for entry in entries:
+                if entry[0].repository is dstfolder.repository:
+                    entries.remove(entry)
+                    return entry
+        return None
+
+    def _putstashed(self, key, entry):
+        with self.lock:
+            self.stash.setdefault(key, []).append(entry)
+
+    def movemessagesto(self, srcfolder, uidlist, dstfolder, statusfolder):
+        """Move stashed copies of new messages into dstfolder
+
+        For the new messages uidlist in srcfolder, look for a stashed
+        message with the same Message-ID and size on dstfolder's side
+        and move it into dstfolder, updating statusfolder.
+
+        :returns: the UIDs that were not moved and still need to be
+            copied the usual way"""
+        with self.lock:
+            if not self.stash:
+                return uidlist
+        keys = srcfolder.getmessagekeys(uidlist)
+        remaining = []
+        for uid in uidlist:
+            entry = None
+            if uid in keys:
+                entry = self._takestashed(keys[uid], dstfolder)
+            if entry is None:
+                remaining.append(uid)
+                continue
+            folder, handle = entry
+            flags = srcfolder.getmessageflags(uid)
+            rtime = srcfolder.getmessagetime(uid)
+            self.ui.movingmessage(uid, folder, dstfolder)
+            try:
+                new_uid = dstfolder.savemessage_moved(uid, folder, handle,
+                                                      flags, rtime)
+            except OfflineImapError as e:
+                if e.severity > OfflineImapError.ERROR.MESSAGE:
+                    raise
+                self.ui.error(e, exc_info()[2])
+                new_uid = None
+            if new_uid is None:
+                # could not be moved, fall back to copying it
+                self._putstashed(keys[uid], entry)
+                remaining.append(uid)
+            elif new_uid > 0:
+                if new_uid != uid:
+                    srcfolder.change_message_uid(uid, new_uid)
+                    statusfolder.deletemessage(uid)
+                statusfolder.savemessage(new_uid, None, flags, rtime)
+            else:
+                # moved, but the new UID is unknown. As in copymessageto(),
+                # delete our copy and get it back on the next run.
+                srcfolder.deletemessage(uid)
+        return remaining
+
+    def finish(self):
+        """Delete all stashed messages for good
+
+        Messages that were moved elsewhere are skipped by the folders."""
+        with self.lock:
+            stashed, self.stashed, self.stash = self.stashed, [], {}
+        byfolder = {}
+        for folder, handle in stashed:
+            byfolder.setdefault(folder, []).append(handle)
+        for folder, handles in byfolder.items():
+            try:
+                folder.dropstashedmessages(handles)
+            except OfflineImapError as e:
+                if e.severity > OfflineImapError.ERROR.FOLDER:
+                    raise
+                self.ui.error(e, exc_info()[2])
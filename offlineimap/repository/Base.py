@@ -16,6 +16,7 @@
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
 import re
+import errno
 import os.path
 import traceback
 from sys import exc_info
@@ -39,6 +40,9 @@ class BaseRepository(CustomConfig.ConfigHelperMixin, object):
         self.mapdir = os.path.join(self.uiddir, 'UIDMapping')
         if not os.path.exists(self.mapdir):
             os.mkdir(self.mapdir, 0o700)
+        # only created by the folders that use them, see getcachedir()
+        self.cachedir = os.path.join(self.uiddir, 'MessageCache')
+        self.statusdir = os.path.join(self.uiddir, 'FolderStatus')
         self.uiddir = os.path.join(self.uiddir, 'FolderValidity')
         if not os.path.exists(self.uiddir):
             os.mkdir(self.uiddir, 0o700)
@@ -83,6 +87,13 @@ class BaseRepository(CustomConfig.ConfigHelperMixin, object):
     def dropconnections(self):
         pass
 
+    def close(self):
+        """Release what the repository holds on to between syncs
+
+        Called once the account stops syncing. The default does
+        nothing."""
+        pass
+
     def getaccount(self):
         return self.account
 
@@ -103,6 +114,26 @@ class BaseRepository(CustomConfig.ConfigHelperMixin, object):
     def getmapdir(self):
         return self.mapdir
 
+    def _makedir(self, path):
+        """Create directory path unless it exists, e.g. created meanwhile
+        by another folder's thread"""
+        try:
+            os.mkdir(path, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        return path
+
+    def getcachedir(self):
+        """:returns: the directory of the message list caches and scan
+        indexes of the folders, created on first use"""
+        return self._makedir(self.cachedir)
+
+    def getstatusdir(self):
+        """:returns: the directory of the STATUS the folders had at their
+        last sync, created on first use"""
+        return self._makedir(self.statusdir)
+
     def getsection(self):
         return 'Repository ' + self.name
 
@@ -126,6 +157,26 @@ class BaseRepository(CustomConfig.ConfigHelperMixin, object):
         after a sync run."""
         pass
 
+    def prepare_quickchanged(self, folders):
+        """Prepare the quickchanged() checks of the given folders
+
+        Repositories that can check many folders more cheaply at once
+        than one by one do so here. The default does nothing."""
+        pass
+
+    def savesyncstate(self, remotefolder, localfolder=None, statusfolder=None):
+        """Keep the folders of a completed folder sync for later updates
+
+        Repositories that are notified of changes (e.g. by IMAP IDLE)
+        may keep the folders with their loaded message lists, to apply
+        the changes without loading everything again. See
+        :func:`offlineimap.accounts.syncfolder_changes`. The default
+        keeps nothing.
+
+        :param localfolder: None to forget the folders kept for
+            remotefolder, e.g. as a sync of it starts."""
+        pass
+
     def getsep(self):
         raise NotImplementedError
 
@@ -15,6 +15,7 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
+from threading import Lock
 from offlineimap.repository.IMAP import IMAPRepository
 from offlineimap import folder, OfflineImapError
 
@@ -35,6 +36,9 @@ class GmailRepository(IMAPRepository):
         account.getconfig().set('Repository ' + reposname,
                                 'ssl', 'yes')
         IMAPRepository.__init__(self, reposname, account)
+        # X-GM-MSGID -> (local folder, uid) of messages stored locally
+        self._storedmessages = {}
+        self._storedmessageslock = Lock()
 
     def gethost(self):
         """Return the server name to connect to.
@@ -72,3 +76,19 @@ class GmailRepository(IMAPRepository):
         #: Gmail also deletes messages upon EXPUNGE in the Spam folder
         return  self.getconf('spamfolder','[Gmail]/Spam')
 
+    def getdeduplicate(self):
+        return self.getconfboolean('deduplicate', 0)
+
+    def addstoredmessage(self, gmmsgid, folder, uid):
+        """Remember that a local folder stores the message gmmsgid
+
+        The first folder registered for a message is kept."""
+        with self._storedmessageslock:
+            self._storedmessages.setdefault(gmmsgid, (folder, uid))
+
+    def getstoredmessage(self, gmmsgid):
+        """Return the (local folder, uid) storing message gmmsgid or None
+
+        The folder may have lost the message meanwhile."""
+        with self._storedmessageslock:
+            return self._storedmessages.get(gmmsgid)
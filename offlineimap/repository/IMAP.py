@@ -185,14 +185,49 @@ class IMAPRepository(BaseRepository):
         localeval = self.localeval
         return localeval.eval(self.getconf('idlefolders', '[]'))
 
+    def getpushconnections(self):
+        return self.getconfint('pushconnections', 0)
+
+    def getpushpollinterval(self):
+        return self.getconfint('pushpollinterval', 60)
+
     def getmaxconnections(self):
         num1 = len(self.getidlefolders())
+        if self.getpushconnections():
+            num1 = min(num1, self.getpushconnections())
         num2 = self.getconfint('maxconnections', 1)
         return max(num1, num2)
 
     def getexpunge(self):
         return self.getconfboolean('expunge', 1)
 
+    def getcompress(self):
+        return self.getconfboolean('compress', 0)
+
+    def getcondstore(self):
+        return self.getconfboolean('condstore', 0)
+
+    def getmessagelistchunksize(self):
+        return self.getconfint('messagelistchunksize', 0)
+
+    def getmaxlinelength(self):
+        return self.getconfint('maxlinelength', 8192)
+
+    def getstreamthreshold(self):
+        return self.getconfint('streamthreshold', 0)
+
+    def getquickstatus(self):
+        return self.getconfboolean('quickstatus', 0)
+
+    def getfetchbatchsize(self):
+        return self.getconfint('fetchbatchsize', 1)
+
+    def getappendbatchsize(self):
+        return self.getconfint('appendbatchsize', 1)
+
+    def getfetchbatchbytes(self):
+        return self.getconfint('fetchbatchbytes', 4194304)
+
     def getpassword(self):
         """Return the IMAP password for this repository.
 
@@ -261,6 +296,37 @@ class IMAPRepository(BaseRepository):
     def forgetfolders(self):
         self.folders = None
 
+    def savesyncstate(self, remotefolder, localfolder=None, statusfolder=None):
+        """Keep the folders of idlefolders for the IDLE threads"""
+        name = remotefolder.getname()
+        if localfolder is None:
+            self.imapserver.syncstates.pop(name, None)
+        elif name in self.imapserver.idlefolders:
+            self.imapserver.syncstates[name] = \
+                (remotefolder, localfolder, statusfolder)
+
+    def prepare_quickchanged(self, folders):
+        """Fetch the STATUS of all folders at once for quickchanged()
+
+        Only done if 'quickstatus' is enabled. Folders we get no STATUS
+        for fall back to SELECTing them in quickchanged()."""
+        for folder in folders:
+            # may be kept from the last sync
+            folder.quickstatus = None
+        if not self.getquickstatus():
+            return
+        names = [folder.getfullname() for folder in folders]
+        try:
+            statuses = self.imapserver.getstatus(names, ('MESSAGES',
+                'UIDNEXT', 'UIDVALIDITY', 'HIGHESTMODSEQ'))
+        except OfflineImapError as e:
+            if e.severity > OfflineImapError.ERROR.REPO:
+                raise
+            self.ui.error(e, exc_info()[2], 'Fetching folder STATUS failed:')
+            return
+        for folder in folders:
+            folder.quickstatus = statuses.get(folder.getfullname())
+
     def getfolders(self):
         if self.folders != None:
             return self.folders
@@ -16,23 +16,31 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
-from offlineimap.folder.LocalStatus import LocalStatusFolder, magicline
+from offlineimap.folder.LocalStatus import LocalStatusFolder, magicline, \
+    journalsuffix
 from offlineimap.folder.LocalStatusSQLite import LocalStatusSQLiteFolder
+from offlineimap.folder.LocalStatusSQLiteAccount import \
+    LocalStatusSQLiteAccountFolder, StatusDatabase
 from offlineimap.repository.Base import BaseRepository
 import os
 import re
+from threading import Lock
 
 class LocalStatusRepository(BaseRepository):
     def __init__(self, reposname, account):
         BaseRepository.__init__(self, reposname, account)
         # Root directory in which the LocalStatus folders reside
         self.root = os.path.join(account.getaccountmeta(), 'LocalStatus')
-        # statusbackend can be 'plain' or 'sqlite'
+        # statusbackend can be 'plain', 'sqlite' or 'sqlite-account'
         backend = self.account.getconf('status_backend', 'plain')
         if backend == 'sqlite':
             self._backend = 'sqlite'
             self.LocalStatusFolderClass = LocalStatusSQLiteFolder
             self.root += '-sqlite'
+        elif backend == 'sqlite-account':
+            self._backend = 'sqlite-account'
+            self.LocalStatusFolderClass = LocalStatusSQLiteAccountFolder
+            self.root += '-sqlite-account'
         elif backend == 'plain':
             self._backend = 'plain'
             self.LocalStatusFolderClass = LocalStatusFolder
@@ -45,10 +53,21 @@ class LocalStatusRepository(BaseRepository):
 
         # self._folders is a list of LocalStatusFolders()
         self._folders = None
+        # the database of the 'sqlite-account' backend
+        self._statusdb = None
+        self._statusdblock = Lock()
 
     def getsep(self):
         return '.'
 
+    def getstatusdb(self):
+        """:returns: the StatusDatabase of the 'sqlite-account' backend"""
+        with self._statusdblock:
+            if self._statusdb is None:
+                self._statusdb = StatusDatabase(
+                    os.path.join(self.root, 'status.db'), self.account)
+            return self._statusdb
+
     def getfolderfilename(self, foldername):
         """Return the full path of the status file
 
@@ -67,7 +86,7 @@ class LocalStatusRepository(BaseRepository):
 
         Empty Folder for plain backend. NoOp for sqlite backend as those
         are created on demand."""
-        if self._backend == 'sqlite':
+        if self._backend in ('sqlite', 'sqlite-account'):
             return # noop for sqlite which creates on-demand
 
         if self.account.dryrun:
@@ -91,7 +110,15 @@ class LocalStatusRepository(BaseRepository):
             return self._folders
 
         self._folders = []
+        if self._backend == 'sqlite-account':
+            for (folder,) in self.getstatusdb().query(
+                    'SELECT name FROM folders'):
+                self._folders.append(self.getfolder(folder))
+            return self._folders
         for folder in os.listdir(self.root):
+            # skip plain journals and sqlite's write-ahead logs
+            if folder.endswith((journalsuffix, '-wal', '-shm')):
+                continue
             self._folders.append(self.getfolder(folder))
         return self._folders
 
@@ -16,13 +16,139 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
-from offlineimap import folder
+from offlineimap import folder, inotify
 from offlineimap.ui import getglobalui
 from offlineimap.error import OfflineImapError
 from offlineimap.repository.Base import BaseRepository
+from offlineimap.threadutil import ExitNotifyThread
+from threading import Event, Lock, currentThread
+import offlineimap.accounts
 import os
 from stat import *
 
+
+class MaildirWatcher(object):
+    """Watch the new/ and cur/ directories of Maildir folders for changes
+
+    A folder is dirty from the time it is first watched until it is
+    marked clean, and again as soon as a message file in it is added,
+    removed or renamed. Delivered messages are moved from tmp/ to new/,
+    so tmp/ is not watched. Events are read as needed, see Inotify."""
+
+    # events on new/ and cur/ that change the message list
+    MASK = inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_MOVED_FROM | \
+        inotify.IN_MOVED_TO | inotify.IN_DELETE_SELF | \
+        inotify.IN_MOVE_SELF | inotify.IN_ONLYDIR
+    # seconds to wait for a mail reader to finish its changes before
+    # the folder is synced, see syncchanges()
+    settletime = 2.0
+
+    def __init__(self, repository):
+        self.repository = repository
+        self.ui = getglobalui()
+        self.inotify = inotify.Inotify()
+        self.lock = Lock()
+        # watch descriptor -> folder name
+        self.watches = {}
+        # folder name -> watch descriptors
+        self.folders = {}
+        self.dirty = set()
+        # folders that could not be watched, warned about once
+        self.failed = set()
+
+    def watch(self, maildirfolder):
+        """Start watching a folder, unless it is watched already"""
+        name = maildirfolder.getname()
+        with self.lock:
+            if name in self.folders:
+                return
+            wds = []
+            try:
+                for dirannex in ('new', 'cur'):
+                    wds.append(self.inotify.add_watch(os.path.join(
+                        maildirfolder.getfullname(), dirannex), self.MASK))
+            except OSError as e:
+                for wd in wds:
+                    self._rm_watch(wd)
+                if not name in self.failed:
+                    self.failed.add(name)
+                    self.ui.warn("Cannot watch Maildir folder '%s' for "
+                                 "changes: %s" % (name, e))
+                return
+            for wd in wds:
+                self.watches[wd] = name
+            self.folders[name] = wds
+            self.dirty.add(name)
+
+    def _rm_watch(self, wd):
+        try:
+            self.inotify.rm_watch(wd)
+        except OSError:
+            pass # removed by the kernel already
+
+    def _unwatch(self, name):
+        for wd in self.folders.pop(name, []):
+            del self.watches[wd]
+            self._rm_watch(wd)
+
+    def _readevents(self):
+        """Mark the folders with new events dirty, with self.lock held
+
+        :returns: set of the names of these folders"""
+        changed = set()
+        for wd, mask, cookie, filename in self.inotify.read():
+            if mask & inotify.IN_Q_OVERFLOW:
+                # events were lost
+                changed.update(self.folders)
+                continue
+            name = self.watches.get(wd)
+            if name is None:
+                continue
+            changed.add(name)
+            if mask & (inotify.IN_IGNORED | inotify.IN_DELETE_SELF |
+                       inotify.IN_MOVE_SELF):
+                # watched again at its new place as it is used next
+                self._unwatch(name)
+        self.dirty.update(changed)
+        return changed
+
+    def isclean(self, name):
+        """:returns: True if a folder is watched and did not change
+            since it was marked clean"""
+        with self.lock:
+            self._readevents()
+            return name in self.folders and not name in self.dirty
+
+    def markclean(self, name):
+        with self.lock:
+            self._readevents()
+            self.dirty.discard(name)
+
+    def markdirty(self, name):
+        with self.lock:
+            self.dirty.add(name)
+
+    def syncchanges(self, stop):
+        """Sync folders as they change, until stop is set
+
+        Our own changes during a sync are reported, too, but the sync
+        they trigger finds nothing to do quickly."""
+        while not stop.isSet():
+            if not self.inotify.wait(1.0):
+                continue
+            stop.wait(self.settletime)
+            with self.lock:
+                changed = self._readevents()
+            for name in sorted(changed):
+                if stop.isSet():
+                    break
+                self.repository.syncchangedfolder(name)
+
+    def close(self):
+        with self.lock:
+            self.inotify.close()
+
+
 class MaildirRepository(BaseRepository):
     def __init__(self, reposname, account):
         """Initialize a MaildirRepository object.  Takes a path name
@@ -34,6 +160,13 @@ class MaildirRepository(BaseRepository):
         self.ui = getglobalui()
         self.debug("MaildirRepository initialized, sep is " + repr(self.getsep()))
         self.folder_atimes = []
+        self.watcher = None
+        if self.getconfboolean('inotify', False):
+            if inotify.available():
+                self.watcher = MaildirWatcher(self)
+            else:
+                self.ui.warn("inotify is not available, ignoring the "
+                             "inotify setting of repository '%s'" % self)
 
         # Create the top-level folder if it doesn't exist
         if not os.path.isdir(self.root):
@@ -60,6 +193,58 @@ class MaildirRepository(BaseRepository):
             os.utime(new_dir, (new_atime, os.path.getmtime(new_dir)))
             os.utime(cur_dir, (cur_atime, os.path.getmtime(cur_dir)))
 
+    def startkeepalive(self):
+        """Sync folders changed while we sleep, if inotifysync is set"""
+        if self.watcher is None or \
+                not self.getconfboolean('inotifysync', False):
+            return
+        self.kaevent = Event()
+        self.kathread = ExitNotifyThread(target = self.watcher.syncchanges,
+                                         name = "Watch " + self.getname(),
+                                         args = (self.kaevent,))
+        self.kathread.setDaemon(1)
+        self.kathread.start()
+
+    def stopkeepalive(self):
+        if not hasattr(self, 'kaevent'):
+            # Keepalive is not active.
+            return
+
+        self.kaevent.set()
+        # a folder sync it started must not overlap the next sync
+        self.kathread.join()
+        del self.kathread
+        del self.kaevent
+
+    def close(self):
+        """Stop watching the folders"""
+        self.stopkeepalive()
+        if self.watcher is not None:
+            self.watcher.close()
+            self.watcher = None
+
+    def syncchangedfolder(self, foldername):
+        """Sync a folder the watcher saw changes in
+
+        The folder is synced in quick mode, so that a folder changed by
+        the last sync only is compared, but not synced again."""
+        account = self.account
+        remoterepos = account.remoterepos
+        for remotefolder in remoterepos.getfolders():
+            if self is remoterepos:
+                name = remotefolder.getname()
+            else:
+                name = remotefolder.getvisiblename().replace(
+                    remoterepos.getsep(), self.getsep())
+            if name == foldername:
+                break
+        else:
+            return # not synced
+        if not remotefolder.sync_this:
+            return
+        offlineimap.accounts.syncfolder(account, remotefolder, quick=True)
+        self.ui.unregisterthread(currentThread()) #syncfolder registered the thread
+
     def getlocalroot(self):
         return os.path.expanduser(self.getconf('localfolders'))
 
@@ -197,6 +382,11 @@ class MaildirRepository(BaseRepository):
     def getfolders(self):
         if self.folders == None:
             self.folders = self._getfolders_scandir(self.root)
+            if self.watcher is not None:
+                # watched from the first listing on, whatever the sync mode
+                for maildirfolder in self.folders:
+                    if maildirfolder.sync_this:
+                        self.watcher.watch(maildirfolder)
         return self.folders
 
     def forgetfolders(self):
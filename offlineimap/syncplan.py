@@ -0,0 +1,68 @@
+# Copyright (C) 2013 John Goerzen & contributors
+# Computing what a sync of one folder to another needs to do
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+def getflagdict(messages):
+    """:returns: dict mapping the UIDs of a message list to their flags"""
+    if hasattr(messages, 'getflagdict'):
+        # MessageList and the like
+        return messages.getflagdict()
+    return dict((uid, msg['flags']) for uid, msg in messages.iteritems())
+
+
+class SyncPlan(object):
+    """The changes to sync from a source folder to a destination folder
+
+    The message lists of the source, destination and status folders are
+    compared once, with set operations over their UIDs, rather than
+    message by message in each pass of BaseFolder.syncmessagesto():
+
+    - copy: sorted UIDs of messages in the source but not in the
+      status folder, i.e. new messages (pass 1).
+    - delete: sorted UIDs of messages in the status folder but not in
+      the source, i.e. deleted messages (pass 2). Negative UIDs are left
+      out.
+    - flagchanges: dict mapping the UIDs of messages in all three
+      folders whose flags differ between source and status folder to
+      (addflags, delflags) tuples (pass 3), as taken by
+      BaseFolder.applyflagchanges().
+
+    Messages that are copied in pass 1 end up in the status folder with
+    the flags of the source, and messages deleted in pass 2 are not in
+    the source, so none of the passes changes what the later passes
+    need to do, and all three can be computed up front."""
+
+    def __init__(self, srcmessages, dstuids, statusmessages):
+        """
+        :param srcmessages: message list of the source folder, a
+            MessageList or a dict mapping UIDs to dicts with (at least)
+            the 'flags' of messages
+        :param dstuids: iterable of the UIDs in the destination folder
+        :param statusmessages: message list of the status folder"""
+        srcflags = getflagdict(srcmessages)
+        statusflags = getflagdict(statusmessages)
+        srcuids = set(srcflags)
+        statusuids = set(statusflags)
+        self.copy = sorted(srcuids - statusuids)
+        self.delete = sorted(uid for uid in statusuids - srcuids if uid >= 0)
+        common = srcuids & statusuids
+        common.intersection_update(dstuids)
+        self.flagchanges = {}
+        for uid in common:
+            flags, oldflags = srcflags[uid], statusflags[uid]
+            if flags is not oldflags and flags != oldflags and uid >= 0:
+                self.flagchanges[uid] = (set(flags - oldflags),
+                                         set(oldflags - flags))
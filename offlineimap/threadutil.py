@@ -228,3 +228,124 @@ class InstanceLimitedThread(ExitNotifyThread):
         finally:
             if instancelimitedsems and instancelimitedsems[self.instancename]:
                 instancelimitedsems[self.instancename].release()
+
+
+######################################################################
+# Worker pools
+######################################################################
+
+workerpools = {}
+workerpoolslock = Lock()
+
+def initWorkerPool(poolname, poolsize):
+    """Initialize the worker pool with the given poolname to run up to
+    poolsize tasks at a time."""
+    workerpoolslock.acquire()
+    if not poolname in workerpools:
+        workerpools[poolname] = WorkerPool(poolname, poolsize)
+    workerpoolslock.release()
+
+def getWorkerPool(poolname):
+    """Return the worker pool set up by initWorkerPool()"""
+    return workerpools[poolname]
+
+def shutdownWorkerPools():
+    """Stop the worker threads of all worker pools"""
+    workerpoolslock.acquire()
+    pools = workerpools.values()
+    workerpoolslock.release()
+    for pool in pools:
+        pool.shutdown()
+
+class WorkerPool(object):
+    """A fixed number of threads working off a bounded queue of tasks
+
+    Rather than starting a thread per task, tasks are queued and taken
+    by long-lived worker threads, which are started on first use. The
+    queue holds at most twice as many tasks as there are workers, so
+    queueing tasks blocks until the workers catch up. Several threads
+    can queue tasks at the same time, each gets the results of its own
+    tasks. Tasks must not queue tasks on the pool they run on, as they
+    might wait for themselves."""
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = max(size, 1)
+        self.tasks = Queue(2 * self.size)
+        self.workers = []
+        self.lock = Lock()
+
+    def _startworkers(self):
+        self.lock.acquire()
+        try:
+            while len(self.workers) < self.size:
+                # Not an ExitNotifyThread: _work() catches all exceptions,
+                # and exiting must not wait for the exit monitor, which
+                # has stopped by the time shutdown() is called.
+                worker = Thread(target = self._work,
+                    name = "%s worker %d" % (self.name, len(self.workers) + 1))
+                worker.setDaemon(True)
+                worker.start()
+                self.workers.append(worker)
+        finally:
+            self.lock.release()
+
+    def _work(self):
+        ui = getglobalui()
+        while True:
+            task = self.tasks.get()
+            if task is None: # queued by shutdown()
+                return
+            func, item, account, results = task
+            if account is not None and ui.getthreadaccount() is not account:
+                ui.registerthread(account)
+            try:
+                results.put((item, func(item), None))
+            except:
+                # handed to the thread that queued the task
+                results.put((item, None, sys.exc_info()))
+
+    def shutdown(self):
+        """Stop the worker threads and wait for them to exit
+
+        The tasks queued so far are still run. Workers are started
+        again if the pool is used afterwards."""
+        self.lock.acquire()
+        try:
+            workers, self.workers = self.workers, []
+        finally:
+            self.lock.release()
+        for worker in workers:
+            self.tasks.put(None)
+        for worker in workers:
+            worker.join()
+
+    def imap(self, func, items, account = None):
+        """Run func(item) for each of items on the worker threads
+
+        Items are taken from the iterable only as there is room in the
+        queue, so they may be generated lazily. Results are returned
+        in the order the tasks complete.
+
+        :param account: the Account to register the worker threads with
+                        in the UI while they work on these tasks.
+        :returns: a generator of (item, result, exc_info) tuples. exc_info
+                  is the sys.exc_info() of the exception func raised, or
+                  None if it returned result."""
+        self._startworkers()
+        results = Queue()
+        pending = 0
+        for item in items:
+            self.tasks.put((func, item, account, results))
+            pending += 1
+            while True:
+                try:
+                    result = results.get_nowait()
+                except Empty:
+                    break
+                pending -= 1
+                yield result
+        while pending:
+            result = results.get()
+            pending -= 1
+            yield result
@@ -423,6 +423,10 @@ class Blinkenlights(UIBase, CursesUtil):
         self.gettf().setcolor('orange')
         super(Blinkenlights, self).copyingmessage(*args)
 
+    def movingmessage(self, *args):
+        self.gettf().setcolor('orange')
+        super(Blinkenlights, self).movingmessage(*args)
+
     def deletingmessages(self, *args):
         self.gettf().setcolor('red')
         super(Blinkenlights, self).deletingmessages(*args)
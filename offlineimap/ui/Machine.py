@@ -105,6 +105,11 @@ class MachineUI(UIBase):
                 (uid, self.getnicename(srcfolder), srcfolder.getname(),
                  self.getnicename(destfolder), destfolder))
 
+    def movingmessage(self, uid, srcfolder, destfolder):
+        self._printData('movingmessage', "%d\n%s\n%s\n%s[%s]" % \
+                (uid, self.getnicename(srcfolder), srcfolder.getname(),
+                 self.getnicename(destfolder), destfolder))
+
     def folderlist(s, list):
         return ("\f".join(["%s\t%s" % (s.getnicename(x), x.getname()) for x in list]))
 
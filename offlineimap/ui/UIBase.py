@@ -343,6 +343,12 @@ class UIBase(object):
                 uid, num, num_to_copy, src.repository, src,
                 destfolder.repository))
 
+    def movingmessage(self, uid, srcfolder, destfolder):
+        """Output a log line stating which message we move"""
+        self.logger.info("Move message %s %s:%s -> %s:%s" % (
+                uid, srcfolder.repository, srcfolder, destfolder.repository,
+                destfolder))
+
     def deletingmessages(self, uidlist, destlist):
         ds = self.folderlist(destlist)
         prefix = "[DRYRUN] " if self.dryrun else ""
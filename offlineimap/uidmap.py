@@ -0,0 +1,321 @@
+# Copyright (C) 2013 John Goerzen & contributors
+# Persistent mapping between local and remote UIDs
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+import mmap
+import os
+import struct
+from threading import RLock
+from offlineimap import OfflineImapError
+
+MAGIC = 'OLIUIDM1'
+HEADER = struct.Struct('<8sQ')
+PAIR = struct.Struct('<qq')
+RECORD = struct.Struct('<cqq')
+# pairs unpacked at once when iterating over the map file
+CHUNK = 4096
+# The log is compacted into the map file once it holds more records
+# than half the pairs in the map file and this many
+LOGMINRECORDS = 1024
+
+
+class UIDMapView(object):
+    """One direction of a UIDMap, used like a dict"""
+
+    def __init__(self, uidmap, forward):
+        self.uidmap = uidmap
+        self.forward = forward
+
+    def __getitem__(self, uid):
+        result = self.uidmap._lookup(uid, self.forward)
+        if result is None:
+            raise KeyError(uid)
+        return result
+
+    def get(self, uid, default=None):
+        result = self.uidmap._lookup(uid, self.forward)
+        if result is None:
+            return default
+        return result
+
+    def __contains__(self, uid):
+        return self.uidmap._lookup(uid, self.forward) is not None
+
+    def keys(self):
+        return [key for key, value in self.uidmap._items(self.forward)]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def items(self):
+        return self.uidmap._items(self.forward)
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def __len__(self):
+        return len(self.uidmap)
+
+
+class UIDMap(object):
+    """Mapping between the local and remote UIDs of a folder
+
+    The mapping is kept in a binary map file, which holds the pairs
+    once sorted by local UID and once by remote UID and is memory
+    mapped for binary searches, and a log of the changes since the
+    map file was written. Changes are appended to the log, and the log
+    is merged into a new map file once it grew large enough. The text
+    files of older versions are converted on first use.
+
+    Pairs with a negative UID, i.e. of messages that are on one side
+    only, are kept in memory only.
+
+    :ivar l2r: UIDMapView mapping local UIDs to remote UIDs
+    :ivar r2l: UIDMapView mapping remote UIDs to local UIDs"""
+
+    def __init__(self, filename):
+        """:param filename: the text file of older versions. The map
+            and the log are kept next to it."""
+        self.textfilename = filename
+        self.mapfilename = filename + '.uidmap'
+        self.logfilename = filename + '.uidlog'
+        self.lock = RLock()
+        self.l2r = UIDMapView(self, True)
+        self.r2l = UIDMapView(self, False)
+        # pairs added since the map file was written
+        self._added = ({}, {})
+        # UIDs of the map file that were changed or removed since
+        self._removed = (set(), set())
+        self._logfile = None
+        self._logrecords = 0
+        # changed with every change to the pairs
+        self.version = 0
+        if not os.path.exists(self.mapfilename):
+            self._convert()
+        self._openmap()
+        self._replaylog()
+
+    def _convert(self):
+        """Write the map file, from the text file if there is one"""
+        pairs = []
+        if os.path.exists(self.textfilename):
+            with open(self.textfilename, 'rt') as file:
+                for line in file:
+                    try:
+                        luid, ruid = line.strip().split(':')
+                        pairs.append((long(luid), long(ruid)))
+                    except ValueError:
+                        raise OfflineImapError("Corrupt line '%s' in UID "
+                            "mapping file '%s'" % (line.strip(),
+                                                   self.textfilename),
+                            OfflineImapError.ERROR.FOLDER)
+        self._writemap(pairs)
+        if os.path.exists(self.textfilename):
+            os.rename(self.textfilename, self.textfilename + '.old')
+
+    def _writemap(self, pairs):
+        """Write pairs of (local UID, remote UID) to a new map file"""
+        bylocal = sorted(pairs)
+        byremote = sorted((ruid, luid) for luid, ruid in pairs)
+        with open(self.mapfilename + '.tmp', 'wb') as file:
+            file.write(HEADER.pack(MAGIC, len(pairs)))
+            for sortedpairs in (bylocal, byremote):
+                for start in xrange(0, len(sortedpairs), CHUNK):
+                    chunk = sortedpairs[start:start + CHUNK]
+                    file.write(struct.pack('<%dq' % (2 * len(chunk)),
+                                           *[uid for pair in chunk
+                                             for uid in pair]))
+        os.rename(self.mapfilename + '.tmp', self.mapfilename)
+
+    def _openmap(self):
+        with open(self.mapfilename, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or \
+                len(self._map) != HEADER.size + 2 * self._count * PAIR.size:
+            raise OfflineImapError("Corrupt UID mapping file '%s'" %
+                                   self.mapfilename,
+                                   OfflineImapError.ERROR.FOLDER)
+
+    def _offset(self, forward):
+        """:returns: offset of the pairs sorted by local or remote UID"""
+        if forward:
+            return HEADER.size
+        return HEADER.size + self._count * PAIR.size
+
+    def _search(self, uid, forward):
+        """Binary search in the map file
+
+        :returns: the UID that uid is mapped to or None"""
+        offset = self._offset(forward)
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            key, value = PAIR.unpack_from(self._map,
+                                          offset + middle * PAIR.size)
+            if key < uid:
+                low = middle + 1
+            elif key > uid:
+                high = middle
+            else:
+                return value
+        return None
+
+    def _lookup(self, uid, forward):
+        side = 0 if forward else 1
+        with self.lock:
+            if uid in self._added[side]:
+                return self._added[side][uid]
+            if uid in self._removed[side]:
+                return None
+            return self._search(uid, forward)
+
+    def _mapitems(self, forward):
+        """:returns: generator over the pairs in the map file"""
+        offset = self._offset(forward)
+        for start in xrange(0, self._count, CHUNK):
+            count = min(CHUNK, self._count - start)
+            uids = struct.unpack_from('<%dq' % (2 * count), self._map,
+                                      offset + start * PAIR.size)
+            for i in xrange(0, 2 * count, 2):
+                yield uids[i], uids[i + 1]
+
+    def _items(self, forward):
+        """:returns: list of all (key, value) pairs of one direction"""
+        side = 0 if forward else 1
+        with self.lock:
+            removed = self._removed[side]
+            items = [(key, value) for key, value in self._mapitems(forward)
+                     if not key in removed]
+            items.extend(self._added[side].items())
+        return items
+
+    def __len__(self):
+        with self.lock:
+            return self._count - len(self._removed[0]) + len(self._added[0])
+
+    def _log(self, record, luid, ruid):
+        if self._logfile is None:
+            self._logfile = open(self.logfilename, 'ab')
+        self._logfile.write(RECORD.pack(record, luid, ruid))
+        self._logfile.flush()
+        self._logrecords += 1
+
+    def _replaylog(self):
+        if not os.path.exists(self.logfilename):
+            return
+        with open(self.logfilename, 'rb') as file:
+            data = file.read()
+        valid = len(data) - len(data) % RECORD.size
+        for offset in xrange(0, valid, RECORD.size):
+            record, luid, ruid = RECORD.unpack_from(data, offset)
+            if record == 'A':
+                self._add(luid, ruid)
+            elif record == 'D':
+                self._remove(luid)
+            else:
+                raise OfflineImapError("Corrupt UID mapping log '%s'" %
+                                       self.logfilename,
+                                       OfflineImapError.ERROR.FOLDER)
+            self._logrecords += 1
+        if valid < len(data):
+            # a record cut short by a crash, it was not reported as done
+            with open(self.logfilename, 'r+b') as file:
+                file.truncate(valid)
+
+    def _remove(self, luid):
+        """Remove the pair of a local UID from memory
+
+        :returns: the remote UID it was mapped to or None"""
+        ruid = self._lookup(luid, True)
+        if ruid is None:
+            return None
+        self.version += 1
+        for side, uid in ((0, luid), (1, ruid)):
+            if self._added[side].pop(uid, None) is None:
+                self._removed[side].add(uid)
+        return ruid
+
+    def _add(self, luid, ruid):
+        self._remove(luid)
+        oldluid = self._lookup(ruid, False)
+        if oldluid is not None:
+            self._remove(oldluid)
+        self._added[0][luid] = ruid
+        self._added[1][ruid] = luid
+        self.version += 1
+
+    @staticmethod
+    def _persistent(luid, ruid):
+        return luid > 0 and ruid > 0
+
+    def add(self, luid, ruid):
+        """Map a local UID to a remote UID, replacing their old pairs"""
+        with self.lock:
+            if self._persistent(luid, ruid):
+                # replaying the record replaces the old pairs, too
+                self._log('A', luid, ruid)
+            else:
+                for uid in (luid, self._lookup(ruid, False)):
+                    if uid is None:
+                        continue
+                    oldruid = self._lookup(uid, True)
+                    if oldruid is not None and self._persistent(uid, oldruid):
+                        self._log('D', uid, oldruid)
+            self._add(luid, ruid)
+            self._compactifdue()
+
+    def removelocal(self, luid):
+        """Remove the pair of a local UID, if any"""
+        with self.lock:
+            ruid = self._remove(luid)
+            if ruid is not None and self._persistent(luid, ruid):
+                self._log('D', luid, ruid)
+                self._compactifdue()
+
+    def removeremote(self, ruid):
+        """Remove the pair of a remote UID, if any"""
+        with self.lock:
+            luid = self._lookup(ruid, False)
+            if luid is not None:
+                self.removelocal(luid)
+
+    def _compactifdue(self):
+        if self._logrecords > max(self._count // 2, LOGMINRECORDS):
+            self.compact()
+
+    def compact(self):
+        """Merge the log into a new map file"""
+        with self.lock:
+            items = self._items(True)
+            self._writemap([(luid, ruid) for luid, ruid in items
+                            if self._persistent(luid, ruid)])
+            if self._logfile is not None:
+                self._logfile.close()
+                self._logfile = None
+            if os.path.exists(self.logfilename):
+                os.unlink(self.logfilename)
+            self._logrecords = 0
+            self._map.close()
+            self._openmap()
+            # keep the pairs that are only kept in memory
+            self._added = (dict(items), {})
+            self._removed = (set(), set())
+            for luid, ruid in items:
+                if self._persistent(luid, ruid):
+                    del self._added[0][luid]
+                else:
+                    self._added[1][ruid] = luid
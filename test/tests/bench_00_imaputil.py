@@ -0,0 +1,45 @@
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+"""Micro-benchmark of the FETCH response parsers in imaputil
+
+Not part of the test suite, run it with
+'python -m test.tests.bench_00_imaputil'."""
+import timeit
+
+from offlineimap import imaputil
+from offlineimap.ui import UI_LIST, setglobalui
+from offlineimap.CustomConfig import CustomConfigParser
+
+RESPONSES = [b'(FLAGS (\\Seen Old) UID 4807)',
+             b'(FLAGS (\\Seen \\Answered $Forwarded) UID 4808 RFC822.SIZE 3488)',
+             b'(UID 4809 FLAGS () MODSEQ (624140003))']
+
+def parse_flags2hash():
+    for response in RESPONSES:
+        imaputil.flagsimap2maildir(imaputil.flags2hash(response)['FLAGS'])
+
+def parse_fetch2hash():
+    for response in RESPONSES:
+        imaputil.flagsimap2maildir(imaputil.fetch2hash(response)['FLAGS'])
+
+if __name__ == '__main__':
+    # imaputil.debug() needs a UI
+    setglobalui(UI_LIST['quiet'](CustomConfigParser()))
+    number = 20000
+    for func in (parse_flags2hash, parse_fetch2hash):
+        best = min(timeit.repeat(func, number=number, repeat=3))
+        print("%-20s %.2f us per response" % (func.__name__,
+              best / number / len(RESPONSES) * 1e6))
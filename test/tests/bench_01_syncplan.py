@@ -0,0 +1,89 @@
+# Copyright (C) 2013- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+"""Benchmark of comparing message lists for a sync on large folders
+
+Compares the per-message comparisons the sync passes used to do with
+BaseFolder.getsyncplan(), on folders with a million messages of which
+1% are new, 1% deleted and 1% have changed flags. Not part of the test
+suite, run it with 'python -m test.tests.bench_01_syncplan [count]'."""
+import sys
+import time
+
+from offlineimap.folder.Base import BaseFolder
+
+class ListFolder(BaseFolder):
+    """A folder holding just a message list"""
+    def __init__(self, messagelist):
+        self.messagelist = messagelist
+
+    def getmessagelist(self):
+        return self.messagelist
+
+    def getmessageflags(self, uid):
+        return self.messagelist[uid]['flags']
+
+def makefolders(count):
+    src, status = {}, {}
+    step = 100
+    for uid in xrange(1, count + 1):
+        flags = set('S')
+        if uid % step != 1: # new in src otherwise
+            status[uid] = {'uid': uid, 'flags': set('S')}
+        if uid % step == 2:
+            flags = set('RS') # changed flags
+        if uid % step != 3: # deleted from src otherwise
+            src[uid] = {'uid': uid, 'flags': flags}
+    dst = dict(status)
+    return ListFolder(src), ListFolder(dst), ListFolder(status)
+
+def permessage(src, dst, status):
+    """The comparisons of the sync passes before SyncPlan"""
+    copylist = filter(lambda uid: not status.uidexists(uid),
+                      src.getmessageuidlist())
+    deletelist = filter(lambda uid: uid >= 0 and not src.uidexists(uid),
+                        status.getmessageuidlist())
+    changes = {}
+    for uid in src.getmessageuidlist():
+        if uid < 0 or not dst.uidexists(uid):
+            continue
+        selfflags = src.getmessageflags(uid)
+        statusflags = status.getmessageflags(uid)
+        if statusflags is None:
+            statusflags = set()
+        addflags = selfflags - statusflags
+        delflags = statusflags - selfflags
+        if addflags or delflags:
+            changes[uid] = (addflags, delflags)
+    return sorted(copylist), sorted(deletelist), changes
+
+def syncplan(src, dst, status):
+    plan = src.getsyncplan(dst, status)
+    return plan.copy, plan.delete, plan.flagchanges
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    folders = makefolders(count)
+    results = []
+    for func in (permessage, syncplan):
+        best = None
+        for i in range(3):
+            start = time.time()
+            result = func(*folders)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results.append(result)
+        print("%-12s %.3f s for %d messages" % (func.__name__, best, count))
+    assert results[0] == results[1]
@@ -0,0 +1,68 @@
+# Copyright (C) 2013- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+"""Benchmark of the memory taken by message lists of large folders
+
+Fills the message lists of an IMAP folder and a Maildir folder with a
+million messages, once as dict of dicts and once as MessageList, each
+in a fresh process, and reports the peak memory used and the time
+taken to compute a SyncPlan between the two. Not part of the test
+suite, run it with 'python -m test.tests.bench_02_messagelist [count]'."""
+import resource
+import subprocess
+import sys
+import time
+
+from offlineimap.messagelist import MessageList
+from offlineimap.syncplan import SyncPlan
+
+def fill(imaplist, maildirlist, count):
+    for uid in xrange(1, count + 1):
+        flags = set('S')
+        if uid % 3 == 0:
+            flags.add('R')
+        imaplist[uid] = {'uid': uid, 'flags': flags, 'time': 1.4e9 + uid,
+                         'size': 4000 + uid % 10000}
+        maildirlist[uid] = {'flags': flags, 'filename':
+                            'cur/1380000000_%d.12345.host,U=%d,FMD5=%s:2,%s'
+                            % (uid, uid, '0' * 32, ''.join(sorted(flags)))}
+
+def measure(variant, count):
+    """Fill both message lists in this process and print the results"""
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if variant == 'dict':
+        imaplist, maildirlist = {}, {}
+    else:
+        imaplist = MessageList('time', 'size', 'gmmsgid')
+        maildirlist = MessageList('filename')
+    fill(imaplist, maildirlist, count)
+    used = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+    start = time.time()
+    SyncPlan(imaplist, maildirlist.keys(), maildirlist)
+    print("%-11s %8.1f MiB %6.1f bytes/message %6.2fs SyncPlan" %
+          (variant, used / 1024.0, used * 1024.0 / count / 2,
+           time.time() - start))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2:
+        measure(sys.argv[2], int(sys.argv[1]))
+        sys.exit(0)
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    print("%d messages per folder" % count)
+    for variant in ('dict', 'MessageList'):
+        sys.stdout.flush()
+        subprocess.check_call([sys.executable, '-m',
+                               'test.tests.bench_02_messagelist',
+                               str(count), variant])
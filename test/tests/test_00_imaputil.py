@@ -97,3 +97,51 @@ class TestInternalFunctions(unittest.TestCase):
         """Test imaputil.uid_sequence()"""
         res = imaputil.uid_sequence([1,2,3,4,5,10,12,13])
         self.assertEqual(res, b'1:5,10,12:13')
+
+    def test_08_uid_sequence_expand(self):
+        """Test imaputil.uid_sequence_expand()"""
+        res = imaputil.uid_sequence_expand(b'1:3,10,13:12')
+        self.assertEqual(res, [1, 2, 3, 10, 12, 13])
+        res = imaputil.uid_sequence_expand(imaputil.uid_sequence([7, 5, 6]))
+        self.assertEqual(res, [5, 6, 7])
+
+    def test_09_statussplit(self):
+        """Test imaputil.statussplit()"""
+        res = imaputil.statussplit(b'"INBOX.Sent" (MESSAGES 231 UIDNEXT 44292)')
+        self.assertEqual(res, ('INBOX.Sent',
+                               {'MESSAGES': 231, 'UIDNEXT': 44292}))
+        res = imaputil.statussplit(b'blurdybloop (UIDVALIDITY 3857529045)')
+        self.assertEqual(res, ('blurdybloop', {'UIDVALIDITY': 3857529045}))
+
+    def test_10_fetch2hash(self):
+        """Test imaputil.fetch2hash()"""
+        res = imaputil.fetch2hash(b'(FLAGS (\\Seen Old) UID 4807)')
+        self.assertEqual(res, imaputil.flags2hash(b'(FLAGS (\\Seen Old) UID 4807)'))
+        res = imaputil.fetch2hash(b'(UID 12 RFC822.SIZE 3488 MODSEQ (624140003) '
+                                  b'INTERNALDATE "17-Jul-1996 02:44:25 -0700")')
+        self.assertEqual(res, {'UID': '12', 'RFC822.SIZE': '3488',
+                               'MODSEQ': '(624140003)',
+                               'INTERNALDATE': '"17-Jul-1996 02:44:25 -0700"'})
+        res = imaputil.fetch2hash((b'(UID 5 BODY[HEADER] {9}', b'Subject:x'))
+        self.assertEqual(res, {'UID': '5', 'BODY[HEADER]': 'Subject:x'})
+        # nested lists are left to imapsplit()
+        res = imaputil.fetch2hash(b'(BODYSTRUCTURE (("TEXT") "MIXED") UID 3)')
+        self.assertEqual(res, {'BODYSTRUCTURE': '(("TEXT") "MIXED")',
+                               'UID': '3'})
+
+    def test_11_uid_sequence_chunks(self):
+        """Test imaputil.uid_sequence_chunks()"""
+        res = imaputil.uid_sequence_chunks([1, 2, 3, 10, 12, 13, 20], 9)
+        self.assertEqual(res, ['1:3,10', '12:13,20'])
+        self.assertEqual(imaputil.uid_sequence_chunks([], 9), [])
+
+    def test_12_flagchanges2groups(self):
+        """Test imaputil.flagchanges2groups()"""
+        changes = {1: (set('S'), set()), 2: (set('RS'), set('F')),
+                   3: (set('S'), set('F'))}
+        res = imaputil.flagchanges2groups(changes)
+        self.assertEqual(res, [('+', set('RS'), [2]), ('+', set('S'), [1, 3]),
+                               ('-', set('F'), [2, 3])])
+        res = imaputil.flagchanges2groups(changes, perflag=True)
+        self.assertEqual(res, [('+', set('R'), [2]), ('+', set('S'), [1, 2, 3]),
+                               ('-', set('F'), [2, 3])])
@@ -0,0 +1,36 @@
+# Copyright (C) 2013- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import unittest
+
+from offlineimap.syncplan import SyncPlan
+
+
+class TestSyncPlan(unittest.TestCase):
+    """Tests of the comparison of message lists for a sync"""
+
+    def test_01_syncplan(self):
+        """Test syncplan.SyncPlan()"""
+        src = {-1: set(), 1: set('S'), 2: set('RS'), 4: set(), 5: set('F')}
+        status = {1: set('S'), 2: set('S'), 3: set(), 5: set()}
+        plan = SyncPlan(dict((uid, {'flags': flags})
+                             for uid, flags in src.items()),
+                        [1, 2, 3],
+                        dict((uid, {'flags': flags})
+                             for uid, flags in status.items()))
+        self.assertEqual(plan.copy, [-1, 4])
+        self.assertEqual(plan.delete, [3])
+        # 5 is gone from the destination
+        self.assertEqual(plan.flagchanges, {2: (set('R'), set())})
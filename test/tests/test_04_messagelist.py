@@ -0,0 +1,46 @@
+# Copyright (C) 2013- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import unittest
+
+from offlineimap.messagelist import MessageList
+
+
+class TestMessageList(unittest.TestCase):
+    """Tests of the message list that folders keep their messages in"""
+
+    def test_01_messagelist(self):
+        """Test messagelist.MessageList()"""
+        ml = MessageList('time', 'filename')
+        ml[3] = {'uid': 3, 'flags': set('S'), 'filename': 'cur/3:2,S'}
+        ml[1] = {'flags': set(['S', '$Label']), 'time': 1.5}
+        ml[-1] = {'flags': set(), 'filename': 'new/x'}
+        self.assertEqual(ml.keys(), [-1, 1, 3])
+        self.assertEqual(ml[1]['flags'], set(['S', '$Label']))
+        self.assertEqual(ml[1]['time'], 1.5)
+        self.assertEqual(ml[3]['time'], None)
+        self.assertFalse('filename' in ml[1])
+        ml[3]['flags'] |= set('R')
+        ml[3]['filename'] = 'cur/3:2,RS'
+        self.assertEqual(ml[3].copy(), {'uid': 3, 'flags': set('RS'),
+                                        'filename': 'cur/3:2,RS'})
+        ml[5] = ml[3]
+        del ml[3]
+        self.assertFalse(3 in ml)
+        self.assertRaises(KeyError, ml.__getitem__, 3)
+        self.assertEqual(ml.pop(5)['filename'], 'cur/3:2,RS')
+        self.assertEqual(len(ml), 2)
+        self.assertEqual(ml.getflagdict(),
+                         {-1: frozenset(), 1: frozenset(['S', '$Label'])})
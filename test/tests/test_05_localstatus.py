@@ -0,0 +1,137 @@
+# Copyright (C) 2013- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import unittest
+import logging
+import os
+
+from offlineimap.accounts import Account
+from offlineimap.repository.LocalStatus import LocalStatusRepository
+from offlineimap.ui import UI_LIST, setglobalui
+
+from test.OLItest import OLITestLib
+
+# Things need to be setup first, usually setup.py initializes everything.
+# but if e.g. called from command line, we take care of default values here:
+if not OLITestLib.cred_file:
+    OLITestLib(cred_file='./test/credentials.conf', cmd='./offlineimap.py')
+
+def setUpModule():
+    logging.info("Set Up test module %s" % __name__)
+    tdir = OLITestLib.create_test_dir(suffix=__name__)
+
+def tearDownModule():
+    logging.info("Tear Down test module")
+    OLITestLib.delete_test_dir()
+
+class TestLocalStatus(unittest.TestCase):
+    """Tests of the files the LocalStatus backends keep the status in"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.config = OLITestLib.get_default_config()
+        cls.config.set('general', 'dry-run', 'False')
+        setglobalui(UI_LIST['quiet'](cls.config))
+        cls.account = Account(cls.config, 'test')
+        os.mkdir(cls.account.getaccountmeta())
+
+    def getfolder(self, name, backend='plain'):
+        """:returns: the status folder name, with its messages loaded"""
+        self.config.set('Account test', 'status_backend', backend)
+        folder = LocalStatusRepository('Status', self.account).getfolder(name)
+        folder.cachemessagelist()
+        return folder
+
+    def getflags(self, folder):
+        return dict((uid, ''.join(sorted(folder.getmessageflags(uid))))
+                    for uid in folder.getmessageuidlist())
+
+    def test_01_journal(self):
+        """Test replaying the journal of a plain status file"""
+        folder = self.getfolder('journal')
+        folder.savemessage(1, None, set('S'), None)
+        folder.savemessage(2, None, set(), None)
+        folder.savemessage(3, None, set('F'), None)
+        folder.savemessageflags(1, set('RS'))
+        folder.deletemessage(2)
+        self.assertTrue(os.path.exists(folder.journalname))
+
+        folder = self.getfolder('journal')
+        self.assertEqual(self.getflags(folder), {1: 'RS', 3: 'F'})
+        folder.save()
+        self.assertFalse(os.path.exists(folder.journalname))
+        self.assertEqual(self.getflags(self.getfolder('journal')),
+                         {1: 'RS', 3: 'F'})
+
+    def test_02_journal_cut_short(self):
+        """Test dropping a journal line cut short by a crash"""
+        folder = self.getfolder('cutshort')
+        folder.savemessage(1, None, set('S'), None)
+        folder.savemessage(2, None, set(), None)
+        with open(folder.journalname, 'at') as file:
+            file.write('+3:F')
+
+        folder = self.getfolder('cutshort')
+        self.assertEqual(self.getflags(folder), {1: 'S', 2: ''})
+        with open(folder.journalname, 'rt') as file:
+            self.assertEqual(file.read(), '+2:\n')
+        # appends after the remaining lines
+        folder.savemessageflags(2, set('R'))
+        self.assertEqual(self.getflags(self.getfolder('cutshort')),
+                         {1: 'S', 2: 'R'})
+
+    def test_03_sqlite_migrate(self):
+        """Test importing a plain status with journal into sqlite"""
+        folder = self.getfolder('tosqlite')
+        folder.savemessage(1, None, set('S'), None)
+        folder.savemessage(2, None, set('F'), None)
+        folder.savemessageflags(1, set('RS'))
+        plainname, journalname = folder.filename, folder.journalname
+        self.assertTrue(os.path.exists(journalname))
+
+        folder = self.getfolder('tosqlite', 'sqlite')
+        self.assertEqual(self.getflags(folder), {1: 'RS', 2: 'F'})
+        for filename in (plainname, journalname):
+            self.assertFalse(os.path.exists(filename))
+            self.assertTrue(os.path.exists(filename + '.old'))
+
+    def test_04_sqlite_account_migrate(self):
+        """Test importing plain and sqlite status into the account database"""
+        folder = self.getfolder('plain')
+        folder.savemessage(1, None, set('S'), None)
+        folder.savemessage(2, None, set('F'), None)
+        folder.deletemessage(1)
+        plainname, journalname = folder.filename, folder.journalname
+        folder = self.getfolder('sqlite', 'sqlite')
+        folder.savemessage(5, None, set('RS'), None)
+        folder.save()
+        sqlitename = folder.filename
+
+        for name, flags in (('plain', {2: 'F'}), ('sqlite', {5: 'RS'})):
+            folder = self.getfolder(name, 'sqlite-account')
+            self.assertEqual(self.getflags(folder), flags)
+            # commit, as each getfolder() opens the database anew
+            folder.save()
+        for filename in (plainname, journalname, sqlitename):
+            self.assertFalse(os.path.exists(filename))
+            self.assertTrue(os.path.exists(filename + '.old'))
+
+        folder.savemessageflags(5, set('S'))
+        folder.save()
+        folder = self.getfolder('sqlite', 'sqlite-account')
+        self.assertEqual(self.getflags(folder), {5: 'S'})
+        self.assertEqual(self.getflags(self.getfolder('plain',
+                                                      'sqlite-account')),
+                         {2: 'F'})
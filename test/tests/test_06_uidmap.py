@@ -0,0 +1,115 @@
+# Copyright (C) 2013- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import unittest
+import logging
+import os
+
+from offlineimap import uidmap
+from offlineimap.uidmap import UIDMap
+
+from test.OLItest import OLITestLib
+
+# Things need to be setup first, usually setup.py initializes everything.
+# but if e.g. called from command line, we take care of default values here:
+if not OLITestLib.cred_file:
+    OLITestLib(cred_file='./test/credentials.conf', cmd='./offlineimap.py')
+
+def setUpModule():
+    logging.info("Set Up test module %s" % __name__)
+    tdir = OLITestLib.create_test_dir(suffix=__name__)
+
+def tearDownModule():
+    logging.info("Tear Down test module")
+    OLITestLib.delete_test_dir()
+
+class TestUIDMap(unittest.TestCase):
+    """Tests of the map and log files of UID mappings"""
+
+    def getfilename(self, name):
+        return os.path.join(OLITestLib.testdir, name)
+
+    def test_01_roundtrip(self):
+        """Test adding, removing and reopening mappings"""
+        filename = self.getfilename('roundtrip')
+        mapping = UIDMap(filename)
+        mapping.add(1, 10)
+        mapping.add(2, 20)
+        mapping.add(3, 30)
+        mapping.add(-1, 40) # only kept in memory
+        mapping.add(2, 21) # replaces 2:20
+        mapping.add(4, 30) # replaces 3:30
+        mapping.removeremote(10)
+        self.assertEqual(sorted(mapping.l2r.items()), [(-1, 40),
+                                                       (2, 21), (4, 30)])
+        self.assertEqual(mapping.r2l[21], 2)
+        self.assertFalse(20 in mapping.r2l)
+
+        mapping = UIDMap(filename)
+        self.assertEqual(sorted(mapping.l2r.items()), [(2, 21), (4, 30)])
+        self.assertEqual(sorted(mapping.r2l.items()), [(21, 2), (30, 4)])
+        mapping.add(-2, 50)
+        mapping.compact()
+        self.assertFalse(os.path.exists(filename + '.uidlog'))
+        self.assertEqual(sorted(mapping.l2r.items()), [(-2, 50),
+                                                       (2, 21), (4, 30)])
+        mapping.removelocal(4)
+        mapping.add(5, 60)
+
+        mapping = UIDMap(filename)
+        self.assertEqual(sorted(mapping.l2r.items()), [(2, 21), (5, 60)])
+        self.assertEqual(mapping.l2r.get(4), None)
+        self.assertEqual(len(mapping), 2)
+
+    def test_02_compact_when_due(self):
+        """Test merging a log that grew large into the map file"""
+        filename = self.getfilename('compact')
+        mapping = UIDMap(filename)
+        count = uidmap.LOGMINRECORDS + 1
+        for uid in xrange(1, count + 1):
+            mapping.add(uid, uid + 1000)
+        self.assertFalse(os.path.exists(filename + '.uidlog'))
+        mapping = UIDMap(filename)
+        self.assertEqual(len(mapping), count)
+        self.assertEqual(mapping.r2l[count + 1000], count)
+
+    def test_03_log_cut_short(self):
+        """Test dropping a log record cut short by a crash"""
+        filename = self.getfilename('cutshort')
+        mapping = UIDMap(filename)
+        mapping.add(1, 10)
+        mapping.add(2, 20)
+        with open(filename + '.uidlog', 'ab') as file:
+            file.write(uidmap.RECORD.pack('A', 3, 30)[:-1])
+
+        mapping = UIDMap(filename)
+        self.assertEqual(sorted(mapping.l2r.items()), [(1, 10), (2, 20)])
+        self.assertEqual(os.path.getsize(filename + '.uidlog'),
+                         2 * uidmap.RECORD.size)
+        mapping.add(3, 31)
+        mapping = UIDMap(filename)
+        self.assertEqual(sorted(mapping.l2r.items()),
+                         [(1, 10), (2, 20), (3, 31)])
+
+    def test_04_convert(self):
+        """Test converting the text file of older versions"""
+        filename = self.getfilename('convert')
+        with open(filename, 'wt') as file:
+            file.write('1:10\n2:20\n')
+        mapping = UIDMap(filename)
+        self.assertEqual(sorted(mapping.l2r.items()), [(1, 10), (2, 20)])
+        self.assertTrue(os.path.exists(filename + '.old'))
+        self.assertEqual(sorted(UIDMap(filename).r2l.items()),
+                         [(10, 1), (20, 2)])
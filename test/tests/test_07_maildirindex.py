@@ -0,0 +1,123 @@
+# Copyright (C) 2013- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import unittest
+import logging
+import os
+import time
+
+from offlineimap.accounts import Account
+from offlineimap.repository.Maildir import MaildirRepository
+from offlineimap.ui import UI_LIST, setglobalui
+
+from test.OLItest import OLITestLib
+
+# Things need to be setup first, usually setup.py initializes everything.
+# but if e.g. called from command line, we take care of default values here:
+if not OLITestLib.cred_file:
+    OLITestLib(cred_file='./test/credentials.conf', cmd='./offlineimap.py')
+
+def setUpModule():
+    logging.info("Set Up test module %s" % __name__)
+    tdir = OLITestLib.create_test_dir(suffix=__name__)
+
+def tearDownModule():
+    logging.info("Tear Down test module")
+    OLITestLib.delete_test_dir()
+
+MESSAGE = "From: a@example.org\nSubject: test\n\nbody\n"
+
+class TestMaildirIndex(unittest.TestCase):
+    """Tests of the scan index of Maildir folders"""
+
+    @classmethod
+    def setUpClass(cls):
+        config = OLITestLib.get_default_config()
+        config.set('general', 'dry-run', 'False')
+        config.set('Repository Maildir', 'localfolders',
+                   os.path.join(OLITestLib.testdir, 'mail'))
+        setglobalui(UI_LIST['quiet'](config))
+        cls.account = Account(config, 'test')
+
+    def getfolder(self, name):
+        """:returns: the Maildir folder name, with its messages loaded
+
+        Each call uses a new repository, so that the folder's scan index
+        is loaded from disk."""
+        repository = MaildirRepository('Maildir', self.account)
+        repository.makefolder(name)
+        folder = repository.getfolder(name)
+        folder.cachemessagelist()
+        return folder
+
+    def getflags(self, folder):
+        return dict((uid, ''.join(sorted(folder.getmessageflags(uid))))
+                    for uid in folder.getmessageuidlist())
+
+    def settle(self, folder):
+        """Date back new/ and cur/, so that their stamps are indexed"""
+        past = time.time() - 60
+        for dirannex in ('new', 'cur'):
+            os.utime(os.path.join(folder.getfullname(), dirannex),
+                     (past, past))
+
+    def test_01_roundtrip(self):
+        """Test saving and loading the scan index"""
+        folder = self.getfolder('roundtrip')
+        folder.savemessage(1, MESSAGE, set('S'), None)
+        folder.savemessage(2, MESSAGE, set(), None)
+        self.settle(folder)
+
+        folder = self.getfolder('roundtrip')
+        index = folder._loadindex()
+        self.assertEqual(sorted(index[0]), ['cur', 'new'])
+        for dirannex in ('new', 'cur'):
+            self.assertEqual(index[0][dirannex], folder._getdirstamp(
+                    os.path.join(folder.getfullname(), dirannex)))
+        self.assertEqual(self.getflags(folder), {1: 'S', 2: ''})
+        self.assertEqual(self.getflags(self.getfolder('roundtrip')),
+                         {1: 'S', 2: ''})
+
+    def test_02_changed(self):
+        """Test rescanning a directory that changed since it was indexed"""
+        folder = self.getfolder('changed')
+        folder.savemessage(1, MESSAGE, set('S'), None)
+        self.settle(folder)
+        folder = self.getfolder('changed')
+        folder.savemessageflags(1, set('FS'))
+        folder.savemessage(3, MESSAGE, set(), None)
+
+        folder = self.getfolder('changed')
+        self.assertEqual(self.getflags(folder), {1: 'FS', 3: ''})
+
+    def test_03_corrupt(self):
+        """Test scanning a folder whose index is corrupt or cut short"""
+        folder = self.getfolder('corrupt')
+        folder.savemessage(1, MESSAGE, set('S'), None)
+        folder.savemessage(2, MESSAGE, set('R'), None)
+        self.settle(folder)
+        folder = self.getfolder('corrupt')
+        filename = folder._getindexfilename()
+        with open(filename, 'rt') as file:
+            data = file.read()
+
+        for broken in (data[:data.rindex('\t')], data + 'new/x\t1\n'):
+            with open(filename, 'wt') as file:
+                file.write(broken)
+            self.assertEqual(folder._loadindex(), None)
+            self.assertEqual(self.getflags(self.getfolder('corrupt')),
+                             {1: 'S', 2: 'R'})
+            # written anew by the scan
+            self.assertNotEqual(folder._loadindex(), None)
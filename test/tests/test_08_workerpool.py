@@ -0,0 +1,60 @@
+# Copyright (C) 2013- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import unittest
+
+from offlineimap.threadutil import WorkerPool
+
+
+def double(item):
+    if item == 3:
+        raise ValueError(item)
+    return 2 * item
+
+class TestWorkerPool(unittest.TestCase):
+    """Tests of the pool of threads messages are copied on"""
+
+    def test_01_imap(self):
+        """Test running tasks and handing back their exceptions"""
+        pool = WorkerPool('test', 2)
+        results = {}
+        errors = {}
+        # more items than fit into the queue at once
+        for item, result, exc in pool.imap(double, xrange(10)):
+            if exc is None:
+                results[item] = result
+            else:
+                errors[item] = exc
+        self.assertEqual(results, dict((item, 2 * item) for item in
+                                       xrange(10) if item != 3))
+        self.assertEqual(errors.keys(), [3])
+        self.assertTrue(errors[3][0] is ValueError)
+        self.assertEqual(errors[3][1].args, (3,))
+        self.assertNotEqual(errors[3][2], None)
+        pool.shutdown()
+
+    def test_02_shutdown(self):
+        """Test stopping the workers, and starting them again"""
+        pool = WorkerPool('test', 3)
+        self.assertEqual(sorted(result for item, result, exc in
+                                pool.imap(double, [1, 2])), [2, 4])
+        workers = list(pool.workers)
+        self.assertEqual(len(workers), 3)
+        pool.shutdown()
+        self.assertEqual(pool.workers, [])
+        self.assertFalse([worker for worker in workers if worker.isAlive()])
+        self.assertEqual([result for item, result, exc in
+                          pool.imap(double, [5])], [10])
+        pool.shutdown()
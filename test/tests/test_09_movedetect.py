@@ -0,0 +1,49 @@
+# Copyright (C) 2013- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import unittest
+from StringIO import StringIO
+
+from offlineimap import movedetect
+
+
+class TestMoveDetectFunctions(unittest.TestCase):
+    """Tests of the helpers that key messages for move detection"""
+
+    def getsize(self, content):
+        return movedetect.getcrlffilesize(StringIO(content), len(content))
+
+    def test_01_readheaders(self):
+        """Test movedetect.readheaders()"""
+        file = StringIO('Message-ID: <a@b>\r\nSubject: x\r\n\r\nbody\n')
+        headers = movedetect.readheaders(file)
+        self.assertEqual(headers, 'Message-ID: <a@b>\r\nSubject: x\r\n')
+        self.assertEqual(movedetect.getmessageid(headers), '<a@b>')
+        self.assertEqual(file.read(), 'body\n')
+
+    def test_02_getcrlffilesize(self):
+        """Test movedetect.getcrlffilesize()"""
+        self.assertEqual(self.getsize(''), 0)
+        self.assertEqual(self.getsize('a\nb\r\nc\n'), 9)
+        self.assertEqual(self.getsize('\r\r\n\n'), 5)
+        # a CR at the end of a chunk and its LF at the start of the next
+        content = 'x' * (movedetect.CHUNKSIZE - 1) + '\r\n\n'
+        self.assertEqual(self.getsize(content), len(content) + 1)
+        # a CR at the end of a chunk without a LF after it
+        content = 'x' * (movedetect.CHUNKSIZE - 1) + '\rx\n'
+        self.assertEqual(self.getsize(content), len(content) + 1)
+        # bare newlines across several chunks
+        content = '\n' * (2 * movedetect.CHUNKSIZE + 1)
+        self.assertEqual(self.getsize(content), 2 * len(content))
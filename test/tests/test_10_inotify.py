@@ -0,0 +1,112 @@
+# Copyright (C) 2013- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import unittest
+import logging
+import os
+import shutil
+
+from offlineimap import inotify
+from offlineimap.accounts import Account
+from offlineimap.repository.Maildir import MaildirRepository
+from offlineimap.ui import UI_LIST, setglobalui
+
+from test.OLItest import OLITestLib
+
+# Things need to be setup first, usually setup.py initializes everything.
+# but if e.g. called from command line, we take care of default values here:
+if not OLITestLib.cred_file:
+    OLITestLib(cred_file='./test/credentials.conf', cmd='./offlineimap.py')
+
+def setUpModule():
+    logging.info("Set Up test module %s" % __name__)
+    tdir = OLITestLib.create_test_dir(suffix=__name__)
+
+def tearDownModule():
+    logging.info("Tear Down test module")
+    OLITestLib.delete_test_dir()
+
+@unittest.skipUnless(inotify.available(), "inotify is Linux only")
+class TestMaildirWatcher(unittest.TestCase):
+    """Tests of watching Maildir folders for changes with inotify"""
+
+    @classmethod
+    def setUpClass(cls):
+        config = OLITestLib.get_default_config()
+        config.set('general', 'dry-run', 'False')
+        config.set('Repository Maildir', 'localfolders',
+                   os.path.join(OLITestLib.testdir, 'mail'))
+        config.set('Repository Maildir', 'inotify', 'True')
+        setglobalui(UI_LIST['quiet'](config))
+        cls.account = Account(config, 'test')
+
+    def setUp(self):
+        self.repository = MaildirRepository('Maildir', self.account)
+        for name in ('watched', 'other'):
+            self.repository.makefolder(name)
+        # watches the folders as it lists them
+        self.repository.getfolders()
+        self.watcher = self.repository.watcher
+
+    def tearDown(self):
+        self.repository.close()
+
+    def deliver(self, name, filename):
+        """Move a message into cur/ of folder name, like a mail reader"""
+        folder = self.repository.getfolder(name)
+        tmpname = os.path.join(folder.getfullname(), 'tmp', filename)
+        with open(tmpname, 'wt') as file:
+            file.write('Subject: test\n\nbody\n')
+        os.rename(tmpname, os.path.join(folder.getfullname(), 'cur',
+                                        filename + ':2,S'))
+
+    def test_01_dirty(self):
+        """Test marking watched folders clean and dirty"""
+        self.assertEqual(sorted(self.watcher.folders), ['other', 'watched'])
+        # not known to be unchanged until marked clean
+        self.assertFalse(self.watcher.isclean('watched'))
+        self.watcher.markclean('watched')
+        self.watcher.markclean('other')
+        self.assertTrue(self.watcher.isclean('watched'))
+
+        self.deliver('watched', '1')
+        self.assertFalse(self.watcher.isclean('watched'))
+        self.assertTrue(self.watcher.isclean('other'))
+        self.watcher.markclean('watched')
+        self.assertTrue(self.watcher.isclean('watched'))
+        self.assertFalse(self.watcher.isclean('unwatched'))
+
+    def test_02_removed(self):
+        """Test a watched folder that is removed"""
+        self.watcher.markclean('other')
+        shutil.rmtree(self.repository.getfolder('other').getfullname())
+        self.assertFalse(self.watcher.isclean('other'))
+        # the kernel dropped the watches (IN_IGNORED)
+        self.assertFalse('other' in self.watcher.folders)
+        self.watcher.markclean('other')
+        self.assertFalse(self.watcher.isclean('other'))
+
+    def test_03_overflow(self):
+        """Test marking all folders dirty when events were lost"""
+        for name in ('watched', 'other'):
+            self.watcher.markclean(name)
+        read = self.watcher.inotify.read
+        self.watcher.inotify.read = lambda: [(-1, inotify.IN_Q_OVERFLOW, 0,
+                                              '')]
+        try:
+            self.assertFalse(self.watcher.isclean('watched'))
+            self.assertFalse(self.watcher.isclean('other'))
+        finally:
+            self.watcher.inotify.read = read